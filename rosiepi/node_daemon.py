@@ -0,0 +1,604 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+import argparse
+import collections
+import dataclasses
+import datetime
+import http.client
+import http.server
+import json
+import logging
+import os
+import pathlib
+import signal
+import socket
+import socketserver
+import threading
+import time
+import traceback
+
+from .run_rosiepi import (
+    NodeResources, PhysaCIConfig, TestResultPayload, run_check
+)
+from .rosie.metrics import NodeMetrics, serve_metrics
+from .rosie.outbox import ResultOutbox
+from .rosie.pipeline import TestPipeline
+from .rosie.result_log import prune_logs
+from .rosie.result_upload import ResultUploader
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+DEFAULT_SOCKET = pathlib.Path.home() / ".cache" / "rosiepi" / "daemon.sock"
+
+# finished jobs remembered for deduplication and status requests
+JOB_HISTORY = 200
+
+
+@dataclasses.dataclass
+class TestJob(): # pylint: disable=too-many-instance-attributes
+    """ Dataclass to contain a test job taken by the node daemon.
+
+    :param: str commit: The commit of circuitpython to test.
+    :param: str check_run_id: The ID of the check run that asked for it.
+    :param: str branch: The branch the commit was pushed to, if known.
+                        A newer commit on the branch supersedes the job
+                        while it is queued.
+    :param: str status: ``queued``, ``running``, ``done``, ``failed`` or
+                        ``superseded``.
+    :param: list coalesced: IDs of other check runs for the same commit,
+                            answered by this job's results.
+    :param: str superseded_by: The commit that superseded the job.
+    :param: float submitted: ``time.time()`` when the job was taken.
+    :param: float started: ``time.time()`` when the job started running.
+    :param: float finished: ``time.time()`` when the job finished.
+    :param: str error: The error the job failed with.
+    """
+    commit: str
+    check_run_id: str
+    branch: str = None
+    status: str = "queued"
+    coalesced: list = dataclasses.field(default_factory=list)
+    superseded_by: str = None
+    submitted: float = dataclasses.field(default_factory=time.time)
+    started: float = None
+    finished: float = None
+    error: str = None
+
+    @property
+    def check_run_ids(self):
+        """ Every check run answered by the job. """
+        return [self.check_run_id] + self.coalesced
+
+
+class JobQueue():
+    """ The node daemon's queue of test jobs, run in the order they were
+        taken.
+
+        A check run that was already taken isn't queued again. A commit
+        that is already queued is coalesced into the queued job, which
+        then answers both check runs. A commit on a branch supersedes the
+        jobs still queued for older commits on the same branch; jobs that
+        are running are left to finish.
+
+    :param: int max_queued: The most jobs waiting to run.
+    """
+    def __init__(self, max_queued=32):
+        self.max_queued = max_queued
+        self._queued = collections.deque()
+        self._jobs = collections.OrderedDict()
+        self._changed = threading.Condition()
+        self._closed = False
+
+    def submit(self, commit, check_run_id, branch=None):
+        """ Takes a job. Returns the job that will answer the check run,
+            whether it is a new job, and the jobs it superseded.
+
+        :param: str commit: The commit of circuitpython to test.
+        :param: str check_run_id: The ID of the check run.
+        :param: str branch: The branch the commit was pushed to, if known.
+        """
+        check_run_id = str(check_run_id)
+        with self._changed:
+            if self._closed:
+                raise RuntimeError("The node daemon is shutting down.")
+
+            known = self._jobs.get(check_run_id)
+            if known is not None:
+                return known, False, []
+
+            for job in self._queued:
+                if job.commit == commit:
+                    job.coalesced.append(check_run_id)
+                    self._jobs[check_run_id] = job
+                    return job, False, []
+
+            superseded = []
+            if branch is not None:
+                superseded = [job for job in self._queued if job.branch == branch]
+                for job in superseded:
+                    self._queued.remove(job)
+                    job.status = "superseded"
+                    job.superseded_by = commit
+                    job.finished = time.time()
+
+            if len(self._queued) >= self.max_queued:
+                err_msg = [
+                    f"The job queue is full ({self.max_queued} jobs).",
+                    f"Check run {check_run_id} was not queued.",
+                ]
+                raise RuntimeError("\n".join(err_msg))
+
+            job = TestJob(commit, check_run_id, branch=branch)
+            self._queued.append(job)
+            self._jobs[check_run_id] = job
+            self._forget_old()
+            self._changed.notify_all()
+
+        return job, True, superseded
+
+    def _forget_old(self):
+        finished = [
+            check_run_id for check_run_id, job in self._jobs.items()
+            if job.finished is not None
+        ]
+        for check_run_id in finished[:max(len(finished) - JOB_HISTORY, 0)]:
+            del self._jobs[check_run_id]
+
+    def get(self):
+        """ Waits for the next job, and marks it as running. Returns
+            ``None`` once the queue is closed.
+        """
+        with self._changed:
+            while not self._queued and not self._closed:
+                self._changed.wait()
+            if self._closed:
+                return None
+            job = self._queued.popleft()
+            job.status = "running"
+            job.started = time.time()
+            return job
+
+    @staticmethod
+    def finish(job, error=None):
+        """ Marks a running job as finished. """
+        job.status = "done" if error is None else "failed"
+        job.error = error
+        job.finished = time.time()
+
+    def jobs(self):
+        """ Every job the queue knows about, oldest first. """
+        with self._changed:
+            unique = {id(job): job for job in self._jobs.values()}
+            return sorted(unique.values(), key=lambda job: job.submitted)
+
+    def find(self, check_run_id):
+        """ The job answering ``check_run_id``, if there is one. """
+        with self._changed:
+            return self._jobs.get(str(check_run_id))
+
+    def close(self):
+        """ Stops handing out jobs. Queued jobs are dropped. """
+        with self._changed:
+            self._closed = True
+            self._changed.notify_all()
+
+
+def superseded_payload(job):
+    """ The results sent for the check runs of a superseded job.
+
+        :param: job: The superseded ``TestJob``.
+    """
+    payload = TestResultPayload()
+    payload.github_data.conclusion = "cancelled"
+    payload.github_data.completed_at = (
+        datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    )
+    payload.github_data.output.update({
+        "title": "RosiePi Test Results",
+        "summary": f"RosiePi Node: {socket.gethostname()}\n\n"
+                   f"Superseded by {job.superseded_by}",
+        "text": f"Testing {job.commit} was skipped in favor of "
+                f"{job.superseded_by}, which was pushed to {job.branch} "
+                "before the tests started.",
+    })
+    return payload
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _DaemonHandler(http.server.BaseHTTPRequestHandler):
+    node_daemon = None
+
+    def address_string(self):
+        return "local"
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        rosiepi_logger.debug("daemon: " + format, *args)
+
+    def _send_json(self, status, body):
+        encoded = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def do_GET(self): # pylint: disable=invalid-name
+        """ Serves job status, and the node's metrics. """
+        path = self.path.split("?")[0].rstrip("/")
+        if path == "/jobs":
+            self._send_json(200, {
+                "jobs": [
+                    dataclasses.asdict(job)
+                    for job in self.node_daemon.jobs.jobs()
+                ]
+            })
+        elif path.startswith("/jobs/"):
+            job = self.node_daemon.jobs.find(path[len("/jobs/"):])
+            if job is None:
+                self._send_json(404, {"error": "No such job."})
+            else:
+                self._send_json(200, dataclasses.asdict(job))
+        elif path == "/metrics":
+            body = self.node_daemon.render_metrics().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self._send_json(404, {"error": "Not found."})
+
+    def do_POST(self): # pylint: disable=invalid-name
+        """ Takes a job: ``{"commit": ..., "check_run_id": ...}``, with
+            an optional ``"branch"``.
+        """
+        if self.path.split("?")[0].rstrip("/") != "/jobs":
+            self._send_json(404, {"error": "Not found."})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            commit = request["commit"]
+            check_run_id = request["check_run_id"]
+        except (ValueError, KeyError, TypeError):
+            self._send_json(
+                400, {"error": "Expected a JSON object with a commit and check_run_id."}
+            )
+            return
+
+        try:
+            job, queued, superseded = self.node_daemon.submit(
+                commit, check_run_id, branch=request.get("branch")
+            )
+        except RuntimeError as submit_err:
+            self._send_json(503, {"error": submit_err.args[0]})
+            return
+
+        self._send_json(202 if queued else 200, {
+            "job": dataclasses.asdict(job),
+            "superseded": [
+                check_run_id
+                for superseded_job in superseded
+                for check_run_id in superseded_job.check_run_ids
+            ],
+        })
+
+
+class NodeDaemon(): # pylint: disable=too-many-instance-attributes
+    """ Resident RosiePi node. Takes test jobs over HTTP on a Unix socket,
+        and runs them through one ``TestPipeline``, keeping the firmware
+        cache, git mirrors, worktrees, flash record and board index warm
+        between jobs.
+
+        Only as many jobs as the pipeline works on at once are started;
+        the rest wait in the ``JobQueue``, where they can still be
+        coalesced or superseded. Superseded check runs are concluded as
+        cancelled.
+
+    :param: config: A ``PhysaCIConfig()`` instance.
+    :param: resources: The node's ``NodeResources``. Set up from ``config``
+                       if not supplied.
+    :param: socket_path: The Unix socket to take jobs on.
+    """
+    def __init__(self, config, resources=None, socket_path=None):
+        self.config = config
+        self.resources = resources or NodeResources.from_config(config)
+        self.socket_path = pathlib.Path(
+            socket_path or config.daemon_socket or DEFAULT_SOCKET
+        )
+        self.jobs = JobQueue(max_queued=config.daemon_max_queued)
+        self.pipeline = TestPipeline(
+            config.supported_boards,
+            fw_cache=self.resources.fw_cache,
+            build_jobs=config.build_jobs,
+            worktree_pool=self.resources.worktree_pool,
+            build_settings=self.resources.build_settings,
+            concurrent_tests=config.concurrent_tests,
+            build_ahead=config.build_ahead
+        )
+        self._job_slots = threading.Semaphore(config.build_ahead + 1)
+        self._job_threads = []
+        # delivers cancellations, and results left from earlier jobs,
+        # while no job is running
+        self.outbox = ResultOutbox(
+            ResultUploader(
+                config.physaci_url,
+                config.physaci_api_key,
+                None,
+                compress=config.compress_uploads
+            ),
+            outbox_dir=config.outbox_dir
+        )
+        self._metrics = None
+        self._metrics_lock = threading.Lock()
+        self._server = None
+        self._metrics_server = None
+        self._stop = threading.Event()
+
+    def submit(self, commit, check_run_id, branch=None):
+        """ Takes a job; see ``JobQueue.submit``. Superseded jobs' check
+            runs are concluded as cancelled.
+        """
+        job, queued, superseded = self.jobs.submit(commit, check_run_id, branch)
+        if queued:
+            rosiepi_logger.info(
+                "Queued %s for check run %s.", commit, job.check_run_id
+            )
+        else:
+            rosiepi_logger.info(
+                "Check run %s is answered by the job for %s.",
+                check_run_id, job.commit
+            )
+        for superseded_job in superseded:
+            rosiepi_logger.info(
+                "%s superseded %s on %s.",
+                commit, superseded_job.commit, branch
+            )
+            self._cancel(superseded_job)
+        return job, queued, superseded
+
+    def _cancel(self, job):
+        payload = superseded_payload(job)
+        for check_run_id in job.check_run_ids:
+            uploader = ResultUploader(
+                self.config.physaci_url,
+                self.config.physaci_api_key,
+                check_run_id,
+                compress=self.config.compress_uploads
+            )
+            with uploader:
+                ResultOutbox(uploader, outbox_dir=self.config.outbox_dir).send_final(
+                    payload
+                )
+        self.outbox.wake()
+
+    def render_metrics(self):
+        """ The node's metric totals in the Prometheus text format. """
+        with self._metrics_lock:
+            if self._metrics is None:
+                # publishing nothing reads the stored totals
+                self._metrics = NodeMetrics().publish(self.config.metrics_state_file)
+            return self._metrics.render()
+
+    def _run_job(self, job):
+        try:
+            totals = run_check(
+                job.commit,
+                job.check_run_id,
+                self.config,
+                self.resources,
+                pipeline=self.pipeline,
+                coalesced=job.coalesced,
+                queue_wait=job.started - job.submitted
+            )
+        except Exception: # pylint: disable=broad-except
+            rosiepi_logger.exception("Job for %s failed.", job.commit)
+            self.jobs.finish(job, error=traceback.format_exc())
+        else:
+            self.jobs.finish(job)
+            if totals is not None:
+                with self._metrics_lock:
+                    self._metrics = totals
+        finally:
+            self._job_slots.release()
+
+    def _dispatch(self):
+        while True:
+            # a job is only taken once it can start, so that it can be
+            # coalesced or superseded for as long as possible
+            self._job_slots.acquire()
+            job = self.jobs.get()
+            if job is None:
+                self._job_slots.release()
+                return
+            rosiepi_logger.info(
+                "Starting %s for check run(s) %s.",
+                job.commit, ", ".join(job.check_run_ids)
+            )
+            thread = threading.Thread(
+                target=self._run_job, args=(job,),
+                name=f"rosiepi-job-{job.check_run_id}"
+            )
+            self._job_threads = [
+                job_thread for job_thread in self._job_threads
+                if job_thread.is_alive()
+            ] + [thread]
+            thread.start()
+
+    def _bind(self):
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        if self.socket_path.exists():
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(str(self.socket_path))
+            except OSError:
+                # left behind by a daemon that didn't shut down cleanly
+                self.socket_path.unlink()
+            else:
+                raise RuntimeError(
+                    f"A node daemon is already running on {self.socket_path}"
+                )
+            finally:
+                probe.close()
+
+        handler = type("DaemonHandler", (_DaemonHandler,), {"node_daemon": self})
+        self._server = _UnixHTTPServer(str(self.socket_path), handler)
+        os.chmod(self.socket_path, 0o660)
+
+    def start(self):
+        """ Starts taking and running jobs. """
+        self._bind()
+        if self.resources.board_index is not None:
+            self.resources.board_index.watch()
+        self.pipeline.start()
+        self.outbox.start()
+        threading.Thread(
+            target=self._dispatch, name="rosiepi-dispatch", daemon=True
+        ).start()
+        threading.Thread(
+            target=self._server.serve_forever, name="rosiepi-daemon", daemon=True
+        ).start()
+        if self.config.metrics_port:
+            self._metrics_server = serve_metrics(self, self.config.metrics_port)
+        rosiepi_logger.info("Node daemon taking jobs on %s", self.socket_path)
+
+    def render(self):
+        """ Lets ``serve_metrics`` serve the daemon's metrics. """
+        return self.render_metrics()
+
+    def stop(self):
+        """ Stops taking jobs, and waits for the running ones to finish.
+            Jobs still queued are dropped; their check runs are left for
+            physaCI to time out.
+        """
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            try:
+                self.socket_path.unlink()
+            except FileNotFoundError:
+                pass
+        if self._metrics_server is not None:
+            self._metrics_server.shutdown()
+        self.jobs.close()
+        for thread in self._job_threads:
+            thread.join()
+        self.pipeline.close()
+        self.outbox.stop()
+        if self.resources.board_index is not None:
+            self.resources.board_index.stop()
+
+    def serve_forever(self):
+        """ Runs the daemon until it gets ``SIGTERM`` or ``SIGINT``. """
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *_: self._stop.set())
+        self.start()
+        try:
+            while not self._stop.wait(3600):
+                prune_logs(self.config.log_dir, self.config.log_max_age)
+        finally:
+            self.stop()
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=30):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = str(socket_path)
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def daemon_request(method, path, body=None, socket_path=None):
+    """ Sends a request to the node daemon, and returns the status code
+        and the decoded JSON response.
+
+        :param: str method: The HTTP method.
+        :param: str path: The path, e.g. ``/jobs``.
+        :param: body: An optional object to send as JSON.
+        :param: socket_path: The daemon's socket. Defaults to
+                             ``DEFAULT_SOCKET``.
+    """
+    connection = _UnixHTTPConnection(socket_path or DEFAULT_SOCKET)
+    try:
+        headers = {}
+        encoded = None
+        if body is not None:
+            encoded = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        connection.request(method, path, body=encoded, headers=headers)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read() or b"null")
+    finally:
+        connection.close()
+
+
+cli_parser = argparse.ArgumentParser(description="RosiePi node daemon") # pylint: disable=invalid-name
+cli_parser.add_argument(
+    "--socket",
+    help="Unix socket of the daemon. Defaults to the configured daemon_socket."
+)
+cli_commands = cli_parser.add_subparsers(dest="command") # pylint: disable=invalid-name
+cli_commands.add_parser("serve", help="Run the daemon (the default).")
+submit_parser = cli_commands.add_parser("submit", help="Queue a test job.") # pylint: disable=invalid-name
+submit_parser.add_argument("commit", help="Commit of circuitpython firmware to test")
+submit_parser.add_argument("check_run_id", help="ID of the check run that requested the test")
+submit_parser.add_argument("--branch", help="Branch the commit was pushed to")
+cli_commands.add_parser("jobs", help="List the daemon's jobs.")
+
+def main():
+    """ Run the RosiePi node daemon, or send it a request. """
+    cli_arg = cli_parser.parse_args()
+    config = PhysaCIConfig()
+    socket_path = cli_arg.socket or config.daemon_socket
+
+    if cli_arg.command in (None, "serve"):
+        prune_logs(config.log_dir, config.log_max_age)
+        NodeDaemon(config, socket_path=socket_path).serve_forever()
+        return
+
+    if cli_arg.command == "submit":
+        status, response = daemon_request(
+            "POST",
+            "/jobs",
+            {
+                "commit": cli_arg.commit,
+                "check_run_id": cli_arg.check_run_id,
+                "branch": cli_arg.branch,
+            },
+            socket_path=socket_path
+        )
+    else:
+        status, response = daemon_request("GET", "/jobs", socket_path=socket_path)
+
+    print(json.dumps(response, indent=2))
+    if status >= 400:
+        raise SystemExit(1)
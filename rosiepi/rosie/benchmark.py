@@ -0,0 +1,321 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+""" Throughput benchmark of ``TestController``, run against a simulated
+    board or a replayed recording of a real one, so that controller
+    overhead can be tracked commit over commit on any host.
+"""
+
+import argparse
+import dataclasses
+import json
+import pathlib
+import platform
+import statistics
+import tempfile
+import time
+
+from .replay import ReplayBoard, load_capture
+from .simulator import LinkModel, SimulatedBoard
+from .test_controller import TestController
+
+cli_parser = argparse.ArgumentParser(
+    description="Benchmark the rosiepi test controller on a simulated board."
+)
+cli_parser.add_argument(
+    "--sizes",
+    default="10x20,50x20,10x200",
+    help=(
+        "Comma separated suite sizes to run, each as "
+        "<number of tests>x<lines per test>."
+    )
+)
+cli_parser.add_argument(
+    "--output-every",
+    type=int,
+    default=5,
+    help="Make every Nth line of a test an output check. 0 for none."
+)
+cli_parser.add_argument(
+    "--repeat",
+    type=int,
+    default=3,
+    help="Times to run each suite. The median run is reported."
+)
+cli_parser.add_argument("--latency", type=float, default=LinkModel.latency,
+                        help="Link latency, in seconds.")
+cli_parser.add_argument("--bandwidth", type=float, default=LinkModel.bandwidth,
+                        help="Link bandwidth, in bytes per second.")
+cli_parser.add_argument("--exec-time", type=float, default=LinkModel.exec_time,
+                        help="Seconds the board spends starting each command.")
+cli_parser.add_argument("--paste-window", type=int, default=LinkModel.paste_window,
+                        help="Raw-paste window in bytes. 0 disables raw-paste.")
+cli_parser.add_argument(
+    "--replay",
+    dest="capture_file",
+    default=None,
+    help=(
+        "Replay a recording of a real board, made with a controller "
+        "``capture_dir``, instead of running synthetic suites."
+    )
+)
+cli_parser.add_argument(
+    "--speed",
+    type=float,
+    default=1.0,
+    help="How many times faster than recorded to replay."
+)
+cli_parser.add_argument(
+    "--json",
+    dest="json_file",
+    default=None,
+    help="Also write the results as JSON to this file."
+)
+
+
+@dataclasses.dataclass
+class BenchmarkResult(): # pylint: disable=too-many-instance-attributes
+    """ Dataclass to contain the measurements of one benchmark suite.
+
+    :param: int tests: Number of test files in the suite.
+    :param: int lines_per_test: Lines of code in each test file.
+    :param: int lines: Lines of code run in total.
+    :param: float wall_time: Seconds taken by ``run_tests``.
+    :param: float cpu_time: Seconds of host CPU used by the controller.
+    :param: int round_trips: Times the controller waited on the board.
+    :param: int bytes_to_board: Bytes the controller sent.
+    :param: int bytes_from_board: Bytes the controller received.
+    :param: bool passed: Whether every test passed.
+    """
+    tests: int
+    lines_per_test: int
+    lines: int
+    wall_time: float
+    cpu_time: float
+    round_trips: int
+    bytes_to_board: int
+    bytes_from_board: int
+    passed: bool
+
+    @property
+    def lines_per_second(self):
+        """ Lines of test code run per second. """
+        return self.lines / self.wall_time if self.wall_time else 0
+
+    @property
+    def round_trips_per_test(self):
+        """ Average times the controller waited on the board per test. """
+        return self.round_trips / self.tests if self.tests else 0
+
+    @property
+    def cpu_per_line(self):
+        """ Seconds of controller CPU time per line of test code. """
+        return self.cpu_time / self.lines if self.lines else 0
+
+    def summary(self):
+        """ The result and its derived rates, as a dict. """
+        summary = dataclasses.asdict(self)
+        summary.update({
+            "lines_per_second": self.lines_per_second,
+            "round_trips_per_test": self.round_trips_per_test,
+            "cpu_per_line": self.cpu_per_line,
+        })
+        return summary
+
+
+def write_synthetic_suite(tests_dir, tests, lines_per_test, output_every=5):
+    """ Writes a suite of ``tests`` rosie test files to ``tests_dir``, each
+        with ``lines_per_test`` lines of code. Every ``output_every``th line
+        is checked with an ``output`` interaction. Returns the number of
+        lines of code in the suite.
+    """
+    tests_dir = pathlib.Path(tests_dir)
+    tests_dir.mkdir(parents=True, exist_ok=True)
+    for test_no in range(tests):
+        test_lines = ["total = 0\n"]
+        for line_no in range(1, lines_per_test):
+            if output_every and line_no % output_every == 0:
+                test_lines.append(f"#$ output={line_no * 2}\n")
+                test_lines.append(f"print({line_no} * 2)\n")
+            else:
+                test_lines.append(f"total += {line_no}\n")
+        (tests_dir / f"bench_{test_no:04}.py").write_text("".join(test_lines))
+    return tests * lines_per_test
+
+
+def run_suite(tests, lines_per_test, model, output_every=5):
+    """ Runs a synthetic suite through ``TestController`` on a simulated
+        board, and returns its ``BenchmarkResult``.
+
+    :param: int tests: Number of test files to run.
+    :param: int lines_per_test: Lines of code in each test file.
+    :param: model: The ``simulator.LinkModel`` of the simulated board.
+    :param: int output_every: Check every Nth line's output.
+    """
+    with tempfile.TemporaryDirectory(prefix="rosiepi-bench-") as work_dir:
+        work_dir = pathlib.Path(work_dir)
+        lines = write_synthetic_suite(
+            work_dir / "tests", tests, lines_per_test, output_every
+        )
+        controller = TestController(
+            "simulated",
+            "benchmark",
+            log_dir=work_dir / "logs",
+            board_factory=SimulatedBoard.factory(model),
+            tests_dir=work_dir / "tests"
+        )
+        return measure(controller, tests, lines_per_test, lines)
+
+
+def run_replay(capture_file, speed=1.0):
+    """ Replays a recording of a real board through ``TestController``,
+        running the tests stored with it, and returns its
+        ``BenchmarkResult``.
+
+    :param: capture_file: Path of the recording.
+    :param: float speed: How many times faster than recorded to replay.
+    """
+    info, _ = load_capture(capture_file)
+    with tempfile.TemporaryDirectory(prefix="rosiepi-replay-") as work_dir:
+        work_dir = pathlib.Path(work_dir)
+        tests_dir = work_dir / "tests"
+        tests_dir.mkdir()
+        lines = 0
+        for test_file, source in info["tests"].items():
+            (tests_dir / test_file).write_text(source)
+            lines += sum(
+                1 for line in source.splitlines()
+                if line.strip() and not line.startswith("#$")
+            )
+
+        controller = TestController(
+            info.get("board", "replay"),
+            info.get("build_ref", "replay"),
+            log_dir=work_dir / "logs",
+            board_factory=ReplayBoard.factory(capture_file, speed=speed),
+            tests_dir=tests_dir
+        )
+        tests = len(info["tests"])
+        return measure(controller, tests, lines // max(tests, 1), lines)
+
+
+def measure(controller, tests, lines_per_test, lines):
+    """ Runs the controller's tests, and returns the ``BenchmarkResult``.
+
+    :param: controller: A connected ``TestController``.
+    :param: int tests: Number of test files to be run.
+    :param: int lines_per_test: Lines of code in each test file.
+    :param: int lines: Lines of code in all of the tests.
+    """
+    if controller.state == "error" or not controller.prepare_tests():
+        raise RuntimeError(controller.log.tail())
+
+    # the simulated board runs in its own thread, so only the
+    # controller's CPU time is counted
+    cpu_start = time.thread_time()
+    wall_start = time.perf_counter()
+    controller.run_tests()
+    wall_time = time.perf_counter() - wall_start
+    cpu_time = time.thread_time() - cpu_start
+
+    stats = controller.board.stats
+    controller.board.close()
+    controller.log.close()
+
+    return BenchmarkResult(
+        tests=tests,
+        lines_per_test=lines_per_test,
+        lines=lines,
+        wall_time=wall_time,
+        cpu_time=cpu_time,
+        round_trips=stats["round_trips"],
+        bytes_to_board=stats["bytes_to_board"],
+        bytes_from_board=stats["bytes_from_board"],
+        passed=controller.tests_failed == 0 and controller.tests_run == tests,
+    )
+
+
+def parse_sizes(sizes):
+    """ Parses ``--sizes`` into ``(tests, lines_per_test)`` pairs. """
+    parsed = []
+    for size in sizes.split(","):
+        tests, _, lines = size.strip().partition("x")
+        parsed.append((int(tests), int(lines)))
+    return parsed
+
+
+def main():
+    """ Runs the benchmark suites and reports their results. """
+    cli_args = cli_parser.parse_args()
+    model = LinkModel(
+        latency=cli_args.latency,
+        bandwidth=cli_args.bandwidth,
+        exec_time=cli_args.exec_time,
+        paste_window=cli_args.paste_window,
+    )
+
+    header = (
+        f"{'suite':>10} {'lines/s':>10} {'trips/test':>11} "
+        f"{'cpu us/line':>12} {'passed':>7}"
+    )
+    print(header)
+    print("-" * len(header))
+
+    if cli_args.capture_file:
+        suites = [None]
+    else:
+        suites = parse_sizes(cli_args.sizes)
+
+    results = []
+    for suite in suites:
+        if suite is None:
+            runs = [
+                run_replay(cli_args.capture_file, cli_args.speed)
+                for _ in range(max(cli_args.repeat, 1))
+            ]
+        else:
+            runs = [
+                run_suite(suite[0], suite[1], model, cli_args.output_every)
+                for _ in range(max(cli_args.repeat, 1))
+            ]
+        median_wall = statistics.median_low(run.wall_time for run in runs)
+        result = next(run for run in runs if run.wall_time == median_wall)
+        results.append(result)
+        print(
+            f"{result.tests:>4}x{result.lines_per_test:<5} "
+            f"{result.lines_per_second:>10.1f} "
+            f"{result.round_trips_per_test:>11.1f} "
+            f"{result.cpu_per_line * 1e6:>12.1f} "
+            f"{str(result.passed):>7}"
+        )
+
+    if cli_args.json_file:
+        report = {
+            "python": platform.python_version(),
+            "model": dataclasses.asdict(model),
+            "replay": cli_args.capture_file,
+            "results": [result.summary() for result in results],
+        }
+        with open(cli_args.json_file, "w") as json_file:
+            json.dump(report, json_file, indent=2)
@@ -0,0 +1,318 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import pathlib
+import time
+
+try:
+    import pyudev
+except ImportError:
+    pyudev = None # pylint: disable=invalid-name
+
+from rosiepi.rosie.device_watch import DeviceWatcher
+
+from tests import pyboard
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+DEFAULT_INDEX_FILE = pathlib.Path.home() / ".cache" / "rosiepi" / "boards.json"
+
+
+def _usb_ids(cpboard):
+    """ The USB vendor ID, product ID and serial number of a connected
+        board, where pyboard exposes them.
+    """
+    usb_dev = getattr(cpboard, "usb_dev", None)
+    return {
+        "vid": getattr(usb_dev, "idVendor", None),
+        "pid": getattr(usb_dev, "idProduct", None),
+        "usb_serial": getattr(usb_dev, "serial_number", None),
+    }
+
+
+class BoardIndex():
+    """ Node-side index of where each attached board was last found,
+        keyed by board name: its serial number and USB IDs, the
+        ``serial/by-id`` link of its serial port, its drive, and the
+        identity of its bootloader.
+
+        ``connect`` uses the index to reach a known board directly,
+        after a cheap check of the udev-maintained ``by-id`` links,
+        and only falls back to a full scan when the board isn't where
+        the index says it is. USB hotplug events keep the index's view
+        of which boards are present up to date; see ``watch``.
+
+    :param: index_file: Path to the JSON file holding the index.
+    :param: device_watcher: The ``DeviceWatcher`` used to read and wait on
+                            the device tree. Defaults to ``DeviceWatcher()``.
+    :param: float index_wait: Most seconds ``connect`` waits for a known
+                              board to appear at its indexed port before
+                              scanning for it.
+    """
+
+    def __init__(self, index_file=None, device_watcher=None, index_wait=5):
+        self.index_file = pathlib.Path(index_file or DEFAULT_INDEX_FILE)
+        self.index_file.parent.mkdir(parents=True, exist_ok=True)
+        self.device_watcher = device_watcher or DeviceWatcher()
+        self.index_wait = index_wait
+        self._observer = None
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with open(self.index_file.with_suffix(".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                records = {}
+                if self.index_file.exists():
+                    try:
+                        with open(self.index_file, "r") as file:
+                            records = json.load(file)
+                    except ValueError:
+                        rosiepi_logger.warning(
+                            "Discarding unreadable board index: %s", self.index_file
+                        )
+                yield records
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _save(self, records):
+        tmp_file = self.index_file.with_suffix(".tmp")
+        with open(tmp_file, "w") as file:
+            json.dump(records, file, indent=1)
+        os.replace(tmp_file, self.index_file)
+
+    def get(self, board_name):
+        """ The index entry for ``board_name``, if any. """
+        with self._locked() as records:
+            return records.get(board_name)
+
+    def update(self, board_name, **fields):
+        """ Merges ``fields`` into the entry for ``board_name``. """
+        with self._locked() as records:
+            record = records.setdefault(board_name, {})
+            record.update(fields)
+            record["updated_at"] = time.time()
+            self._save(records)
+
+    def forget(self, board_name):
+        """ Drops the entry for a board, so it is scanned for next time. """
+        with self._locked() as records:
+            if records.pop(board_name, None) is not None:
+                self._save(records)
+
+    def record_board(self, board_name, cpboard):
+        """ Records where a connected board was found.
+
+        :param: str board_name: The name of the board.
+        :param: cpboard: The connected ``pyboard.CPboard``.
+        """
+        serial_number = cpboard.serial_number
+        ports = sorted(self.device_watcher.serial_ports(serial_number or ""))
+        disk = getattr(cpboard, "disk", None)
+        self.update(
+            board_name,
+            serial_number=serial_number,
+            port=ports[0] if serial_number and ports else None,
+            drive=getattr(disk, "path", None),
+            present=True,
+            **_usb_ids(cpboard)
+        )
+
+    def record_bootloader(self, board_name, boot_board=None, drive=None):
+        """ Records the identity of a board's bootloader.
+
+        :param: str board_name: The name of the board.
+        :param: boot_board: The ``pyboard.CPboard`` connected to the
+                            bootloader, if there is one.
+        :param: str drive: The ``disk/by-id`` name of the bootloader drive.
+        """
+        bootloader = dict((self.get(board_name) or {}).get("bootloader") or {})
+        if boot_board is not None:
+            bootloader.update(_usb_ids(boot_board))
+        if drive is not None:
+            bootloader["drive"] = drive
+        self.update(board_name, bootloader=bootloader)
+
+    def probe(self, board_name):
+        """ Cheaply checks whether the board is where the index last
+            found it. Returns its entry if it is, otherwise ``None``.
+        """
+        record = self.get(board_name)
+        if not record or not record.get("serial_number"):
+            return None
+        if not self.device_watcher.serial_ports(record["serial_number"]):
+            return None
+        return record
+
+    def _connect_direct(self, record, wait):
+        """ Connects to exactly the indexed board by its USB IDs. """
+        if record.get("vid") is None or record.get("pid") is None:
+            return None
+        usb_filter = {"idVendor": record["vid"], "idProduct": record["pid"]}
+        if record.get("usb_serial"):
+            usb_filter["serial_number"] = record["usb_serial"]
+        cpboard = pyboard.CPboard.from_usb(wait=wait, **usb_filter)
+        if cpboard.serial_number != record["serial_number"]:
+            return None
+        return cpboard
+
+    def connect(self, board_name, wait=20, scan=None, **kwargs):
+        """ Connects to ``board_name``, using the index to skip the full
+            scan when the board is where it was last found. A known board
+            that is briefly absent is waited on through its ``by-id`` link
+            for up to ``index_wait`` seconds, or only checked once when
+            hotplug events saw it unplugged, before it is scanned for.
+            Usable as ``TestController``'s ``board_factory``.
+
+        :param: str board_name: The name of the board.
+        :param: float wait: Most seconds to wait for the board to appear,
+                            in all.
+        :param: scan: Callable doing the full scan. Defaults to
+                      ``pyboard.CPboard.from_try_all``.
+        """
+        scan = scan or pyboard.CPboard.from_try_all
+        record = self.get(board_name)
+        start = time.monotonic()
+
+        if record and record.get("serial_number"):
+            index_wait = min(wait, self.index_wait)
+            if record.get("present") is False:
+                # it left and hasn't come back; waiting would only delay
+                # the scan.
+                index_wait = 0
+            try:
+                self.device_watcher.wait_for_serial(
+                    record["serial_number"], timeout=index_wait
+                )
+            except TimeoutError:
+                self.update(board_name, present=False)
+                rosiepi_logger.info(
+                    "%s is not at its indexed port; scanning.", board_name
+                )
+            else:
+                try:
+                    cpboard = self._connect_direct(record, 0)
+                except (RuntimeError, ValueError, OSError) as conn_err:
+                    rosiepi_logger.info(
+                        "Direct connection to %s failed; scanning. %s",
+                        board_name, conn_err
+                    )
+                    cpboard = None
+                if cpboard is not None:
+                    self.update(board_name, present=True)
+                    return cpboard
+
+        wait = max(wait - (time.monotonic() - start), 0)
+        cpboard = scan(board_name, wait=wait, **kwargs)
+        try:
+            self.record_board(board_name, cpboard)
+        except Exception as index_err: # pylint: disable=broad-except
+            rosiepi_logger.warning(
+                "Could not index %s: %s", board_name, index_err
+            )
+        return cpboard
+
+    def connect_bootloader(self, board_name):
+        """ Connects to a board's bootloader, going straight to the
+            indexed bootloader when its identity is known.
+        """
+        record = self.get(board_name) or {}
+        bootloader = record.get("bootloader") or {}
+        boot_board = None
+        if bootloader.get("usb_serial"):
+            try:
+                boot_board = pyboard.CPboard.from_build_name_bootloader(
+                    board_name, serial_number=bootloader["usb_serial"]
+                )
+            except (RuntimeError, ValueError, OSError):
+                boot_board = None
+        if boot_board is None:
+            boot_board = pyboard.CPboard.from_build_name_bootloader(board_name)
+            try:
+                self.record_bootloader(board_name, boot_board)
+            except Exception as index_err: # pylint: disable=broad-except
+                rosiepi_logger.warning(
+                    "Could not index the bootloader of %s: %s",
+                    board_name, index_err
+                )
+        return boot_board
+
+    def apply_event(self, action, serial_short):
+        """ Updates which indexed boards are present from a USB hotplug
+            event.
+
+        :param: str action: The udev action, e.g. ``"add"`` or ``"remove"``.
+        :param: str serial_short: The ``ID_SERIAL_SHORT`` of the device.
+        """
+        if action not in ("add", "remove") or not serial_short:
+            return
+        with self._locked() as records:
+            changed = False
+            for record in records.values():
+                if record.get("serial_number") != serial_short:
+                    continue
+                record["present"] = action == "add"
+                if action == "add":
+                    ports = sorted(self.device_watcher.serial_ports(serial_short))
+                    record["port"] = ports[0] if ports else record.get("port")
+                record["updated_at"] = time.time()
+                changed = True
+            if changed:
+                self._save(records)
+
+    def watch(self):
+        """ Keeps the index up to date from USB hotplug events, in the
+            background. Needs ``pyudev``; without it the index is only
+            refreshed as boards are connected. Returns whether watching
+            started.
+        """
+        if pyudev is None or self._observer is not None:
+            return self._observer is not None
+
+        monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+        monitor.filter_by(subsystem="tty")
+
+        def on_event(device):
+            try:
+                self.apply_event(device.action, device.get("ID_SERIAL_SHORT"))
+            except Exception: # pylint: disable=broad-except
+                rosiepi_logger.exception("Failed to apply a hotplug event.")
+
+        self._observer = pyudev.MonitorObserver(
+            monitor, callback=on_event, name="rosiepi-hotplug"
+        )
+        self._observer.daemon = True
+        self._observer.start()
+        return True
+
+    def stop(self):
+        """ Stops watching hotplug events. """
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer = None
@@ -21,9 +21,16 @@
  # THE SOFTWARE.
  #
 
+import concurrent.futures
+import contextlib
+import dataclasses
+import functools
 import logging
+import multiprocessing
 import os
 import pathlib
+import re
+import shutil
 import subprocess
 import time
 
@@ -31,6 +38,11 @@ import sh
 from sh.contrib import git
 
 from rosiepi.rosie import find_circuitpython as cirpy_dir
+from rosiepi.rosie import timing
+from rosiepi.rosie.device_watch import DeviceWatcher
+from rosiepi.rosie.fw_cache import make_cache_key
+from rosiepi.rosie.job_budget import JobBudget
+from rosiepi.rosie.worktrees import WorktreePool
 
 from tests import pyboard
 
@@ -38,64 +50,167 @@ rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
 
 _AVAILABLE_PORTS = ["atmel-samd", "nrf"]
 
+_RUN_ENVS = {
+    "BASH_ENV": "/etc/profile",
+}
+
+_FULL_SHA = re.compile(r"^[0-9a-f]{40}$")
+
 def check_local_clone():
     """ Checks if there is a local clone of the circuitpython repository.
         If not, it will clone it to the `circuitpython` directory.
     """
     check_dir = os.listdir(cirpy_dir())
     if ".git" not in check_dir:
-        working_dir = os.getcwd()
-        os.chdir(cirpy_dir())
         git.clone("https://github.com/adafruit/circuitpython.git",
-                  "--depth", "1")
-        os.chdir(working_dir)
+                  "--depth", "1", _cwd=str(cirpy_dir()))
 
-def build_fw(board, build_ref, test_log): # pylint: disable=too-many-locals,too-many-statements
-    """ Builds the firware at `build_ref` for `board`. Firmware will be
-        output to `.fw_builds/<build_ref>/<board>/`.
+def resolve_commit(build_ref):
+    """ Resolves `build_ref` to the full SHA of the commit it points
+        to, without fetching any objects.
 
-    :param: str board: Name of the board to build firmware for.
-    :param: str build_ref: The tag/commit to build firmware for.
-    :param: test_log: The TestController.log used for output.
+    :param: str build_ref: The tag/commit to resolve.
     """
-    working_dir = os.getcwd()
-    cirpy_ports_dir = pathlib.Path(cirpy_dir(), "ports")
-
-    board_port_dir = None
-    for port in _AVAILABLE_PORTS:
-        port_dir = cirpy_ports_dir / port / "boards" / board
-        if port_dir.exists():
-            board_port_dir = (cirpy_ports_dir / port).resolve()
-            rosiepi_logger.info("Board source found: %s", board_port_dir)
-            break
+    if _FULL_SHA.match(build_ref):
+        return build_ref
 
-    if board_port_dir is None:
+    try:
+        remote_refs = str(
+            git("ls-remote", "origin", build_ref, _cwd=str(cirpy_dir()))
+        ).split()
+    except sh.ErrorReturnCode as git_err:
         err_msg = [
-            f"'{board}' board not available to test. Can't build firmware.",
-            #"="*60,
-            #"Closing RosiePi"
+            f"Resolving '{build_ref}' failed:",
+            " - {}".format(str(git_err.stderr, encoding="utf-8").strip("\n")),
         ]
-        raise RuntimeError("\n".join(err_msg))
+        raise RuntimeError("\n".join(err_msg)) from None
 
-    build_dir = pathlib.Path.home() / ".fw_builds" / build_ref[:5] / board
+    if remote_refs:
+        return remote_refs[0]
 
-    os.chdir(cirpy_dir())
+    # not a named ref on the remote, so treat it as an abbreviated SHA
+    # that the local clone may already know about.
     try:
-        test_log.write("Fetching {}...".format(build_ref))
-        git.fetch("--depth", "1", "origin", build_ref)
+        return str(
+            git("rev-parse", "--verify", f"{build_ref}^{{commit}}",
+                _cwd=str(cirpy_dir()))
+        ).strip()
+    except sh.ErrorReturnCode:
+        raise RuntimeError(f"Unable to resolve '{build_ref}' to a commit.") from None
+
+@functools.lru_cache(maxsize=None)
+def toolchain_version():
+    """ Returns the version banner of the ARM compiler toolchain used
+        to build firmware, for use in the firmware cache key.
+    """
+    # pylint: disable=subprocess-run-check
+    gcc_version = subprocess.run(
+        "arm-none-eabi-gcc --version",
+        shell=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        executable="/usr/bin/bash",
+        env=_RUN_ENVS,
+    )
+    version_lines = str(gcc_version.stdout, encoding="utf-8").split("\n")
+    return version_lines[0].strip()
+
+class BuildLog():
+    """ Minimal stand-in for ``TestController.log`` used by builds that
+        run outside of the controller's process. The collected output
+        and phase timings are handed back to the controller once the
+        build finishes.
+    """
+    def __init__(self):
+        self.lines = []
+        self.timings = timing.PhaseTimings()
+
+    def write(self, data, quiet=True): # pylint: disable=unused-argument
+        """ Collect ``data`` as a line of build output. """
+        if isinstance(data, bytes):
+            data = str(data, encoding="utf-8")
+        self.lines.append(data.rstrip("\n"))
+
+    def getvalue(self):
+        """ All collected build output. """
+        return "\n".join(self.lines)
+
+def board_port_dir(board, source_dir=None):
+    """ Returns the port directory that contains `board`'s definition.
+
+    :param: str board: Name of the board to find.
+    :param: source_dir: The circuitpython source tree to look in. Defaults
+                        to the local clone.
+    """
+    cirpy_ports_dir = pathlib.Path(source_dir or cirpy_dir(), "ports")
+
+    for port in _AVAILABLE_PORTS:
+        port_dir = cirpy_ports_dir / port / "boards" / board
+        if port_dir.exists():
+            port_dir = (cirpy_ports_dir / port).resolve()
+            rosiepi_logger.info("Board source found: %s", port_dir)
+            return port_dir
+
+    err_msg = [
+        f"'{board}' board not available to test. Can't build firmware.",
+        #"="*60,
+        #"Closing RosiePi"
+    ]
+    raise RuntimeError("\n".join(err_msg))
+
+def board_build_flags(board):
+    """ The flags passed to `make` when building `board`. """
+    return [f"BOARD={board}"]
+
+def fw_cache_key(commit, board, build_flags):
+    """ The firmware cache key for building `commit` for `board`. """
+    return make_cache_key(commit, board, toolchain_version(), build_flags)
+
+def check_fw_cache(board, commit, test_log, fw_cache):
+    """ Returns the cached firmware directory for `board` at `commit`,
+        or ``None`` if it has not been built yet.
+    """
+    if fw_cache is None:
+        return None
+
+    with timing.span(test_log, "fw_cache_lookup"):
+        cache_key = fw_cache_key(commit, board, board_build_flags(board))
+        cached_dir = fw_cache.lookup(cache_key)
+    if cached_dir is not None:
+        test_log.write(f"Using cached firmware for {commit}.")
+        rosiepi_logger.info("Firmware cache hit: %s", cached_dir)
+    return cached_dir
+
+def default_worktree_pool():
+    """ A ``worktrees.WorktreePool`` of the local circuitpython clone,
+        using the default pool location and limits.
+    """
+    return WorktreePool(cirpy_dir())
 
-        test_log.write("Checking out {}...".format(build_ref))
-        git.checkout(build_ref)
+def fetch_commit(build_ref, commit, test_log, worktree_pool):
+    """ Fetches `commit` into the local circuitpython clone, unless the
+        clone already has it.
 
-        test_log.write("Syncing submodules...")
-        git.submodule("sync")
+    :param: str build_ref: The tag/commit that was requested.
+    :param: str commit: The full SHA that `build_ref` resolved to.
+    :param: test_log: The TestController.log used for output.
+    :param: worktree_pool: The ``WorktreePool`` of the clone.
+    """
+    if worktree_pool.has_commit(commit):
+        return
 
-        test_log.write("Updating submodules...")
-        git.submodule("update", "--init", "--depth", "1")
+    try:
+        with timing.span(test_log, "git_fetch"):
+            if worktree_pool.mirror is not None:
+                worktree_pool.mirror.populate_clone(
+                    worktree_pool.repo_dir, build_ref, commit, test_log
+                )
+                return
+
+            test_log.write("Fetching {}...".format(build_ref))
+            git.fetch("--depth", "1", "origin", build_ref,
+                      _cwd=str(worktree_pool.repo_dir))
     except sh.ErrorReturnCode as git_err:
-        # TODO: change to 'master'
-        git.checkout("-f", "rosiepi_test")
-        os.chdir(working_dir)
         err_msg = [
             "Building firmware failed:",
             " - {}".format(str(git_err.stderr, encoding="utf-8").strip("\n")),
@@ -104,72 +219,409 @@ def build_fw(board, build_ref, test_log): # pylint: disable=too-many-locals,too-
         ]
         raise RuntimeError("\n".join(err_msg)) from None
 
-    os.chdir(board_port_dir)
-    board_cmd = (
-        f"make clean BOARD={board} BUILD={build_dir}",
-        f"make BOARD={board} BUILD={build_dir}"
-    )
+@contextlib.contextmanager
+def leased_source(build_ref, commit, test_log, worktree_pool):
+    """ Context manager that leases a worktree checked out at `commit`,
+        with its submodules initialized, and yields its path. The
+        shared clone's working tree is never touched.
 
-    test_log.write("Building firmware...")
-    try:
-        rosiepi_logger.info("Running make recipe: %s", '; '.join(board_cmd))
-        run_envs = {
-            "BASH_ENV": "/etc/profile",
-        }
-
-        rosiepi_logger.info("Running build clean...")
-        # pylint: disable=subprocess-run-check
-        subprocess.run(
-            board_cmd[0],
-            shell=True,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.STDOUT,
-            executable="/usr/bin/bash",
-            start_new_session=True,
-            env=run_envs,
-        )
-
-        build_dir.mkdir(mode=0o0774, parents=True)
-
-        # pylint: enable=subprocess-run-check
-        rosiepi_logger.info("Running firmware build...")
-        fw_build = subprocess.run(
-            board_cmd[1],
-            check=True,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            executable="/usr/bin/bash",
-            start_new_session=True,
-            env=run_envs,
-        )
+    :param: str build_ref: The tag/commit that was requested.
+    :param: str commit: The full SHA that `build_ref` resolved to.
+    :param: test_log: The TestController.log used for output.
+    :param: worktree_pool: The ``WorktreePool`` to lease from.
+    """
+    fetch_commit(build_ref, commit, test_log, worktree_pool)
 
-        result = str(fw_build.stdout, encoding="utf-8").split("\n")
-        success_msg = [line for line in result if "bytes" in line]
-        test_log.write(" - " + "\n - ".join(success_msg))
-        rosiepi_logger.info("Firmware built...")
+    try:
+        with contextlib.ExitStack() as lease_stack:
+            with timing.span(test_log, "worktree_checkout"):
+                source_dir, is_new = lease_stack.enter_context(
+                    worktree_pool.lease(commit)
+                )
+            if is_new:
+                test_log.write("Checked out {}...".format(commit))
+
+                with timing.span(test_log, "submodule_update"):
+                    if worktree_pool.mirror is not None:
+                        test_log.write("Updating submodules from mirror...")
+                        worktree_pool.mirror.update_submodules(source_dir, test_log)
+                    else:
+                        test_log.write("Syncing submodules...")
+                        git.submodule("sync", _cwd=str(source_dir))
+
+                        test_log.write("Updating submodules...")
+                        git.submodule("update", "--init", "--depth", "1",
+                                      _cwd=str(source_dir))
+            else:
+                test_log.write("Reusing worktree for {}...".format(commit))
+
+            yield source_dir
 
-    except subprocess.CalledProcessError as cmd_err:
-        # TODO: change to 'master'
-        git.checkout("-f", "rosiepi_test")
-        os.chdir(working_dir)
+    except sh.ErrorReturnCode as git_err:
         err_msg = [
             "Building firmware failed:",
-            " - {}".format(str(cmd_err.stdout, encoding="utf-8").strip("\n")),
+            " - {}".format(str(git_err.stderr, encoding="utf-8").strip("\n")),
             #"="*60,
             #"Closing RosiePi"
         ]
-        rosiepi_logger.warning("Firmware build failed...")
         raise RuntimeError("\n".join(err_msg)) from None
 
-    finally:
-        # TODO: change to 'master'
-        git.checkout("-f", "rosiepi_test")
-        os.chdir(working_dir)
+@dataclasses.dataclass
+class BuildSettings():
+    """ Dataclass to contain the options used when compiling firmware.
+
+    :param: ccache: Compile through ``ccache`` when it is installed. Each
+                    build starts from a fresh worktree, so ccache is what
+                    carries compiled objects from one build to the next.
+    :param: job_budget: The node-wide ``job_budget.JobBudget`` that
+                        ``make -j`` jobs are drawn from.
+    :param: jobs: The jobs to ask the budget for per build. Defaults to
+                  the whole budget.
+    """
+    ccache: bool = True
+    job_budget: JobBudget = None
+    jobs: int = None
+
+@functools.lru_cache(maxsize=None)
+def ccache_available():
+    """ Whether ``ccache`` is installed on the node. """
+    # pylint: disable=subprocess-run-check
+    which_ccache = subprocess.run(
+        "command -v ccache",
+        shell=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        executable="/usr/bin/bash",
+        env=_RUN_ENVS,
+    )
+    return which_ccache.returncode == 0
+
+def _ccache_stats(stats_log):
+    """ Counts the cache hits and misses recorded in a ccache stats log. """
+    hits = misses = 0
+    if stats_log.exists():
+        for line in stats_log.read_text().splitlines():
+            if line.endswith("cache_hit"):
+                hits += 1
+            elif line == "cache_miss":
+                misses += 1
+        stats_log.unlink()
+    return hits, misses
+
+def make_mpy_cross(source_dir, test_log, build_settings=None):
+    """ Builds ``mpy-cross`` in `source_dir`. Every port's build uses
+        the one ``mpy-cross`` at the top of the tree, outside of its
+        ``BUILD`` directory, so it is built once before several boards
+        are built in the same worktree.
+
+    :param: source_dir: The worktree holding the checked out source.
+    :param: test_log: The TestController.log used for output.
+    :param: build_settings: The ``BuildSettings`` to compile with.
+                            Defaults to ``BuildSettings()``.
+    """
+    if build_settings is None:
+        build_settings = BuildSettings()
+    job_budget = build_settings.job_budget or JobBudget()
+
+    with job_budget.acquire() as jobs:
+        rosiepi_logger.info("Building mpy-cross...")
+        try:
+            with timing.span(test_log, "make_mpy_cross"):
+                subprocess.run(
+                    f"make -j{jobs} -C mpy-cross",
+                    check=True,
+                    shell=True,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    executable="/usr/bin/bash",
+                    start_new_session=True,
+                    env=_RUN_ENVS,
+                    cwd=source_dir,
+                )
+        except subprocess.CalledProcessError as cmd_err:
+            err_msg = [
+                "Building mpy-cross failed:",
+                " - {}".format(str(cmd_err.stdout, encoding="utf-8").strip("\n")),
+            ]
+            rosiepi_logger.warning("mpy-cross build failed...")
+            raise RuntimeError("\n".join(err_msg)) from None
+
+def make_fw(board, commit, source_dir, test_log, fw_cache=None, # pylint: disable=too-many-arguments,too-many-locals
+            build_settings=None):
+    """ Runs `make` for `board` in `source_dir`, which must already be
+        checked out at `commit`. Does not change the working directory,
+        so may be run for several boards at once.
+
+    :param: str board: Name of the board to build firmware for.
+    :param: str commit: The full SHA of the checked out source.
+    :param: source_dir: The worktree holding the checked out source.
+    :param: test_log: The TestController.log used for output.
+    :param: fw_cache: An optional ``fw_cache.FirmwareCache`` to store
+                      the finished build in.
+    :param: build_settings: The ``BuildSettings`` to compile with.
+                            Defaults to ``BuildSettings()``.
+    """
+    if build_settings is None:
+        build_settings = BuildSettings()
+    job_budget = build_settings.job_budget or JobBudget()
+
+    port_dir = board_port_dir(board, source_dir)
+    build_flags = board_build_flags(board)
+    fw_dir = pathlib.Path.home() / ".fw_builds" / commit / board
+
+    run_envs = dict(_RUN_ENVS)
+    make_vars = []
+    stats_log = None
+    if build_settings.ccache and ccache_available():
+        stats_log = fw_dir.parent / f".{board}.ccache_stats"
+        run_envs.update({
+            "CCACHE_DIR": str(pathlib.Path.home() / ".fw_builds" / "ccache"),
+            # worktree paths differ per commit; hash relative to them so
+            # that identical sources hit across commits.
+            "CCACHE_BASEDIR": str(source_dir),
+            "CCACHE_NOHASHDIR": "1",
+            "CCACHE_STATSLOG": str(stats_log),
+        })
+        make_vars.append("CC='ccache arm-none-eabi-gcc'")
+
+    with job_budget.acquire(build_settings.jobs) as jobs:
+        make_flags = " ".join(build_flags + make_vars)
+        # BUILD is per commit and board, and is removed once the firmware
+        # is cached, so there is nothing stale to clean out of it; objects
+        # left by an uncached or failed build of the same board are reused.
+        board_cmd = f"make -j{jobs} {make_flags} BUILD={fw_dir}"
+
+        test_log.write("Building firmware...")
+        build_start = time.monotonic()
+        try:
+            rosiepi_logger.info("Running make recipe: %s", board_cmd)
+
+            fw_dir.mkdir(mode=0o0774, parents=True, exist_ok=True)
+
+            rosiepi_logger.info("Running firmware build...")
+            with timing.span(test_log, "make", board):
+                fw_build = subprocess.run(
+                    board_cmd,
+                    check=True,
+                    shell=True,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    executable="/usr/bin/bash",
+                    start_new_session=True,
+                    env=run_envs,
+                    cwd=port_dir,
+                )
+
+            result = str(fw_build.stdout, encoding="utf-8").split("\n")
+            success_msg = [line for line in result if "bytes" in line]
+            test_log.write(" - " + "\n - ".join(success_msg))
+            rosiepi_logger.info("Firmware built...")
+
+        except subprocess.CalledProcessError as cmd_err:
+            err_msg = [
+                "Building firmware failed:",
+                " - {}".format(str(cmd_err.stdout, encoding="utf-8").strip("\n")),
+                #"="*60,
+                #"Closing RosiePi"
+            ]
+            rosiepi_logger.warning("Firmware build failed...")
+            raise RuntimeError("\n".join(err_msg)) from None
+
+        finally:
+            build_time = time.monotonic() - build_start
+            build_stats = [f" - Build time: {build_time:.1f}s ({jobs} jobs)"]
+            if stats_log is not None:
+                hits, misses = _ccache_stats(stats_log)
+                if hits + misses:
+                    build_stats.append(
+                        f" - ccache: {hits} hits, {misses} misses "
+                        f"({100 * hits / (hits + misses):.1f}% hit rate)"
+                    )
+            test_log.write("\n".join(build_stats))
+            rosiepi_logger.info("%s: %s", board, "; ".join(build_stats))
+
+    if fw_cache is not None:
+        with timing.span(test_log, "fw_cache_store"):
+            cached_dir = fw_cache.store(
+                fw_cache_key(commit, board, build_flags),
+                fw_dir / "firmware.uf2",
+                board=board,
+                commit=commit,
+            )
+        shutil.rmtree(fw_dir, ignore_errors=True)
+        return cached_dir
+
+    return fw_dir
+
+def build_fw(board, build_ref, test_log, fw_cache=None, worktree_pool=None, # pylint: disable=too-many-arguments
+             build_settings=None):
+    """ Builds the firware at `build_ref` for `board`. Firmware will be
+        output to `.fw_builds/<commit>/<board>/`, or served from and
+        stored into `fw_cache` when one is supplied.
+
+    :param: str board: Name of the board to build firmware for.
+    :param: str build_ref: The tag/commit to build firmware for.
+    :param: test_log: The TestController.log used for output.
+    :param: fw_cache: An optional ``fw_cache.FirmwareCache`` to check
+                      for an existing build before building.
+    :param: worktree_pool: The ``worktrees.WorktreePool`` to build in.
+                           Defaults to ``default_worktree_pool()``.
+    :param: build_settings: The ``BuildSettings`` to compile with.
+    """
+    with timing.span(test_log, "resolve_commit"):
+        commit = resolve_commit(build_ref)
+
+    cached_dir = check_fw_cache(board, commit, test_log, fw_cache)
+    if cached_dir is not None:
+        return cached_dir
 
-    return build_dir
+    if worktree_pool is None:
+        worktree_pool = default_worktree_pool()
 
-def update_fw(board, board_name, fw_path, test_log):
+    with leased_source(build_ref, commit, test_log, worktree_pool) as source_dir:
+        return make_fw(board, commit, source_dir, test_log, fw_cache,
+                       build_settings)
+
+def _make_fw_worker(board, commit, source_dir, fw_cache, build_settings, # pylint: disable=too-many-arguments
+                    source_log=None):
+    """ Process pool entry point for `make_fw`. Returns the build
+        directory along with the ``BuildLog`` of the build, which starts
+        with the output and timings of ``source_log``.
+    """
+    build_log = BuildLog()
+    if source_log is not None:
+        if source_log.lines:
+            build_log.write(source_log.getvalue())
+        build_log.timings.extend(source_log.timings)
+    build_dir = make_fw(board, commit, source_dir, build_log, fw_cache,
+                        build_settings)
+    return build_dir, build_log
+
+class ParallelBuild(): # pylint: disable=too-many-instance-attributes
+    """ Context manager that builds firmware for several boards at once
+        in a process pool. A worktree at the commit is leased once and
+        ``mpy-cross`` is built in it, then `make` is run in it for every
+        board concurrently. The lease is released when the context
+        exits. Unless ``build_settings`` asks for a set number of jobs,
+        the node's job budget is split evenly between the builds
+        running at once.
+
+        ``futures`` maps each board name to a ``concurrent.futures.Future``
+        that resolves to a ``(build_dir, build_log)`` tuple, where
+        ``build_log`` is the ``BuildLog`` holding the build's output and
+        phase timings, so that callers can start using each board's
+        firmware as soon as it is ready.
+
+    :param: boards: The names of the boards to build firmware for.
+    :param: str build_ref: The tag/commit to build firmware for.
+    :param: fw_cache: An optional ``fw_cache.FirmwareCache``.
+    :param: int max_workers: The most builds to run at the same time.
+                             Defaults to the number of CPUs.
+    :param: worktree_pool: The ``worktrees.WorktreePool`` to build in.
+                           Defaults to ``default_worktree_pool()``.
+    :param: build_settings: The ``BuildSettings`` to compile with.
+    """
+    def __init__(self, boards, build_ref, fw_cache=None, max_workers=None, # pylint: disable=too-many-arguments
+                 worktree_pool=None, build_settings=None):
+        self.boards = list(boards)
+        self.build_ref = build_ref
+        self.fw_cache = fw_cache
+        self.max_workers = max_workers
+        self.worktree_pool = worktree_pool
+        self.build_settings = build_settings or BuildSettings()
+        self.futures = {}
+        self._pool = None
+        self._source_lease = contextlib.ExitStack()
+
+    def __enter__(self):
+        if not self.boards:
+            return self
+
+        source_log = BuildLog()
+        try:
+            with timing.span(source_log, "resolve_commit"):
+                commit = resolve_commit(self.build_ref)
+        except RuntimeError as ref_err:
+            self._fail_builds(self.boards, ref_err)
+            return self
+
+        pending = []
+        for board in self.boards:
+            build_log = BuildLog()
+            build_log.timings.extend(source_log.timings)
+            cached_dir = check_fw_cache(board, commit, build_log, self.fw_cache)
+            if cached_dir is not None:
+                future = concurrent.futures.Future()
+                future.set_result((cached_dir, build_log))
+                self.futures[board] = future
+            else:
+                pending.append(board)
+
+        if not pending:
+            return self
+
+        if self.worktree_pool is None:
+            self.worktree_pool = default_worktree_pool()
+
+        try:
+            source_dir = self._source_lease.enter_context(
+                leased_source(self.build_ref, commit, source_log,
+                              self.worktree_pool)
+            )
+        except RuntimeError as git_err:
+            self._fail_builds(pending, git_err)
+            return self
+
+        build_settings = self.build_settings
+        if build_settings.job_budget is None:
+            build_settings = dataclasses.replace(build_settings,
+                                                 job_budget=JobBudget())
+
+        if len(pending) > 1:
+            try:
+                make_mpy_cross(source_dir, source_log, build_settings)
+            except RuntimeError as build_err:
+                self._fail_builds(pending, build_err)
+                return self
+
+        if build_settings.jobs is None:
+            running = min(len(pending), self.max_workers or os.cpu_count() or 1)
+            build_settings = dataclasses.replace(
+                build_settings,
+                jobs=max(1, build_settings.job_budget.total // running)
+            )
+
+        # the caller may have threads of its own running; don't fork them
+        self._pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context("forkserver")
+        )
+        for board in pending:
+            self.futures[board] = self._pool.submit(
+                _make_fw_worker,
+                board,
+                commit,
+                source_dir,
+                self.fw_cache,
+                build_settings,
+                source_log
+            )
+
+        return self
+
+    def _fail_builds(self, boards, build_err):
+        for board in boards:
+            future = concurrent.futures.Future()
+            future.set_exception(build_err)
+            self.futures[board] = future
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+        self._source_lease.close()
+
+def update_fw(board, board_name, fw_path, test_log, device_watcher=None, # pylint: disable=too-many-arguments
+              board_index=None, repl_reset=True):
     """ Resets `board` into bootloader mode, and copies over
         new firmware located at `fw_path`.
 
@@ -177,16 +629,57 @@ def update_fw(board, board_name, fw_path, test_log):
     :param: board_name: The name of the board
     :param: fw_path: File path to the firmware UF2 to copy.
     :param: test_log: The TestController.log used for output.
+    :param: device_watcher: The ``device_watch.DeviceWatcher`` used to wait
+                            for the board's USB transitions. Defaults to
+                            ``DeviceWatcher()``.
+    :param: board_index: An optional ``board_index.BoardIndex`` used to
+                         find the bootloader, and to record its identity.
+    :param: repl_reset: Whether to reset into the bootloader through the
+                        REPL. ``False`` uses the 1200 baud touch instead,
+                        which also works when the REPL is not answering.
     """
+    if device_watcher is None:
+        device_watcher = DeviceWatcher()
+
+    bootloader = {}
+    if board_index is not None:
+        bootloader = (board_index.get(board_name) or {}).get("bootloader") or {}
+    boot_ids = [bootloader.get("usb_serial"), bootloader.get("drive")]
+
     success_msg = ["Firmware upload successful!"]
     try:
-        with board:
-            if not board.bootloader:
-                test_log.write("Resetting into bootloader mode...")
-                board.reset_to_bootloader(repl=True)
-                time.sleep(10)
-
-        boot_board = pyboard.CPboard.from_build_name_bootloader(board_name)
+        serial_number = board.serial_number
+        boot_drive = None
+        # until this board's bootloader is known, the drive that appears
+        # and the bootloader that is found could be another board's, so
+        # nothing else may be in its bootloader meanwhile.
+        with device_watcher.bootloader_phase(bool(bootloader.get("usb_serial"))):
+            with timing.span(test_log, "bootloader_reset"):
+                with board:
+                    in_bootloader = board.bootloader
+                    if not in_bootloader:
+                        test_log.write("Resetting into bootloader mode...")
+                        # a quick bootloader can be up before it is looked for
+                        disks_before = device_watcher.usb_disks()
+                        board.reset_to_bootloader(repl=repl_reset)
+
+                if not in_bootloader:
+                    boot_drive, elapsed = device_watcher.wait_for_bootloader(
+                        serial_number, boot_ids=boot_ids, before=disks_before
+                    )
+                    test_log.write(f" - Bootloader ready after {elapsed:.2f}s")
+                    if board_index is not None:
+                        board_index.record_bootloader(
+                            board_name, drive=boot_drive
+                        )
+
+            with timing.span(test_log, "bootloader_connect"):
+                if board_index is not None:
+                    boot_board = board_index.connect_bootloader(board_name)
+                else:
+                    boot_board = pyboard.CPboard.from_build_name_bootloader(
+                        board_name
+                    )
         with boot_board:
             test_log.write(
                 "In bootloader mode. Current bootloader: "
@@ -194,14 +687,24 @@ def update_fw(board, board_name, fw_path, test_log):
             )
             test_log.write("Uploading firmware...")
 
-            boot_board.firmware.upload(fw_path)
-
-            test_log.write("Waiting for board to reload...")
-            time.sleep(10)
+            upload_start = time.monotonic()
+            with timing.span(test_log, "uf2_copy"):
+                boot_board.firmware.upload(fw_path)
+            test_log.write(
+                f" - UF2 copied in {time.monotonic() - upload_start:.2f}s"
+            )
 
-        with board:
-            pass
-            #success_msg.append(" - New firmware: {}".format(board.firmware.info))
+        test_log.write("Waiting for board to reload...")
+        if boot_drive is not None:
+            with timing.span(test_log, "uf2_flush"):
+                elapsed = device_watcher.wait_for_flush(boot_drive)
+            test_log.write(f" - UF2 flushed after {elapsed:.2f}s")
+        with timing.span(test_log, "reboot"):
+            elapsed = device_watcher.wait_for_serial(serial_number)
+            with board:
+                pass
+                #success_msg.append(" - New firmware: {}".format(board.firmware.info))
+        test_log.write(f" - Serial port back after {elapsed:.2f}s")
         test_log.write("\n".join(success_msg))
 
     except BaseException as brd_err:
@@ -0,0 +1,228 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+
+""" Deadlines for the lines, tests and boards run by ``TestController``,
+    so that code which never returns fails its test instead of hanging
+    the board's whole run.
+"""
+
+import contextlib
+import dataclasses
+import time
+
+from tests import pyboard
+
+
+@dataclasses.dataclass
+class Deadlines():
+    """ Dataclass to contain the time limits of a test run. ``None``
+        leaves that scope unlimited.
+
+    :param: float line: Seconds each top-level statement may run. A
+                        ``#$ timeout=`` marker overrides it for the
+                        statement it precedes. Setting it runs blocks of
+                        code a statement at a time.
+    :param: float test: Seconds each test file may run. A
+                        ``#$ test-timeout=`` marker overrides it.
+    :param: float board: Seconds all of a board's tests may run. Tests
+                         not started by then are skipped.
+    :param: float recovery: Seconds each recovery tier waits for the
+                            board to answer.
+    """
+    line: float = None
+    test: float = None
+    board: float = None
+    recovery: float = 10
+
+
+class DeadlineExceeded(pyboard.CPboardError):
+    """ Raised when the board is still busy at a deadline.
+
+    :param: str scope: The deadline that passed: ``"line"``, ``"test"``
+                       or ``"board"``.
+    :param: float seconds: The time limit of that deadline.
+    """
+
+    def __init__(self, scope, seconds):
+        super().__init__(f"{scope} deadline of {seconds:g}s exceeded")
+        self.scope = scope
+        self.seconds = seconds
+
+
+class DeadlineClock():
+    """ Keeps the deadlines that are running, and raises
+        ``DeadlineExceeded`` once the nearest of them has passed.
+    """
+
+    def __init__(self):
+        self._deadlines = {}
+        self.expired = None
+
+    def start(self, scope, seconds):
+        """ Starts a deadline ``seconds`` from now. ``None`` leaves the
+            scope unlimited.
+        """
+        if seconds is None:
+            self._deadlines.pop(scope, None)
+        else:
+            self._deadlines[scope] = (time.monotonic() + seconds, seconds)
+
+    def stop(self, scope):
+        """ Stops the deadline of ``scope``. """
+        self._deadlines.pop(scope, None)
+
+    @contextlib.contextmanager
+    def limit(self, scope, seconds):
+        """ Runs the ``with`` block under a deadline of ``seconds``. """
+        self.start(scope, seconds)
+        try:
+            yield self
+        finally:
+            self.stop(scope)
+
+    def nearest(self):
+        """ The ``(scope, expires_at, seconds)`` of the nearest deadline,
+            or ``None`` when none are running.
+        """
+        if not self._deadlines:
+            return None
+        scope, (expires_at, seconds) = min(
+            self._deadlines.items(), key=lambda item: item[1][0]
+        )
+        return scope, expires_at, seconds
+
+    def remaining(self):
+        """ Seconds until the nearest deadline, or ``None``. """
+        nearest = self.nearest()
+        if nearest is None:
+            return None
+        return nearest[1] - time.monotonic()
+
+    def passed(self, scope):
+        """ Whether the deadline of ``scope`` has passed. """
+        deadline = self._deadlines.get(scope)
+        return deadline is not None and deadline[0] <= time.monotonic()
+
+    def check(self):
+        """ Raises ``DeadlineExceeded`` if the nearest deadline has passed.
+        """
+        nearest = self.nearest()
+        if nearest is not None and nearest[1] <= time.monotonic():
+            raise self.expire()
+
+    def expire(self):
+        """ Records the nearest deadline as the one that passed, and
+            returns its ``DeadlineExceeded`` to raise.
+        """
+        scope, _, seconds = self.nearest()
+        self.expired = DeadlineExceeded(scope, seconds)
+        return self.expired
+
+
+class DeadlineSerial():
+    """ Wraps a board's serial port so that polling or reading it fails
+        once the clock's nearest deadline has passed, even while the
+        board keeps sending. Everything else is passed through to the
+        port, as pyserial's ``Serial`` would.
+
+    :param: serial: The serial port to wrap.
+    :param: clock: The ``DeadlineClock`` to keep.
+    """
+
+    def __init__(self, serial, clock):
+        self.serial = serial
+        self.clock = clock
+
+    def read(self, size=1):
+        """ Reads from the port, unless a deadline has passed. """
+        self.clock.check()
+        return self.serial.read(size)
+
+    def read_until(self, *args, **kwargs):
+        """ Reads from the port, unless a deadline has passed. """
+        self.clock.check()
+        return self.serial.read_until(*args, **kwargs)
+
+    def inWaiting(self): # pylint: disable=invalid-name
+        """ The bytes waiting to be read, unless a deadline has passed. """
+        self.clock.check()
+        return self.serial.inWaiting()
+
+    @property
+    def in_waiting(self):
+        """ The bytes waiting to be read, unless a deadline has passed. """
+        self.clock.check()
+        return self.serial.in_waiting
+
+    def __getattr__(self, name):
+        return getattr(self.serial, name)
+
+
+def _deadline_read_until(read_until, clock):
+    """ Wraps a REPL's ``read_until`` so that it waits for the board no
+        longer than the clock's nearest deadline.
+    """
+    def deadline_read_until(ending, timeout=10):
+        clock.check()
+        remaining = clock.remaining()
+        if remaining is None or (timeout is not None and remaining >= timeout):
+            return read_until(ending, timeout=timeout)
+        try:
+            return read_until(ending, timeout=max(remaining, 0))
+        except DeadlineExceeded:
+            raise
+        except (pyboard.CPboardError, TimeoutError) as read_err:
+            # the wait was cut short by the deadline, not the board
+            raise clock.expire() from read_err
+    return deadline_read_until
+
+
+@contextlib.contextmanager
+def guarded(cpboard, clock):
+    """ Keeps the deadlines of ``clock`` on ``cpboard``'s serial traffic
+        for the duration of the ``with`` block. The board's own port is
+        wrapped, since its REPL reads ``serial`` from the board, and the
+        REPL's ``read_until`` has its timeouts capped, so ``cpboard``
+        must be open.
+
+    :param: cpboard: The connected ``pyboard.CPboard``.
+    :param: clock: The ``DeadlineClock`` to keep.
+    """
+    repl = cpboard.repl
+    serial = cpboard.serial
+    deadline_serial = DeadlineSerial(serial, clock)
+    cpboard.serial = deadline_serial
+    read_until = vars(repl).get("read_until")
+    repl.read_until = _deadline_read_until(repl.read_until, clock)
+    try:
+        yield clock
+    finally:
+        if read_until is None:
+            del repl.read_until
+        else:
+            repl.read_until = read_until
+        # leave the port alone if the board was closed in the meantime
+        if cpboard.serial is deadline_serial:
+            cpboard.serial = serial
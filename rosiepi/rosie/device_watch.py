@@ -0,0 +1,230 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import contextlib
+import logging
+import pathlib
+import threading
+import time
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+
+class _BootloaderGate():
+    """ Shared/exclusive gate around the bootloader phase of a firmware
+        update. Boards whose bootloader can be told apart from the others
+        go through it together; a board whose bootloader isn't known yet
+        has it to itself, so the only new drive it can see is its own.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._shared = 0
+        self._exclusive = False
+
+    @contextlib.contextmanager
+    def shared(self):
+        """ Holds the gate alongside other identified boards. """
+        with self._cond:
+            self._cond.wait_for(lambda: not self._exclusive)
+            self._shared += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._shared -= 1
+                self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        """ Holds the gate alone. """
+        with self._cond:
+            self._cond.wait_for(
+                lambda: not self._exclusive and not self._shared
+            )
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._exclusive = False
+                self._cond.notify_all()
+
+
+# one per process: every board on the node shares the USB bus
+_BOOTLOADER_GATE = _BootloaderGate()
+
+
+class DeviceWatcher():
+    """ Watches the device tree for the USB transitions a board goes
+        through while its firmware is updated, so that callers wait
+        only as long as the board actually takes instead of a fixed
+        sleep. Devices are found through the udev-maintained
+        ``disk/by-id`` and ``serial/by-id`` links under ``dev_root``.
+
+    :param: dev_root: Root of the device tree. Point this at a directory
+                      of plain files to simulate devices.
+    :param: float poll_interval: Seconds between device tree checks.
+    :param: float bootloader_timeout: Most seconds to wait for the board
+                                      to enter the bootloader.
+    :param: float flush_timeout: Most seconds to wait for the bootloader
+                                 to take the UF2 and reset.
+    :param: float reboot_timeout: Most seconds to wait for the serial
+                                  port to come back after a reset.
+    """
+
+    def __init__(self, dev_root="/dev", poll_interval=0.1, # pylint: disable=too-many-arguments
+                 bootloader_timeout=30, flush_timeout=60, reboot_timeout=30):
+        self.dev_root = pathlib.Path(dev_root)
+        self.poll_interval = poll_interval
+        self.bootloader_timeout = bootloader_timeout
+        self.flush_timeout = flush_timeout
+        self.reboot_timeout = reboot_timeout
+
+    def _entries(self, kind):
+        by_id = self.dev_root / kind / "by-id"
+        if not by_id.exists():
+            return set()
+        return {entry.name for entry in by_id.iterdir()}
+
+    def usb_disks(self):
+        """ The names of the USB disks currently attached, ignoring
+            partition links.
+        """
+        return {
+            name for name in self._entries("disk")
+            if name.startswith("usb-") and "-part" not in name
+        }
+
+    def serial_ports(self, serial_number):
+        """ The serial port links that belong to ``serial_number``. """
+        return {
+            name for name in self._entries("serial") if serial_number in name
+        }
+
+    def wait_for(self, condition, timeout, description):
+        """ Polls ``condition`` until it returns a truthy value, and
+            returns ``(value, elapsed_seconds)``.
+
+        :param: condition: Callable to poll.
+        :param: float timeout: Seconds to wait before giving up.
+        :param: str description: What is being waited for, used in the
+                                 log and in the ``TimeoutError``.
+        """
+        start = time.monotonic()
+        while True:
+            value = condition()
+            elapsed = time.monotonic() - start
+            if value:
+                rosiepi_logger.info("%s after %.2fs", description, elapsed)
+                return value, elapsed
+            if elapsed >= timeout:
+                raise TimeoutError(
+                    f"Timed out after {timeout}s waiting for: {description}"
+                )
+            time.sleep(self.poll_interval)
+
+    @staticmethod
+    def bootloader_phase(identified):
+        """ Context manager to hold from resetting a board into its
+            bootloader until its bootloader is connected. Boards whose
+            bootloader is ``identified`` share it; others wait to have it
+            to themselves.
+
+        :param: bool identified: Whether the board's bootloader can be
+                                 told apart from other bootloaders.
+        """
+        if identified:
+            return _BOOTLOADER_GATE.shared()
+        return _BOOTLOADER_GATE.exclusive()
+
+    def wait_for_bootloader(self, serial_number, timeout=None, boot_ids=None, # pylint: disable=too-many-arguments
+                            before=None):
+        """ Waits for a board that was told to reset into its bootloader
+            to drop its serial port and for the bootloader drive to
+            appear. Returns ``(drive_name, elapsed_seconds)``.
+
+        :param: str serial_number: The board's serial number.
+        :param: float timeout: Seconds to wait. Defaults to
+                               ``bootloader_timeout``.
+        :param: boot_ids: Strings that identify the board's bootloader
+                          drive in its ``by-id`` name, e.g. the
+                          bootloader's USB serial number or the drive's
+                          ``by-id`` name from an earlier update. When
+                          given, only a matching drive is taken; without
+                          them, any new drive is, so the caller should
+                          hold ``bootloader_phase(False)``.
+        :param: before: The ``usb_disks()`` from before the board was
+                        reset. Drives in it aren't new, unless their name
+                        is one of ``boot_ids``. Defaults to the drives
+                        attached when this is called, which can already
+                        include a quick bootloader's.
+        """
+        timeout = self.bootloader_timeout if timeout is None else timeout
+        boot_ids = [boot_id for boot_id in boot_ids or () if boot_id]
+        if before is None:
+            before = self.usb_disks()
+
+        def is_ours(name):
+            if name in before:
+                # the board's own drive may carry the same serial number,
+                # so only the exact bootloader drive counts
+                return name in boot_ids
+            return not boot_ids or any(boot_id in name for boot_id in boot_ids)
+
+        start = time.monotonic()
+        self.wait_for(
+            lambda: not self.serial_ports(serial_number),
+            timeout,
+            "serial port to close"
+        )
+        remaining = max(timeout - (time.monotonic() - start), 0)
+        new_disks, _ = self.wait_for(
+            lambda: set(filter(is_ours, self.usb_disks())),
+            remaining,
+            "bootloader drive to appear"
+        )
+        return sorted(new_disks)[0], time.monotonic() - start
+
+    def wait_for_flush(self, drive_name, timeout=None):
+        """ Waits for the bootloader drive to leave once the UF2 has been
+            written, which happens when the bootloader has flashed it and
+            reset. Returns the elapsed seconds.
+        """
+        _, elapsed = self.wait_for(
+            lambda: drive_name not in self.usb_disks(),
+            self.flush_timeout if timeout is None else timeout,
+            "UF2 copy to flush"
+        )
+        return elapsed
+
+    def wait_for_serial(self, serial_number, timeout=None):
+        """ Waits for the board's serial port to come back. Returns the
+            elapsed seconds.
+        """
+        _, elapsed = self.wait_for(
+            lambda: self.serial_ports(serial_number),
+            self.reboot_timeout if timeout is None else timeout,
+            "serial port to return"
+        )
+        return elapsed
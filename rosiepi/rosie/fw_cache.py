@@ -0,0 +1,237 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+import time
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+DEFAULT_CACHE_DIR = pathlib.Path.home() / ".fw_builds" / "cache"
+DEFAULT_MAX_SIZE = 2048 * 1024 * 1024
+
+_FW_FILENAME = "firmware.uf2"
+
+
+def make_cache_key(commit, board, toolchain, build_flags):
+    """ Builds the cache key for a firmware artifact.
+
+    :param: str commit: The full SHA of the commit being built.
+    :param: str board: Name of the board the firmware is built for.
+    :param: str toolchain: Version string of the compiler toolchain.
+    :param: build_flags: Iterable of the flags passed to ``make``.
+    """
+    key_parts = [commit, board, toolchain, " ".join(sorted(build_flags))]
+    return hashlib.sha256("\0".join(key_parts).encode("utf-8")).hexdigest()
+
+
+def file_digest(file_path):
+    """ Returns the SHA256 hex digest of the file at ``file_path``. """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FirmwareCache():
+    """ Content-addressed store of built firmware. Artifacts are
+        indexed by a key covering the commit, board, toolchain and
+        build flags, verified against a stored SHA256 on every hit,
+        and evicted least-recently-used once ``max_size`` is exceeded.
+        Artifacts held with ``pinned`` are not evicted.
+
+    :param: cache_dir: Directory to hold the index and artifacts.
+    :param: int max_size: Disk budget for stored artifacts, in bytes.
+    """
+
+    def __init__(self, cache_dir=None, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = pathlib.Path(cache_dir or DEFAULT_CACHE_DIR)
+        self.max_size = max_size
+        self.index_file = self.cache_dir / "index.json"
+        self._lock_file = self.cache_dir / ".lock"
+        self._pin_dir = self.cache_dir / "pins"
+        self._pin_dir.mkdir(parents=True, exist_ok=True)
+
+    @contextlib.contextmanager
+    def _locked_index(self):
+        """ Holds an exclusive lock on the index while it is read and
+            updated, so that concurrent builds can share the cache.
+        """
+        with open(self._lock_file, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                index = self._read_index()
+                yield index
+                self._write_index(index)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        if not self.index_file.exists():
+            return {}
+        try:
+            with open(self.index_file, "r") as file:
+                return json.load(file)
+        except ValueError:
+            rosiepi_logger.warning("Firmware cache index corrupt; resetting.")
+            return {}
+
+    def _write_index(self, index):
+        tmp_file = self.index_file.with_suffix(".tmp")
+        with open(tmp_file, "w") as file:
+            json.dump(index, file, indent=1)
+        os.replace(tmp_file, self.index_file)
+
+    def entry_dir(self, key):
+        """ The directory an artifact with ``key`` is stored in. """
+        return self.cache_dir / key[:2] / key
+
+    def _pin_file(self, key):
+        return self._pin_dir / f"{key}.lock"
+
+    def _remove(self, index, key):
+        """ Removes the artifact for ``key``, unless it is pinned. Returns
+            whether it was removed.
+        """
+        with open(self._pin_file(key), "w") as pin:
+            try:
+                fcntl.flock(pin, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            try:
+                index.pop(key, None)
+                shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            finally:
+                fcntl.flock(pin, fcntl.LOCK_UN)
+        return True
+
+    @contextlib.contextmanager
+    def pinned(self, entry_dir):
+        """ Context manager that keeps the artifact in ``entry_dir`` from
+            being evicted, by this or any other process, while it is used.
+            Yields the path of its ``firmware.uf2``, or ``None`` if it was
+            evicted before it could be pinned.
+
+        :param: entry_dir: A directory returned by ``lookup`` or ``store``.
+        """
+        entry_dir = pathlib.Path(entry_dir)
+        with open(self._pin_file(entry_dir.name), "w") as pin:
+            fcntl.flock(pin, fcntl.LOCK_SH)
+            try:
+                fw_file = entry_dir / _FW_FILENAME
+                yield fw_file if fw_file.exists() else None
+            finally:
+                fcntl.flock(pin, fcntl.LOCK_UN)
+
+    def lookup(self, key):
+        """ Returns the directory holding the cached ``firmware.uf2`` for
+            ``key``, or ``None`` if there is no valid cached artifact.
+        """
+        with self._locked_index() as index:
+            entry = index.get(key)
+            if entry is None:
+                return None
+
+            fw_file = self.entry_dir(key) / _FW_FILENAME
+            if not fw_file.exists() or file_digest(fw_file) != entry["sha256"]:
+                rosiepi_logger.warning(
+                    "Cached firmware failed integrity check; discarding: %s",
+                    key
+                )
+                self._remove(index, key)
+                return None
+
+            entry["last_used"] = time.time()
+
+        return self.entry_dir(key)
+
+    def store(self, key, fw_file, **metadata):
+        """ Copies ``fw_file`` into the cache under ``key``, and returns
+            the directory it was stored in. Any extra keyword arguments
+            are kept in the index alongside the artifact. Raises a
+            ``RuntimeError`` if the copy does not match ``fw_file``.
+        """
+        # hash the build output, so that a bad copy can't be recorded
+        # as the artifact's reference digest.
+        sha256 = file_digest(fw_file)
+        dest_dir = self.entry_dir(key)
+        dest_dir.mkdir(parents=True, exist_ok=True)
+        # several nodes may store the same key at once; each copies to
+        # its own file and the last rename wins.
+        with tempfile.NamedTemporaryFile(dir=dest_dir,
+                                         prefix=_FW_FILENAME + ".",
+                                         suffix=".tmp",
+                                         delete=False) as tmp:
+            tmp_file = pathlib.Path(tmp.name)
+        try:
+            shutil.copyfile(fw_file, tmp_file)
+            if file_digest(tmp_file) != sha256:
+                raise RuntimeError(
+                    f"Copy of {fw_file} into the firmware cache is corrupt."
+                )
+            fw_path = dest_dir / _FW_FILENAME
+            os.replace(tmp_file, fw_path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                tmp_file.unlink()
+            raise
+
+        entry = dict(metadata)
+        entry.update({
+            "sha256": sha256,
+            "size": fw_path.stat().st_size,
+            "created": time.time(),
+            "last_used": time.time(),
+        })
+
+        with self._locked_index() as index:
+            index[key] = entry
+            self._evict(index, keep=key)
+
+        return dest_dir
+
+    def _evict(self, index, keep=None):
+        """ Removes least-recently-used artifacts until the cache fits
+            within ``max_size``. The ``keep`` entry, and pinned entries,
+            are never evicted.
+        """
+        total = sum(entry["size"] for entry in index.values())
+        by_age = sorted(index.items(), key=lambda item: item[1]["last_used"])
+        for key, entry in by_age:
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            if not self._remove(index, key):
+                rosiepi_logger.info("Not evicting firmware in use: %s", key)
+                continue
+            rosiepi_logger.info("Evicted cached firmware: %s", key)
+            total -= entry["size"]
@@ -0,0 +1,137 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import pathlib
+import re
+import time
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+DEFAULT_RECORD_FILE = pathlib.Path.home() / ".fw_builds" / "flashed.json"
+
+# e.g. "Adafruit CircuitPython 5.0.0-beta.2-12-gabc1234 on 2020-01-01; ..."
+_VERSION_COMMIT = re.compile(r"-g([0-9a-f]{7,40})\b")
+
+
+def read_boot_out(disk_path):
+    """ Returns the first line of ``boot_out.txt`` on the board's drive,
+        which holds the running CircuitPython version, or ``None`` if
+        it can't be read.
+
+    :param: disk_path: Mount path of the board's CIRCUITPY drive.
+    """
+    try:
+        with open(os.path.join(disk_path, "boot_out.txt"), "r") as boot_out:
+            return boot_out.readline().strip()
+    except (OSError, TypeError):
+        return None
+
+
+def version_commit(version_line):
+    """ Returns the abbreviated commit SHA in a CircuitPython version
+        banner, or ``None`` if the banner doesn't carry one.
+    """
+    if not version_line:
+        return None
+    match = _VERSION_COMMIT.search(version_line)
+    return match.group(1) if match else None
+
+
+class FlashRecord():
+    """ Node-side record of the firmware last flashed onto each board,
+        keyed by board serial number. Each entry holds the firmware
+        cache key and UF2 hash recorded at build time, along with the
+        ``boot_out.txt`` banner the board reported after flashing.
+
+    :param: record_file: Path to the JSON file holding the record.
+    """
+
+    def __init__(self, record_file=None):
+        self.record_file = pathlib.Path(record_file or DEFAULT_RECORD_FILE)
+        self.record_file.parent.mkdir(parents=True, exist_ok=True)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with open(self.record_file.with_suffix(".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                records = {}
+                if self.record_file.exists():
+                    with open(self.record_file, "r") as file:
+                        records = json.load(file)
+                yield records
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def get(self, serial_number):
+        """ The record for the board with ``serial_number``, if any. """
+        with self._locked() as records:
+            return records.get(serial_number)
+
+    def update(self, serial_number, commit, fw_key, fw_sha256, version_line): # pylint: disable=too-many-arguments
+        """ Records the firmware that was just flashed onto a board. """
+        with self._locked() as records:
+            records[serial_number] = {
+                "commit": commit,
+                "fw_key": fw_key,
+                "sha256": fw_sha256,
+                "version": version_line,
+                "flashed_at": time.time(),
+            }
+            tmp_file = self.record_file.with_suffix(".tmp")
+            with open(tmp_file, "w") as file:
+                json.dump(records, file, indent=1)
+            os.replace(tmp_file, self.record_file)
+
+    def forget(self, serial_number):
+        """ Drops the record for a board, so it is flashed next time. """
+        with self._locked() as records:
+            if records.pop(serial_number, None) is not None:
+                tmp_file = self.record_file.with_suffix(".tmp")
+                with open(tmp_file, "w") as file:
+                    json.dump(records, file, indent=1)
+                os.replace(tmp_file, self.record_file)
+
+    def matches(self, serial_number, commit, fw_key, version_line):
+        """ Whether the board is known to be running the firmware built
+            from ``commit`` with ``fw_key``. The board's current version
+            banner must be the one it reported after it was flashed, and
+            any commit in the banner must agree with ``commit``, so that
+            a board reflashed by hand is never mistaken for a match.
+        """
+        record = self.get(serial_number)
+        if record is None or version_line is None:
+            return False
+        if record["commit"] != commit or record["fw_key"] != fw_key:
+            return False
+        if record["version"] != version_line:
+            return False
+        running_commit = version_commit(version_line)
+        if running_commit is not None and not commit.startswith(running_commit):
+            return False
+        return True
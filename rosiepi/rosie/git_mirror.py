@@ -0,0 +1,252 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import contextlib
+import fcntl
+import logging
+import pathlib
+import re
+import time
+
+import sh
+from sh.contrib import git
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+DEFAULT_MIRROR_DIR = pathlib.Path.home() / ".fw_builds" / "mirrors"
+
+_MIRROR_REF = "refs/rosiepi/{}"
+
+
+def _mirror_name(url):
+    """ Turns a repository URL into a directory name for its mirror. """
+    name = re.sub(r"^[a-z+]+://", "", url).rstrip("/")
+    if name.endswith(".git"):
+        name = name[:-4]
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", name) + ".git"
+
+
+def _join_url(base, url):
+    """ Resolves a relative submodule URL against the superproject's
+        URL the way git does: each ``../`` drops a path component.
+    """
+    base = base.rstrip("/")
+    while True:
+        if url.startswith("./"):
+            url = url[2:]
+        elif url.startswith("../"):
+            base = base.rsplit("/", 1)[0]
+            url = url[3:]
+        else:
+            return f"{base}/{url}"
+
+
+class GitMirror():
+    """ Persistent bare mirrors of the circuitpython repository and each
+        of its submodules. Objects are only fetched from the network
+        when a mirror does not already have the commit being asked for,
+        and clones and worktrees borrow objects from the mirrors through
+        git alternates instead of copying them.
+
+        The duration of every git step is logged, both to the node's log
+        and to the ``test_log`` passed in, as ``git <step>: <seconds>s``.
+
+    :param: upstream: URL of the circuitpython repository. Local paths
+                      to bare repositories work as well. Defaults to the
+                      ``origin`` of the clone being populated, which is
+                      also where commits are resolved.
+    :param: mirror_dir: Directory to hold the bare mirrors.
+    """
+
+    def __init__(self, upstream=None, mirror_dir=None):
+        self.upstream = upstream
+        self.mirror_dir = pathlib.Path(mirror_dir or DEFAULT_MIRROR_DIR)
+        self.mirror_dir.mkdir(parents=True, exist_ok=True)
+
+    @contextlib.contextmanager
+    def _timed(self, step, test_log=None):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            rosiepi_logger.info("git %s: %.2fs", step, elapsed)
+            if test_log is not None:
+                test_log.write(f" - git {step}: {elapsed:.2f}s")
+
+    @contextlib.contextmanager
+    def _locked(self, mirror_path):
+        """ Serializes updates to a single mirror across processes. """
+        lock_path = mirror_path.with_suffix(".lock")
+        with open(lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def upstream_url(self, repo_dir):
+        """ The URL of the circuitpython repository that ``repo_dir`` is
+            populated from: ``upstream`` if it was given, otherwise the
+            repository's ``origin``.
+        """
+        if self.upstream:
+            return self.upstream
+        return str(
+            git("remote", "get-url", "origin", _cwd=str(repo_dir))
+        ).strip()
+
+    def mirror_path(self, url):
+        """ The bare mirror directory for the repository at ``url``. """
+        return self.mirror_dir / _mirror_name(url)
+
+    @staticmethod
+    def _has_commit(repo_path, commit):
+        try:
+            git("cat-file", "-e", f"{commit}^{{commit}}", _cwd=str(repo_path))
+        except sh.ErrorReturnCode:
+            return False
+        return True
+
+    def _ensure_mirror(self, url, test_log=None):
+        mirror_path = self.mirror_path(url)
+        if not mirror_path.exists():
+            with self._timed(f"mirror {_mirror_name(url)}", test_log):
+                git("init", "--bare", str(mirror_path))
+                git("remote", "add", "origin", url, _cwd=str(mirror_path))
+        return mirror_path
+
+    def fetch(self, url, ref, commit=None, test_log=None):
+        """ Makes sure the mirror of ``url`` has ``commit``, fetching
+            ``ref`` into it if it does not. The commit is kept alive by a
+            ``refs/rosiepi/<commit>`` ref. Returns the mirror path.
+
+        :param: str url: The repository URL.
+        :param: str ref: The ref or SHA to fetch.
+        :param: str commit: The full SHA expected. Defaults to ``ref``.
+        :param: test_log: An optional log to write step timings to.
+        """
+        commit = commit or ref
+        # servers only take full SHAs, so an abbreviated one is fetched
+        # by the SHA it resolved to.
+        if commit.startswith(ref):
+            ref = commit
+        mirror_path = self._ensure_mirror(url, test_log)
+        with self._locked(mirror_path):
+            if not self._has_commit(mirror_path, commit):
+                with self._timed(f"fetch {_mirror_name(url)}", test_log):
+                    git("fetch", "origin", ref, _cwd=str(mirror_path))
+                if not self._has_commit(mirror_path, commit):
+                    raise RuntimeError(
+                        f"Fetching '{ref}' from {url} did not bring {commit}."
+                    )
+            git("update-ref", _MIRROR_REF.format(commit), commit,
+                _cwd=str(mirror_path))
+        return mirror_path
+
+    def populate_clone(self, repo_dir, build_ref, commit, test_log=None):
+        """ Brings ``commit`` into the clone at ``repo_dir`` from the
+            mirror. The clone is pointed at the mirror's object store
+            through alternates, so no objects are copied.
+
+        :param: repo_dir: The circuitpython clone that worktrees are
+                          created from.
+        :param: str build_ref: The tag/commit that was requested.
+        :param: str commit: The full SHA that `build_ref` resolved to.
+        :param: test_log: An optional log to write step timings to.
+        """
+        mirror_path = self.fetch(
+            self.upstream_url(repo_dir), build_ref, commit, test_log
+        )
+        self._add_alternate(repo_dir, mirror_path)
+        if not self._has_commit(repo_dir, commit):
+            with self._timed("fetch from mirror", test_log):
+                git("fetch", str(mirror_path), _MIRROR_REF.format(commit),
+                    _cwd=str(repo_dir))
+
+    @staticmethod
+    def _add_alternate(repo_dir, mirror_path):
+        git_dir = pathlib.Path(
+            str(git("rev-parse", "--git-common-dir", _cwd=str(repo_dir))).strip()
+        )
+        if not git_dir.is_absolute():
+            git_dir = pathlib.Path(repo_dir) / git_dir
+        alternates = git_dir / "objects" / "info" / "alternates"
+        mirror_objects = str((mirror_path / "objects").resolve())
+
+        current = []
+        if alternates.exists():
+            current = alternates.read_text().split()
+        if mirror_objects not in current:
+            alternates.parent.mkdir(parents=True, exist_ok=True)
+            with open(alternates, "a") as file:
+                file.write(mirror_objects + "\n")
+
+    def submodules(self, worktree):
+        """ Returns a list of ``(name, path, url, commit)`` tuples for the
+            submodules recorded at the worktree's checked out commit.
+        """
+        worktree = str(worktree)
+        try:
+            config = str(git("config", "-f", ".gitmodules", "--get-regexp",
+                             r"^submodule\..*\.(path|url)$", _cwd=worktree))
+        except sh.ErrorReturnCode:
+            return []
+
+        modules = {}
+        for line in config.splitlines():
+            key, _, value = line.partition(" ")
+            name, _, setting = key[len("submodule."):].rpartition(".")
+            modules.setdefault(name, {})[setting] = value.strip()
+
+        upstream = self.upstream_url(worktree)
+        found = []
+        for name, settings in sorted(modules.items()):
+            path = settings.get("path")
+            url = settings.get("url", "")
+            if path is None:
+                continue
+            if url.startswith("../") or url.startswith("./"):
+                url = _join_url(upstream, url)
+            tree_entry = str(git("ls-tree", "HEAD", path, _cwd=worktree)).split()
+            # only gitlinks (mode 160000) are submodules
+            if len(tree_entry) >= 3 and tree_entry[1] == "commit":
+                found.append((name, path, url, tree_entry[2]))
+        return found
+
+    def update_submodules(self, worktree, test_log=None):
+        """ Checks out every submodule of ``worktree`` from the mirrors.
+            A submodule's mirror is only fetched when it does not already
+            have the commit the worktree records for it.
+
+        :param: worktree: The checked out circuitpython worktree.
+        :param: test_log: An optional log to write step timings to.
+        """
+        with self._timed("submodule update", test_log):
+            for name, path, url, commit in self.submodules(worktree):
+                mirror_path = self.fetch(url, commit, test_log=test_log)
+                git("config", f"submodule.{name}.url", mirror_path.as_uri(),
+                    _cwd=str(worktree))
+                git("-c", "protocol.file.allow=always",
+                    "submodule", "update", "--init", "--reference",
+                    str(mirror_path), "--", path, _cwd=str(worktree))
@@ -0,0 +1,82 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import contextlib
+import fcntl
+import os
+import pathlib
+import time
+
+DEFAULT_SLOT_DIR = pathlib.Path.home() / ".fw_builds" / "job_slots"
+
+
+class JobBudget():
+    """ Node-wide budget of ``make`` jobs, shared by every build running
+        on the node, including builds in other processes. Each job is a
+        slot file; holding a ``flock`` on the file holds the job. Locks
+        are dropped by the kernel if a build dies, so crashed builds
+        never leak jobs.
+
+    :param: int total: The number of jobs in the budget. Defaults to the
+                       number of CPUs.
+    :param: slot_dir: Directory to hold the slot files.
+    """
+
+    def __init__(self, total=None, slot_dir=None):
+        self.total = total or os.cpu_count() or 1
+        self.slot_dir = pathlib.Path(slot_dir or DEFAULT_SLOT_DIR)
+        self.slot_dir.mkdir(parents=True, exist_ok=True)
+
+    def _try_slots(self, want):
+        held = []
+        for slot in range(self.total):
+            if len(held) == want:
+                break
+            slot_file = open(self.slot_dir / f"slot-{slot}", "w")
+            try:
+                fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                slot_file.close()
+                continue
+            held.append(slot_file)
+        return held
+
+    @contextlib.contextmanager
+    def acquire(self, want=None):
+        """ Holds up to ``want`` jobs from the budget, waiting until at
+            least one is free. Yields the number of jobs held.
+
+        :param: int want: The jobs to ask for. Defaults to the whole budget.
+        """
+        want = max(1, min(want or self.total, self.total))
+        held = self._try_slots(want)
+        while not held:
+            time.sleep(0.5)
+            held = self._try_slots(want)
+
+        try:
+            yield len(held)
+        finally:
+            for slot_file in held:
+                fcntl.flock(slot_file, fcntl.LOCK_UN)
+                slot_file.close()
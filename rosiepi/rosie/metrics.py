@@ -0,0 +1,429 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+import bisect
+import contextlib
+import fcntl
+import http.server
+import json
+import logging
+import math
+import os
+import pathlib
+import tempfile
+import threading
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+DEFAULT_STATE_FILE = pathlib.Path.home() / ".cache" / "rosiepi" / "metrics.json"
+
+BUILD_PHASES = (
+    "resolve_commit", "fw_cache_lookup", "git_fetch", "worktree_checkout",
+    "submodule_update", "make_mpy_cross", "make", "fw_cache_store",
+)
+
+# controller states, and the phase a failure in them is counted under
+_STATE_PHASES = {
+    "init": "connect",
+    "board_connected": "connect",
+    "gather_tests": "gather_tests",
+    "starting_fw_prep": "firmware",
+    "running_tests": "tests",
+}
+
+
+def _label_key(labelnames, labels):
+    missing = set(labelnames) - set(labels)
+    if missing or len(labels) != len(labelnames):
+        raise ValueError(f"Expected labels {labelnames}, got {sorted(labels)}")
+    return json.dumps([str(labels[name]) for name in labelnames])
+
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, json.loads(key))) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        '{}="{}"'.format(
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        for name, value in pairs
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter():
+    """ A Prometheus counter.
+
+    :param: str name: Name of the metric.
+    :param: str help_text: Description of the metric.
+    :param: labelnames: Names of the metric's labels.
+    """
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        """ Adds ``amount`` to the counter with ``labels``. """
+        key = _label_key(self.labelnames, labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def merge(self, state):
+        """ Adds the values of a stored ``state`` to this counter. """
+        for key, value in state.items():
+            self.values[key] = self.values.get(key, 0) + value
+
+    def state(self):
+        """ The counter's values, for storing. """
+        return dict(self.values)
+
+    def samples(self):
+        """ Yields the counter's lines of the text format. """
+        for key, value in sorted(self.values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram():
+    """ A Prometheus histogram.
+
+    :param: str name: Name of the metric.
+    :param: str help_text: Description of the metric.
+    :param: buckets: Upper bounds of the histogram's buckets.
+    :param: labelnames: Names of the metric's labels.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.labelnames = tuple(labelnames)
+        # per label set: [bucket counts..., count of larger values], sum
+        self.values = {}
+
+    def _entry(self, key):
+        return self.values.setdefault(
+            key, {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0}
+        )
+
+    def observe(self, value, **labels):
+        """ Records ``value`` in the histogram with ``labels``. """
+        entry = self._entry(_label_key(self.labelnames, labels))
+        entry["counts"][bisect.bisect_left(self.buckets, value)] += 1
+        entry["sum"] += value
+
+    def merge(self, state):
+        """ Adds the observations of a stored ``state``. Stored states
+            with other buckets are dropped.
+        """
+        for key, stored in state.items():
+            if len(stored["counts"]) != len(self.buckets) + 1:
+                continue
+            entry = self._entry(key)
+            entry["counts"] = [a + b for a, b in zip(entry["counts"], stored["counts"])]
+            entry["sum"] += stored["sum"]
+
+    def state(self):
+        """ The histogram's observations, for storing. """
+        return {
+            key: {"counts": list(entry["counts"]), "sum": entry["sum"]}
+            for key, entry in self.values.items()
+        }
+
+    def samples(self):
+        """ Yields the histogram's lines of the text format. """
+        for key, entry in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), entry["counts"]):
+                cumulative += count
+                labels = _format_labels(
+                    self.labelnames, key, [("le", _format_value(float(bound)))]
+                )
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(entry['sum'])}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class MetricsRegistry():
+    """ A set of metrics, rendered together in the Prometheus text format.
+        Totals can be carried between runs of the node with ``publish``.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, help_text, labelnames=()):
+        """ Adds and returns a ``Counter``. """
+        self.metrics[name] = Counter(name, help_text, labelnames)
+        return self.metrics[name]
+
+    def histogram(self, name, help_text, buckets, labelnames=()):
+        """ Adds and returns a ``Histogram``. """
+        self.metrics[name] = Histogram(name, help_text, buckets, labelnames)
+        return self.metrics[name]
+
+    @contextlib.contextmanager
+    def updating(self):
+        """ Holds the registry's lock while metrics are updated. """
+        with self._lock:
+            yield self
+
+    def render(self):
+        """ The registry in the Prometheus text exposition format. """
+        lines = []
+        with self._lock:
+            for metric in self.metrics.values():
+                lines.append(f"# HELP {metric.name} {metric.help_text}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+                lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+    def publish(self, state_file=None, textfile=None):
+        """ Adds this registry's metrics to the node's stored totals, and
+            writes the totals as a textfile collector file. The stored
+            totals are locked while they are updated, so concurrent runs
+            don't lose each other's metrics.
+
+        :param: state_file: JSON file holding the node's metric totals.
+        :param: textfile: The ``.prom`` file to write, usually in the node
+                          exporter's textfile collector directory.
+        """
+        state_file = pathlib.Path(state_file or DEFAULT_STATE_FILE)
+        state_file.parent.mkdir(parents=True, exist_ok=True)
+
+        totals = type(self)()
+        with open(state_file.with_suffix(".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                stored = {}
+                if state_file.exists():
+                    try:
+                        stored = json.loads(state_file.read_text())
+                    except ValueError:
+                        rosiepi_logger.warning(
+                            "Discarding unreadable metrics state: %s", state_file
+                        )
+                with self._lock:
+                    for name, metric in totals.metrics.items():
+                        metric.merge(stored.get(name, {}))
+                        if name in self.metrics:
+                            metric.merge(self.metrics[name].state())
+                    new_state = {
+                        name: metric.state()
+                        for name, metric in totals.metrics.items()
+                    }
+                _write_atomic(state_file, json.dumps(new_state))
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        if textfile is not None:
+            _write_atomic(pathlib.Path(textfile), totals.render())
+        return totals
+
+
+def _write_atomic(path, text):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # the textfile is written outside the state lock, by any thread
+    tmp = tempfile.NamedTemporaryFile("w", dir=path.parent,
+                                      prefix=f".{path.name}.", suffix=".tmp",
+                                      delete=False)
+    try:
+        with tmp:
+            tmp.write(text)
+        os.replace(tmp.name, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp.name)
+        raise
+
+
+class NodeMetrics(MetricsRegistry):
+    """ The operational metrics of a RosiePi node: how long jobs wait,
+        build, flash and test, how they fail, and how often firmware is
+        reused.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.queue_wait = self.histogram(
+            "rosiepi_queue_wait_seconds",
+            "Seconds a test job waited before it started.",
+            (1, 5, 15, 30, 60, 300, 900, 1800, 3600),
+        )
+        self.build = self.histogram(
+            "rosiepi_build_seconds",
+            "Seconds spent building a board's firmware.",
+            (5, 15, 30, 60, 120, 300, 600, 1200),
+            ("board",),
+        )
+        self.flash = self.histogram(
+            "rosiepi_flash_seconds",
+            "Seconds spent updating a board's firmware.",
+            (1, 2, 5, 10, 20, 30, 60, 120),
+            ("board",),
+        )
+        self.test = self.histogram(
+            "rosiepi_test_seconds",
+            "Seconds taken by each test file.",
+            (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120),
+            ("board",),
+        )
+        self.recovery = self.histogram(
+            "rosiepi_recovery_seconds",
+            "Seconds spent recovering a hung board, by recovery tier.",
+            (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120),
+            ("board", "tier"),
+        )
+        self.runs = self.counter(
+            "rosiepi_board_runs_total",
+            "Board test runs, by outcome.",
+            ("board", "outcome"),
+        )
+        self.failures = self.counter(
+            "rosiepi_failures_total",
+            "Board test runs that failed or errored, by the phase they "
+            "stopped in.",
+            ("board", "phase"),
+        )
+        self.flaky = self.counter(
+            "rosiepi_flaky_tests_total",
+            "Tests that failed and then passed on the same firmware.",
+            ("board",),
+        )
+        self.fw_cache = self.counter(
+            "rosiepi_fw_cache_lookups_total",
+            "Firmware cache lookups, by result.",
+            ("result",),
+        )
+        self.fw_reused = self.counter(
+            "rosiepi_fw_reused_total",
+            "Board runs that skipped building and flashing because the "
+            "board already ran the firmware.",
+            ("board",),
+        )
+
+    def observe_board(self, board, rosie_test, outcome):
+        """ Records the metrics of one board's run.
+
+        :param: str board: The name of the board.
+        :param: rosie_test: The ``TestController`` that ran the board, or
+                            ``None`` if none could be made for it.
+        :param: str outcome: The board's outcome, e.g. ``"Passed"``.
+        """
+        if rosie_test is None:
+            with self.updating():
+                self.runs.inc(board=board, outcome=outcome)
+                self.failures.inc(board=board, phase="connect")
+            return
+
+        spans = rosie_test.log.timings.spans
+        phases = {span.phase for span in spans}
+        with self.updating():
+            self.runs.inc(board=board, outcome=outcome)
+
+            if outcome == "Error":
+                self.failures.inc(
+                    board=board,
+                    phase=_STATE_PHASES.get(rosie_test.error_state, "unknown")
+                )
+            elif outcome == "Failed":
+                self.failures.inc(board=board, phase="tests")
+
+            # results kept from an earlier run were counted then
+            flaky = sum(
+                1 for test in rosie_test.tests
+                if test.flaky and test.test_result and not test.carried_over
+            )
+            if flaky:
+                self.flaky.inc(flaky, board=board)
+
+            build_time = sum(
+                span.duration for span in spans if span.phase in BUILD_PHASES
+            )
+            if "make" in phases:
+                self.build.observe(build_time, board=board)
+            if "fw_cache_lookup" in phases:
+                self.fw_cache.inc(result="miss" if "make" in phases else "hit")
+
+            for span in spans:
+                if span.phase == "flash":
+                    self.flash.observe(span.duration, board=board)
+                elif span.phase == "test":
+                    self.test.observe(span.duration, board=board)
+                elif span.phase.startswith("recovery_"):
+                    self.recovery.observe(
+                        span.duration,
+                        board=board,
+                        tier=span.phase[len("recovery_"):]
+                    )
+
+            if "firmware_check" in phases and "flash" not in phases \
+                    and rosie_test.state != "error":
+                self.fw_reused.inc(board=board)
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self): # pylint: disable=invalid-name
+        """ Serves the registry on ``/metrics``. """
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        rosiepi_logger.debug("metrics: " + format, *args)
+
+
+def serve_metrics(registry, port, host="127.0.0.1"):
+    """ Serves ``registry`` on ``http://host:port/metrics`` from a
+        background thread, and returns the server. Stop it with
+        ``shutdown()``.
+    """
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    thread = threading.Thread(
+        target=server.serve_forever, name="rosiepi-metrics", daemon=True
+    )
+    thread.start()
+    return server
@@ -0,0 +1,368 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import pathlib
+import random
+import re
+import tempfile
+import threading
+import time
+
+from .result_upload import BOARD_ENDPOINT, FINAL_ENDPOINT, gzip_chunks
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+DEFAULT_OUTBOX_DIR = pathlib.Path.home() / ".cache" / "rosiepi" / "outbox"
+
+# how long an undeliverable entry is retried before it is set aside
+DEFAULT_MAX_AGE = 7 * 24 * 60 * 60
+
+# status codes that won't change by sending the same upload again
+_RETRYABLE_CLIENT_ERRORS = (408, 425, 429)
+
+
+class ResultOutbox():
+    """ Durable outbox for results bound for physaCI. Uploads are written
+        to disk first and delivered by a background sender, which retries
+        failed uploads with exponential backoff. Entries left over when
+        the process exits are delivered by the next outbox started on the
+        same directory, so a physaCI outage doesn't lose a run's results.
+
+        Every entry carries an idempotency key made from the check run ID
+        and the node name, plus the board for early board uploads. Putting
+        an entry with a key that is already queued replaces it.
+
+        Accepts the same ``send_board`` and ``send_final`` calls as the
+        ``ResultUploader`` it delivers through.
+
+    :param: uploader: The ``result_upload.ResultUploader`` to deliver with.
+    :param: outbox_dir: Directory holding the queued entries.
+    :param: float base_delay: Seconds to wait before the first retry.
+    :param: float max_delay: Most seconds to wait between retries.
+    :param: int max_age: Seconds to keep retrying an entry before it is
+                         moved to the outbox's ``dead`` directory.
+    :param: int batch_size: Most due entries to send in one pass over the
+                            uploader's connection.
+    """
+
+    def __init__(self, uploader, outbox_dir=None, base_delay=5, max_delay=600, # pylint: disable=too-many-arguments
+                 max_age=DEFAULT_MAX_AGE, batch_size=10):
+        self.uploader = uploader
+        self.outbox_dir = pathlib.Path(outbox_dir or DEFAULT_OUTBOX_DIR)
+        self.dead_dir = self.outbox_dir / "dead"
+        self.dead_dir.mkdir(parents=True, exist_ok=True)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_age = max_age
+        self.batch_size = batch_size
+        # idempotency keys put by this outbox, which ``drain`` waits for
+        self.queued = set()
+
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._sender = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @staticmethod
+    def _entry_name(key):
+        return re.sub(r"[^\w.-]", "_", key)
+
+    def _paths(self, name):
+        return (
+            self.outbox_dir / f"{name}.json.gz",
+            self.outbox_dir / f"{name}.meta.json",
+        )
+
+    def _lock_path(self, name):
+        return self.outbox_dir / f"{name}.lock"
+
+    @contextlib.contextmanager
+    def _claim(self, name, wait=True):
+        """ Holds the entry's lock, so that only one sender handles it.
+            Yields whether the lock was taken. The lock file is removed
+            along with the entry, by ``_release``.
+        """
+        lock_file = self._lock_path(name)
+        flags = fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB
+        while True:
+            lock = open(lock_file, "w")
+            try:
+                fcntl.flock(lock, flags)
+            except BlockingIOError:
+                lock.close()
+                yield False
+                return
+            # the entry may have been removed while we waited, taking the
+            # lock file we hold with it; lock the current one instead.
+            try:
+                current = os.stat(lock_file).st_ino == os.fstat(lock.fileno()).st_ino
+            except FileNotFoundError:
+                current = False
+            if current:
+                break
+            lock.close()
+
+        try:
+            yield True
+        finally:
+            lock.close()
+
+    def _release(self, name):
+        """ Removes the entry's lock file. Only call while holding the
+            entry's claim, after the entry itself is removed.
+        """
+        with contextlib.suppress(FileNotFoundError):
+            self._lock_path(name).unlink()
+
+    @staticmethod
+    def _write_meta(meta_file, meta):
+        tmp_file = meta_file.with_suffix(f".{os.getpid()}.tmp")
+        tmp_file.write_text(json.dumps(meta))
+        os.replace(tmp_file, meta_file)
+
+    def put(self, key, endpoint, chunks, boards=()):
+        """ Writes an upload to the outbox and wakes the sender.
+
+        :param: str key: The upload's idempotency key.
+        :param: str endpoint: Path of the physaCI endpoint to send it to.
+        :param: chunks: Iterable of ``str`` chunks of the JSON body.
+        :param: boards: Boards whose logs the upload carries.
+        """
+        name = self._entry_name(key)
+        body_file, meta_file = self._paths(name)
+        # the same key may be put by several threads or processes at once
+        with tempfile.NamedTemporaryFile(dir=self.outbox_dir,
+                                         prefix=f"{name}.",
+                                         suffix=".tmp",
+                                         delete=False) as body:
+            tmp_file = body.name
+            try:
+                for chunk in gzip_chunks(chunks):
+                    body.write(chunk)
+            except BaseException:
+                body.close()
+                os.unlink(tmp_file)
+                raise
+
+        with self._claim(name):
+            os.replace(tmp_file, body_file)
+            self._write_meta(meta_file, {
+                "key": key,
+                "endpoint": endpoint,
+                "boards": list(boards),
+                "created": time.time(),
+                "attempts": 0,
+                "next_attempt": 0,
+            })
+
+        self.queued.add(key)
+        self._wake.set()
+
+    def send_board(self, board_payload):
+        """ Queues one board's results for early delivery.
+
+        :param: board_payload: A ``TestResultPayload`` holding only the
+                               board's results.
+        """
+        boards = [
+            board["board_name"]
+            for board in board_payload.node_test_data.board_tests
+        ]
+        key = ":".join(
+            [str(self.uploader.check_run_id), self.uploader.node_name] + boards
+        )
+        self.put(
+            key,
+            BOARD_ENDPOINT,
+            board_payload.iter_json(
+                node_name=self.uploader.node_name,
+                check_run_id=self.uploader.check_run_id,
+                partial=True,
+                idempotency_key=key
+            ),
+            boards=boards
+        )
+        return True
+
+    def send_final(self, results_payload):
+        """ Queues the complete results. Logs of boards whose early
+            upload was already delivered are left out.
+
+        :param: results_payload: The run's ``TestResultPayload``.
+        """
+        key = f"{self.uploader.check_run_id}:{self.uploader.node_name}"
+        self.put(
+            key,
+            FINAL_ENDPOINT,
+            results_payload.iter_json(
+                node_name=self.uploader.node_name,
+                check_run_id=self.uploader.check_run_id,
+                sent_logs=set(self.uploader.uploaded),
+                idempotency_key=key
+            )
+        )
+
+    def pending(self):
+        """ The metadata of every queued entry, oldest first. """
+        entries = []
+        for meta_file in self.outbox_dir.glob("*.meta.json"):
+            try:
+                entries.append(json.loads(meta_file.read_text()))
+            except (OSError, ValueError):
+                continue
+        return sorted(entries, key=lambda meta: meta["created"])
+
+    def _backoff(self, attempts):
+        delay = min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+        # spread retries out, so nodes don't all retry at once
+        return delay * random.uniform(0.5, 1)
+
+    def _deliver(self, key):
+        name = self._entry_name(key)
+        body_file, meta_file = self._paths(name)
+        with self._claim(name, wait=False) as claimed:
+            if not claimed or not meta_file.exists():
+                return
+            meta = json.loads(meta_file.read_text())
+
+            try:
+                self.uploader.post_file(meta["endpoint"], body_file, meta["key"])
+            except RuntimeError as upload_err:
+                status_code = upload_err.args[1] if len(upload_err.args) > 1 else None
+                meta["attempts"] += 1
+                permanent = (
+                    status_code is not None
+                    and 400 <= status_code < 500
+                    and status_code not in _RETRYABLE_CLIENT_ERRORS
+                )
+                if permanent or time.time() - meta["created"] > self.max_age:
+                    rosiepi_logger.error(
+                        "Giving up on upload %s after %s attempt(s):\n%s",
+                        meta["key"], meta["attempts"], upload_err.args[0]
+                    )
+                    os.replace(body_file, self.dead_dir / body_file.name)
+                    self._write_meta(self.dead_dir / meta_file.name, meta)
+                    meta_file.unlink()
+                    self._release(name)
+                    return
+
+                meta["next_attempt"] = time.time() + self._backoff(meta["attempts"])
+                self._write_meta(meta_file, meta)
+                rosiepi_logger.warning(
+                    "Upload %s failed (attempt %s); retrying in %.0fs:\n%s",
+                    meta["key"], meta["attempts"],
+                    meta["next_attempt"] - time.time(), upload_err.args[0]
+                )
+                return
+
+            meta_file.unlink()
+            body_file.unlink()
+            self._release(name)
+            # entries left by other runs don't count towards this one
+            run_prefix = f"{self.uploader.check_run_id}:{self.uploader.node_name}:"
+            if meta["key"].startswith(run_prefix):
+                self.uploader.uploaded.update(meta["boards"])
+            rosiepi_logger.info("Delivered upload: %s", meta["key"])
+
+    def send_due(self):
+        """ Sends up to ``batch_size`` entries that are due, oldest first.
+            Returns the seconds until the next entry is due, or ``None``
+            if the outbox is empty.
+        """
+        now = time.time()
+        entries = self.pending()
+        due = [meta for meta in entries if meta["next_attempt"] <= now]
+        for meta in due[:self.batch_size]:
+            self._deliver(meta["key"])
+
+        entries = self.pending()
+        if not entries:
+            return None
+        return max(min(meta["next_attempt"] for meta in entries) - time.time(), 0)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                wait = self.send_due()
+            except Exception: # pylint: disable=broad-except
+                rosiepi_logger.exception("Outbox sender failed a pass.")
+                wait = self.base_delay
+            self._wake.wait(60 if wait is None else min(wait, 60))
+            self._wake.clear()
+
+    def start(self):
+        """ Starts the background sender, which also picks up entries
+            left from earlier runs.
+        """
+        if self._sender is not None:
+            return
+        self._stop.clear()
+        self._sender = threading.Thread(
+            target=self._run, name="rosiepi-outbox", daemon=True
+        )
+        self._sender.start()
+
+    def wake(self):
+        """ Has the background sender look for due entries now, such as
+            ones put by another outbox on the same directory.
+        """
+        self._wake.set()
+
+    def drain(self, timeout, keys=None):
+        """ Waits up to ``timeout`` seconds for this run's uploads to be
+            delivered. Entries left from earlier runs aren't waited for.
+            Returns whether they were; anything left is delivered later.
+
+        :param: float timeout: Most seconds to wait.
+        :param: keys: Idempotency keys to wait for. Defaults to the ones
+                      put by this outbox.
+        """
+        keys = set(self.queued if keys is None else keys)
+        deadline = time.monotonic() + timeout
+        self._wake.set()
+        while keys & {meta["key"] for meta in self.pending()}:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.2)
+        return True
+
+    def stop(self):
+        """ Stops the background sender. Queued entries stay on disk. """
+        if self._sender is None:
+            return
+        self._stop.set()
+        self._wake.set()
+        self._sender.join()
+        self._sender = None
@@ -0,0 +1,308 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+import concurrent.futures
+import logging
+import queue
+import threading
+import traceback
+
+from . import cirpy_actions
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+
+class PipelineRun():
+    """ A commit submitted to a ``TestPipeline``.
+
+        ``futures`` maps each board name to a ``concurrent.futures.Future``
+        that resolves to the board's ``TestController`` once the board has
+        finished with the commit, whatever its outcome. If no controller
+        could be made for the board, the future holds that error instead.
+
+    :param: str commit: The tag/commit to test.
+    :param: boards: The names of the boards to test the commit on.
+    :param: make_controller: Callable that returns a connected
+                             ``TestController`` for the run, given the
+                             board name and the commit.
+    """
+    def __init__(self, commit, boards, make_controller):
+        self.commit = commit
+        self.boards = list(boards)
+        self.make_controller = make_controller
+        self.futures = {
+            board: concurrent.futures.Future() for board in self.boards
+        }
+        self._remaining = len(self.boards)
+        self._lock = threading.Lock()
+        self._on_done = None
+        self._handed_off = set()
+
+    def _finish(self, board, rosie_test, error=None):
+        if error is None:
+            self.futures[board].set_result(rosie_test)
+        else:
+            self.futures[board].set_exception(error)
+        with self._lock:
+            self._remaining -= 1
+            done = self._remaining == 0
+        if done and self._on_done is not None:
+            self._on_done()
+
+    def wait(self, timeout=None):
+        """ Waits for every board to finish. Returns whether they did. """
+        _, not_done = concurrent.futures.wait(
+            self.futures.values(), timeout=timeout
+        )
+        return not not_done
+
+
+class TestPipeline(): # pylint: disable=too-many-instance-attributes
+    """ Runs commits through build, flash and test stages, so that the
+        CPU builds the next commit's firmware while the boards are busy
+        flashing and testing the current one.
+
+        A single build stage builds each commit's firmware for all of its
+        boards at once with ``cirpy_actions.ParallelBuild``, one commit
+        at a time. Every board has its own stage that flashes and tests
+        the commits in the order they were submitted, starting each as
+        soon as that board's firmware is ready.
+
+        Both queues are bounded: ``submit`` blocks while ``max_queued``
+        commits are waiting to be built, and the build stage waits while
+        ``build_ahead`` built commits are waiting on the boards.
+
+        A failure only stops the affected board's work on that commit; a
+        failed build or connection is reported in the board's log, and
+        the other boards, and the board's later commits, carry on.
+
+        Boards that are idle when a commit's build starts are connected
+        then, and skip the build when they already run its firmware.
+        Builds for busy boards start ahead of time, and are still skipped
+        for flashing when the board turns out to be current.
+
+    :param: boards: The names of the boards connected to the node.
+    :param: make_controller: Callable that returns a connected
+                             ``TestController``, given the board name
+                             and the commit. Can also be given with each
+                             submitted commit.
+    :param: fw_cache: An optional ``fw_cache.FirmwareCache``.
+    :param: int build_jobs: The most firmware builds to run at once.
+    :param: worktree_pool: An optional ``worktrees.WorktreePool`` to build
+                           the firmware in.
+    :param: build_settings: An optional ``cirpy_actions.BuildSettings``.
+    :param: bool concurrent_tests: Run the boards' tests in parallel
+                                   instead of one board at a time.
+    :param: int build_ahead: The most commits built ahead of the one
+                             the boards are running.
+    :param: int max_queued: The most commits waiting to be built.
+    """
+    def __init__(self, boards, make_controller=None, fw_cache=None, # pylint: disable=too-many-arguments
+                 build_jobs=None, worktree_pool=None, build_settings=None,
+                 concurrent_tests=True, build_ahead=1, max_queued=8):
+        self.boards = list(boards)
+        self.make_controller = make_controller
+        self.fw_cache = fw_cache
+        self.build_jobs = build_jobs
+        self.worktree_pool = worktree_pool
+        self.build_settings = build_settings
+
+        self._commits = queue.Queue(maxsize=max_queued)
+        self._in_flight = threading.Semaphore(build_ahead + 1)
+        self._board_queues = {board: queue.Queue() for board in self.boards}
+        # jobs handed to each board's stage that it hasn't finished yet
+        self._board_jobs = {board: 0 for board in self.boards}
+        self._lock = threading.Lock()
+        self._test_slots = threading.Semaphore(
+            max(len(self.boards), 1) if concurrent_tests else 1
+        )
+        self._threads = []
+        self._closed = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def start(self):
+        """ Starts the pipeline's stages. """
+        if self._threads:
+            return
+        self._threads.append(threading.Thread(
+            target=self._build_stage, name="rosiepi-build", daemon=True
+        ))
+        for board in self.boards:
+            self._threads.append(threading.Thread(
+                target=self._board_stage,
+                args=(board,),
+                name=f"rosiepi-{board}",
+                daemon=True
+            ))
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, commit, boards=None, make_controller=None):
+        """ Queues ``commit`` to be tested, and returns its ``PipelineRun``.
+            Blocks while the queue of commits waiting to be built is full.
+
+        :param: str commit: The tag/commit to test.
+        :param: boards: The boards to test on. Defaults to all of them.
+        :param: make_controller: Makes the commit's ``TestController``\s.
+                                 Defaults to the pipeline's.
+        """
+        if self._closed:
+            raise RuntimeError("The test pipeline is closed.")
+        boards = self.boards if boards is None else boards
+        unknown = [board for board in boards if board not in self._board_queues]
+        if unknown:
+            err_msg = [
+                "Boards are not part of the test pipeline:",
+                " - " + "\n - ".join(unknown),
+            ]
+            raise RuntimeError("\n".join(err_msg))
+
+        make_controller = make_controller or self.make_controller
+        if make_controller is None:
+            raise RuntimeError("No way to make test controllers was given.")
+
+        run = PipelineRun(commit, boards, make_controller)
+        self._commits.put(run)
+        return run
+
+    def close(self):
+        """ Stops taking commits, and waits for the queued ones to finish. """
+        if self._closed:
+            return
+        self._closed = True
+        self._commits.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _board_idle(self, board):
+        with self._lock:
+            return self._board_jobs[board] == 0
+
+    def _hand_off(self, board, run, rosie_test, fw_build):
+        run._handed_off.add(board) # pylint: disable=protected-access
+        with self._lock:
+            self._board_jobs[board] += 1
+        self._board_queues[board].put((run, rosie_test, fw_build))
+
+    def _build_stage(self):
+        while True:
+            run = self._commits.get()
+            if run is None:
+                break
+            self._in_flight.acquire()
+            run._on_done = self._in_flight.release # pylint: disable=protected-access
+            if not run.boards:
+                self._in_flight.release()
+                continue
+            try:
+                self._build(run)
+            except Exception: # pylint: disable=broad-except
+                rosiepi_logger.exception("Build stage failed for %s", run.commit)
+                # the boards still get the commit, and build it themselves
+                for board in run.boards:
+                    if board not in run._handed_off: # pylint: disable=protected-access
+                        self._hand_off(board, run, None, None)
+
+        for board_queue in self._board_queues.values():
+            board_queue.put(None)
+
+    def _build(self, run):
+        needs_build = {}
+        for board in run.boards:
+            rosie_test = None
+            if self._board_idle(board):
+                try:
+                    rosie_test = run.make_controller(board, run.commit)
+                except Exception: # pylint: disable=broad-except
+                    # the board's stage tries to connect again, and
+                    # reports the board as errored if it still can't
+                    rosiepi_logger.exception("Connecting to %s failed", board)
+                    self._hand_off(board, run, None, None)
+                    continue
+                if rosie_test.state == "error" or rosie_test.firmware_current():
+                    self._hand_off(board, run, rosie_test, None)
+                    continue
+            needs_build[board] = rosie_test
+
+        # leaving the build waits for its builds, so the next commit's
+        # build starts once this one's firmware is all ready.
+        with cirpy_actions.ParallelBuild(needs_build, run.commit,
+                                         fw_cache=self.fw_cache,
+                                         max_workers=self.build_jobs,
+                                         worktree_pool=self.worktree_pool,
+                                         build_settings=self.build_settings) as fw_builds:
+            for board, rosie_test in needs_build.items():
+                self._hand_off(board, run, rosie_test, fw_builds.futures[board])
+
+    def _board_stage(self, board):
+        board_queue = self._board_queues[board]
+        while True:
+            job = board_queue.get()
+            if job is None:
+                break
+            run, rosie_test, fw_build = job
+            error = None
+            try:
+                if fw_build is not None:
+                    # don't hold a test slot while the firmware builds
+                    concurrent.futures.wait([fw_build])
+                with self._test_slots:
+                    if rosie_test is None:
+                        rosie_test = run.make_controller(board, run.commit)
+                    if rosie_test.state != "error":
+                        run_board_tests(rosie_test, fw_build)
+            except Exception as stage_err: # pylint: disable=broad-except
+                rosiepi_logger.exception("Board stage failed for %s", board)
+                if rosie_test is None:
+                    error = stage_err
+            finally:
+                with self._lock:
+                    self._board_jobs[board] -= 1
+                run._finish(board, rosie_test, error) # pylint: disable=protected-access
+
+
+def run_board_tests(rosie_test, fw_build):
+    """ Runs a single board's tests, keeping any unexpected error
+        contained to that board's log and outcome.
+
+        :param: rosie_test: The board's ``TestController``.
+        :param: fw_build: The ``Future`` holding the board's firmware
+                          build, or ``None`` to build it in place.
+    """
+    try:
+        rosie_test.start_test(fw_build=fw_build)
+    except Exception: # pylint: disable=broad-except
+        rosie_test.log.write(traceback.format_exc())
+        rosie_test.state = "error"
+        rosiepi_logger.warning(
+            "Tests errored on %s. End of log:\n%s",
+            rosie_test.board_name,
+            rosie_test.log.tail()
+        )
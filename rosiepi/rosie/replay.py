@@ -0,0 +1,361 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+""" Recording of the serial traffic between the controller and a real
+    board, and replay of those recordings to ``TestController`` without
+    the board. Replays keep the board's real timing quirks, like slow
+    soft reboots, for profiling and benchmarking the controller.
+
+    A recording is a gzipped JSON lines file. The first line holds the
+    recording's details, including the tests that were run; each line
+    after it is ``[seconds, "w" or "r", data]``, where ``data`` is the
+    bytes written or read, decoded as latin-1.
+"""
+
+import collections
+import contextlib
+import gzip
+import json
+import threading
+import time
+
+from tests import pyboard
+
+from .simulator import SimulatedREPL, SimulatedSerial
+
+CAPTURE_FORMAT = 1
+
+# most seconds of same-direction traffic merged into one record
+MERGE_WINDOW = 0.05
+
+
+class SerialRecorder():
+    """ Writes timestamped serial traffic to a recording. The REPL reads
+        a byte at a time, so consecutive traffic in the same direction is
+        merged into one record for up to ``merge_window`` seconds, and
+        stamped with the time its last byte moved.
+
+    :param: capture_file: Path of the recording to write.
+    :param: float merge_window: Most seconds of traffic to merge.
+    :param: info: Details to store in the recording's header.
+    """
+
+    def __init__(self, capture_file, merge_window=MERGE_WINDOW, **info):
+        self.capture_file = capture_file
+        self.merge_window = merge_window
+        self._file = gzip.open(capture_file, "wt", encoding="utf-8")
+        self._lock = threading.Lock()
+        self._file.write(json.dumps(dict(info, format=CAPTURE_FORMAT)) + "\n")
+        self._start = time.monotonic()
+        # [direction, first seconds, last seconds, data] not yet written
+        self._pending = None
+
+    def record(self, direction, data):
+        """ Records ``data`` moving in ``direction``: ``"w"`` for bytes
+            written to the board, ``"r"`` for bytes read from it.
+        """
+        if not data:
+            return
+        elapsed = time.monotonic() - self._start
+        with self._lock:
+            pending = self._pending
+            if (pending is not None and pending[0] == direction
+                    and elapsed - pending[1] <= self.merge_window):
+                pending[2] = elapsed
+                pending[3] += data
+                return
+            self._flush()
+            self._pending = [direction, elapsed, elapsed, bytearray(data)]
+
+    def _flush(self):
+        if self._pending is None:
+            return
+        direction, _, elapsed, data = self._pending
+        line = json.dumps([round(elapsed, 6), direction, bytes(data).decode("latin-1")])
+        self._file.write(line + "\n")
+        self._pending = None
+
+    def close(self):
+        """ Finishes the recording. """
+        with self._lock:
+            self._flush()
+            self._file.close()
+
+
+class RecordingSerial():
+    """ Wraps a board's serial port, recording everything written to and
+        read from it. Everything else is passed through to the port.
+
+    :param: serial: The serial port to wrap.
+    :param: recorder: The ``SerialRecorder`` to record to.
+    """
+
+    def __init__(self, serial, recorder):
+        self.serial = serial
+        self.recorder = recorder
+
+    def write(self, data):
+        """ Writes ``data`` to the port, recording it. """
+        self.recorder.record("w", data)
+        return self.serial.write(data)
+
+    def read(self, size=1):
+        """ Reads from the port, recording what was read. """
+        data = self.serial.read(size)
+        self.recorder.record("r", data)
+        return data
+
+    def read_until(self, *args, **kwargs):
+        """ Reads from the port, recording what was read. """
+        data = self.serial.read_until(*args, **kwargs)
+        self.recorder.record("r", data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.serial, name)
+
+
+@contextlib.contextmanager
+def recording(cpboard, capture_file, **info):
+    """ Records the serial traffic of ``cpboard`` for the duration of the
+        ``with`` block. The board's own port is wrapped, since its REPL
+        reads ``serial`` from the board, so ``cpboard`` must be open.
+
+    :param: cpboard: The connected ``pyboard.CPboard``.
+    :param: capture_file: Path of the recording to write.
+    :param: info: Details to store in the recording's header.
+    """
+    recorder = SerialRecorder(
+        capture_file,
+        serial_number=cpboard.serial_number,
+        disk_path=str(cpboard.disk.path),
+        **info
+    )
+    serial = cpboard.serial
+    recording_serial = RecordingSerial(serial, recorder)
+    cpboard.serial = recording_serial
+    try:
+        yield recorder
+    finally:
+        # leave the port alone if the board was closed in the meantime
+        if cpboard.serial is recording_serial:
+            cpboard.serial = serial
+        recorder.close()
+
+
+def load_capture(capture_file):
+    """ Reads a recording. Returns ``(info, records)``, where each record
+        is ``(seconds, direction, data)``.
+    """
+    with gzip.open(capture_file, "rt", encoding="utf-8") as capture:
+        info = json.loads(capture.readline())
+        if info.get("format") != CAPTURE_FORMAT:
+            raise ValueError(f"Unsupported recording format: {info.get('format')}")
+        records = [
+            (seconds, direction, data.encode("latin-1"))
+            for seconds, direction, data in map(json.loads, capture)
+        ]
+    return info, records
+
+
+class ReplaySerial(SimulatedSerial): # pylint: disable=super-init-not-called
+    """ Serial port that answers the controller with the bytes a real
+        board sent in a recording.
+
+        Replies are matched to the controller's requests by turnaround:
+        the recording is split at each point the host went from writing to
+        reading, and the reads after the Nth turnaround are released once
+        the controller makes its Nth turnaround. Each read is released as
+        long after the controller's last write as it came after the
+        recorded one, divided by ``speed``. What the controller writes is
+        not checked against the recording.
+
+    :param: records: The records from ``load_capture``.
+    :param: float speed: How many times faster than recorded to replay.
+    :param: float timeout: Default seconds for ``read`` to wait.
+    """
+
+    def __init__(self, records, speed=1.0, timeout=1):
+        self.timeout = timeout
+        self.speed = speed
+        self._pushback = bytearray()
+        self._wrote = False
+        self.round_trips = 0
+        self.bytes_written = 0
+        self.bytes_read = 0
+
+        # (turnaround, seconds after the turnaround's last write, data)
+        self._chunks = collections.deque()
+        turn = 0
+        last_write = 0
+        wrote = False
+        for seconds, direction, data in records:
+            if direction == "w":
+                wrote = True
+                last_write = seconds
+                continue
+            if wrote:
+                turn += 1
+                wrote = False
+            self._chunks.append((turn, seconds - last_write, data))
+
+        self._turn = 0
+        self._last_write = time.monotonic()
+        self._turn_start = self._last_write
+        self._last_ready = 0
+
+    def write(self, data):
+        """ Takes ``data`` from the controller. """
+        self._wrote = True
+        self._last_write = time.monotonic()
+        self.bytes_written += len(data)
+        return len(data)
+
+    def _count_turnaround(self):
+        if self._wrote:
+            self._turn += 1
+            self._turn_start = self._last_write
+        super()._count_turnaround()
+
+    def _ready_at(self, chunk):
+        turn, delay, _ = chunk
+        if turn < self._turn:
+            # left over from an earlier turnaround; it already arrived
+            return self._last_ready
+        return max(self._turn_start + delay / self.speed, self._last_ready)
+
+    def _receive(self, size, timeout):
+        deadline = float("inf") if timeout is None else time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            if self._chunks and self._chunks[0][0] <= self._turn:
+                ready_at = self._ready_at(self._chunks[0])
+                if ready_at <= now:
+                    return self._take(size, ready_at)
+                wake = min(ready_at, deadline)
+            else:
+                wake = deadline
+            if now >= deadline:
+                return b""
+            time.sleep(max(wake - now, 0))
+
+    def _take(self, size, ready_at):
+        turn, delay, data = self._chunks.popleft()
+        self._last_ready = ready_at
+        if size is not None and size < len(data):
+            self._chunks.appendleft((turn, delay, data[size:]))
+            data = data[:size]
+        self.bytes_read += len(data)
+        return data
+
+    def _available(self):
+        now = time.monotonic()
+        available = 0
+        for chunk in self._chunks:
+            if chunk[0] > self._turn or self._ready_at(chunk) > now:
+                break
+            available += len(chunk[2])
+        return available
+
+    def read_turn(self):
+        """ Reads everything the board sent in reply to the controller's
+            latest writes.
+        """
+        self._count_turnaround()
+        data = bytearray(self._pushback)
+        self._pushback.clear()
+        while self._chunks and self._chunks[0][0] <= self._turn:
+            data += self._receive(None, None)
+        return bytes(data)
+
+
+class ReplayREPL(SimulatedREPL):
+    """ REPL of a replayed board. Calls that read a board-specific reply,
+        like a soft reset, take whatever the recorded board replied.
+    """
+
+    def execute(self, command, wait_for_response=False):
+        """ Writes ``command`` and, if asked, reads the recorded reply. """
+        self.write(command)
+        if wait_for_response:
+            data = self.serial.read_turn()
+            self.session += data
+            return data
+        return b""
+
+    def reset(self):
+        """ Soft resets the board, taking the recorded reboot output. """
+        self.write(b"\x04")
+        self.session += self.serial.read_turn()
+
+
+class _ReplayDisk(): # pylint: disable=too-few-public-methods
+    def __init__(self, path):
+        self.path = path
+
+
+class ReplayBoard(pyboard.CPboard): # pylint: disable=super-init-not-called
+    """ A ``pyboard.CPboard`` that replays a recorded board.
+
+    :param: capture_file: Path of the recording to replay.
+    :param: float speed: How many times faster than recorded to replay.
+    """
+
+    def __init__(self, capture_file, speed=1.0):
+        self.info, records = load_capture(capture_file)
+        self.board_name = self.info.get("board", "replay")
+        self.serial_number = self.info.get("serial_number", "REPLAY")
+        self.disk = _ReplayDisk(self.info.get("disk_path", ""))
+        self.bootloader = False
+        self.serial = ReplaySerial(records, speed=speed)
+        self.repl = ReplayREPL(self)
+
+    @classmethod
+    def factory(cls, capture_file, speed=1.0):
+        """ A callable for ``TestController``'s ``board_factory`` that
+            connects to a replay of ``capture_file``.
+        """
+        def connect(board_name, **_): # pylint: disable=unused-argument
+            return cls(capture_file, speed=speed)
+        return connect
+
+    def __enter__(self):
+        # recordings start inside the board's ``with`` block
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback): # pylint: disable=redefined-outer-name
+        pass
+
+    def close(self):
+        """ Nothing to stop for a replayed board. """
+
+    @property
+    def stats(self):
+        """ Traffic counters of the replay. """
+        return {
+            "bytes_to_board": self.serial.bytes_written,
+            "bytes_from_board": self.serial.bytes_read,
+            "round_trips": self.serial.round_trips,
+            "commands": None,
+        }
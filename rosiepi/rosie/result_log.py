@@ -0,0 +1,186 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+import codecs
+import collections
+import datetime
+import logging
+import os
+import pathlib
+import threading
+import time
+import zlib
+
+from .timing import PhaseTimings
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+DEFAULT_LOG_DIR = pathlib.Path.home() / ".cache" / "rosiepi" / "logs"
+
+# how much of the end of the log is kept in memory for summaries
+DEFAULT_TAIL_SIZE = 64 * 1024
+
+_READ_CHUNK = 64 * 1024
+
+
+class TestResultStream():
+    """ Container for handling test result output, sending to both the
+        stdout (print) and a per-run gzip file for logging and database
+        usage. Only the last ``tail_size`` characters are kept in memory;
+        the full log is streamed back from the file with ``iter_text``.
+        The run's phase timings are kept alongside it in ``timings``.
+
+    :param: str name: Name to include in the log file's name, usually
+                      the board being tested.
+    :param: log_dir: Directory to hold the log file.
+    :param: int tail_size: Characters of the log to keep in memory.
+    """
+
+    def __init__(self, name="rosiepi", log_dir=None, tail_size=DEFAULT_TAIL_SIZE):
+        self.log_dir = pathlib.Path(log_dir or DEFAULT_LOG_DIR)
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        self.path = self.log_dir / f"{name}-{stamp}-{os.getpid()}-{id(self):x}.log.gz"
+
+        self.tail_size = tail_size
+        self._tail = collections.deque()
+        self._tail_len = 0
+        self.size = 0
+        self.timings = PhaseTimings()
+
+        self._lock = threading.Lock()
+        self._file = open(self.path, "wb")
+        # a gzip stream, so the file can be read with zcat as it grows
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self._dirty = False
+
+    def write(self, data, quiet=True):
+        """ Writes ``data`` to the log, also printing it to stdout
+            unless ``quiet`` is set.
+        """
+        if isinstance(data, bytes):
+            data = str(data, encoding="utf-8", errors="replace")
+
+        if not quiet:
+            print(data)
+
+        if data[-1:] != "\n":
+            data = data + "\n"
+
+        with self._lock:
+            if self._compressor is None:
+                raise ValueError("I/O operation on closed log.")
+            self._file.write(self._compressor.compress(data.encode("utf-8")))
+            self._dirty = True
+            self.size += len(data)
+
+            self._tail.append(data)
+            self._tail_len += len(data)
+            while self._tail_len - len(self._tail[0]) >= self.tail_size:
+                self._tail_len -= len(self._tail.popleft())
+
+        return len(data)
+
+    def flush(self):
+        """ Pushes everything written so far out to the log file. """
+        with self._lock:
+            if self._compressor is None:
+                return
+            if self._dirty:
+                self._file.write(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+                self._dirty = False
+            self._file.flush()
+
+    def close(self):
+        """ Finishes the gzip stream. The log can still be read. """
+        with self._lock:
+            if self._compressor is None:
+                return
+            self._file.write(self._compressor.flush(zlib.Z_FINISH))
+            self._compressor = None
+            self._file.close()
+
+    @property
+    def closed(self):
+        """ Whether the log has been closed for writing. """
+        return self._compressor is None
+
+    def tail(self):
+        """ The end of the log, at most ``tail_size`` characters, plus any
+            part of the oldest line kept.
+        """
+        with self._lock:
+            tail = "".join(self._tail)
+        if len(tail) > self.tail_size:
+            tail = tail[-self.tail_size:]
+        return tail
+
+    def iter_text(self, chunk_size=_READ_CHUNK):
+        """ Yields the full log as text, in chunks, reading it back from
+            the log file.
+        """
+        self.flush()
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        with open(self.path, "rb") as log_file:
+            while True:
+                raw = log_file.read(chunk_size)
+                if not raw:
+                    break
+                text = decoder.decode(decompressor.decompress(raw))
+                if text:
+                    yield text
+        text = decoder.decode(decompressor.flush(), final=True)
+        if text:
+            yield text
+
+    def getvalue(self):
+        """ The full log as one string. Prefer ``iter_text`` for large
+            logs.
+        """
+        return "".join(self.iter_text())
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception: # pylint: disable=broad-except
+            pass
+
+
+def prune_logs(log_dir=None, max_age=7 * 24 * 60 * 60):
+    """ Removes run logs older than ``max_age`` seconds.
+
+    :param: log_dir: Directory holding the logs.
+    :param: int max_age: Seconds to keep a log for.
+    """
+    log_dir = pathlib.Path(log_dir or DEFAULT_LOG_DIR)
+    if not log_dir.exists():
+        return
+    cutoff = time.time() - max_age
+    for log_file in log_dir.glob("*.log.gz"):
+        try:
+            if log_file.stat().st_mtime < cutoff:
+                log_file.unlink()
+        except OSError:
+            rosiepi_logger.warning("Could not remove old log: %s", log_file)
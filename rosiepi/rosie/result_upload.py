@@ -0,0 +1,197 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+import gzip
+import logging
+import zlib
+from socket import gethostname
+
+import requests
+from requests.adapters import HTTPAdapter
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+BOARD_ENDPOINT = "/testresult/board"
+FINAL_ENDPOINT = "/testresult/update"
+
+
+def gzip_chunks(chunks, level=6):
+    """ Compresses an iterable of ``str`` or ``bytes`` chunks into a
+        gzip stream, yielding the compressed chunks as they are ready.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+class ResultUploader():
+    """ Sends test results to physaCI over one pooled, keep-alive HTTP
+        session. Each board's results can be sent as soon as the board
+        finishes, so the check run shows progress early and the final
+        upload only has to carry what wasn't sent already.
+
+    :param: str physaci_url: Base URL of the physaCI API.
+    :param: str api_key: Key sent with every request.
+    :param: check_run_id: The check run ID of the initiating check.
+    :param: str node_name: Name of this node. Defaults to the hostname.
+    :param: bool compress: Whether to gzip request bodies.
+    :param: float timeout: Seconds to wait on each request.
+    """
+
+    def __init__(self, physaci_url, api_key, check_run_id, node_name=None, # pylint: disable=too-many-arguments
+                 compress=True, timeout=60):
+        self.physaci_url = physaci_url.rstrip("/")
+        self.check_run_id = check_run_id
+        self.node_name = node_name or gethostname()
+        self.compress = compress
+        self.timeout = timeout
+        # boards whose logs physaCI already has
+        self.uploaded = set()
+
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=4))
+        self.session.mount("http://", HTTPAdapter(pool_maxsize=4))
+        self.session.headers.update({
+            "x-functions-key": api_key,
+            "Content-Type": "application/json",
+        })
+        if compress:
+            self.session.headers["Content-Encoding"] = "gzip"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """ Closes the HTTP session. """
+        self.session.close()
+
+    def _post(self, endpoint, body, idempotency_key=None):
+        headers = {}
+        if idempotency_key is not None:
+            headers["Idempotency-Key"] = idempotency_key
+
+        try:
+            response = self.session.post(
+                self.physaci_url + endpoint,
+                data=body,
+                headers=headers,
+                timeout=self.timeout
+            )
+        except requests.RequestException as req_err:
+            raise RuntimeError(
+                f"Failed to reach physaCI at {endpoint}: {req_err}",
+                None
+            ) from None
+
+        if not response.ok:
+            err_msg = [
+                f"physaCI rejected the upload to {endpoint}.",
+                f"Response code: {response.status_code}",
+                f"Response: {response.text}",
+            ]
+            raise RuntimeError("\n".join(err_msg), response.status_code)
+
+        return response
+
+    def post(self, endpoint, chunks, idempotency_key=None):
+        """ Streams the JSON ``chunks`` to ``endpoint``. Raises
+            ``RuntimeError`` if physaCI doesn't accept them, with the
+            response's status code as the second argument (``None`` if
+            physaCI couldn't be reached).
+
+        :param: str endpoint: Path of the API endpoint.
+        :param: chunks: Iterable of ``str`` chunks of the JSON body.
+        :param: str idempotency_key: Key that lets physaCI ignore repeats
+                                     of the same upload.
+        """
+        if self.compress:
+            body = gzip_chunks(chunks)
+        else:
+            body = (chunk.encode("utf-8") for chunk in chunks)
+        return self._post(endpoint, body, idempotency_key)
+
+    def post_file(self, endpoint, body_file, idempotency_key=None):
+        """ Streams a gzipped JSON body from ``body_file`` to ``endpoint``.
+            Raises ``RuntimeError`` the same way as ``post``.
+
+        :param: str endpoint: Path of the API endpoint.
+        :param: body_file: Path of the gzipped JSON body.
+        :param: str idempotency_key: Key that lets physaCI ignore repeats
+                                     of the same upload.
+        """
+        opener = open if self.compress else gzip.open
+        with opener(body_file, "rb") as body:
+            return self._post(endpoint, body, idempotency_key)
+
+    def send_board(self, board_payload):
+        """ Sends one board's results as soon as it is done. A failed
+            send is only logged; the board's log is then carried by the
+            final upload instead. Returns whether the send succeeded.
+
+        :param: board_payload: A ``TestResultPayload`` holding only the
+                               board's results.
+        """
+        board_tests = board_payload.node_test_data.board_tests
+        try:
+            self.post(
+                BOARD_ENDPOINT,
+                board_payload.iter_json(
+                    node_name=self.node_name,
+                    check_run_id=self.check_run_id,
+                    partial=True
+                )
+            )
+        except RuntimeError as upload_err:
+            rosiepi_logger.warning(
+                "Failed to send results early for: %s\n%s",
+                ", ".join(board["board_name"] for board in board_tests),
+                upload_err.args[0]
+            )
+            return False
+
+        self.uploaded.update(board["board_name"] for board in board_tests)
+        return True
+
+    def send_final(self, results_payload):
+        """ Sends the complete results, leaving out the logs of boards
+            that were already sent.
+
+        :param: results_payload: The run's ``TestResultPayload``.
+        """
+        return self.post(
+            FINAL_ENDPOINT,
+            results_payload.iter_json(
+                node_name=self.node_name,
+                check_run_id=self.check_run_id,
+                sent_logs=self.uploaded
+            )
+        )
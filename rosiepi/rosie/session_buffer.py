@@ -0,0 +1,169 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+import tempfile
+import threading
+
+# how much of a test's REPL session is kept in memory
+DEFAULT_SESSION_CAP = 1024 * 1024
+
+_READ_CHUNK = 64 * 1024
+
+
+class SessionBuffer():
+    """ Growable capture of a board's REPL session, assigned to
+        ``board.repl.session`` so the REPL's ``session += data`` appends
+        in place instead of copying the whole session on every read.
+
+        Up to ``cap`` bytes are held in memory. Past that the session is
+        spilled to a temporary file, and only the last ``cap`` bytes are
+        kept in memory for excerpts.
+
+    :param: int cap: Most bytes of the session to hold in memory.
+    :param: spill_dir: Directory for the spill file. Defaults to the
+                       system temporary directory.
+    """
+
+    def __init__(self, cap=DEFAULT_SESSION_CAP, spill_dir=None):
+        self.cap = cap
+        self.spill_dir = spill_dir
+        self._buffer = bytearray()
+        self._spill = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def append(self, data):
+        """ Adds ``data`` to the end of the session. """
+        if not data:
+            return
+        with self._lock:
+            self._size += len(data)
+            if self._spill is None and len(self._buffer) + len(data) <= self.cap:
+                self._extend(data)
+                return
+
+            if self._spill is None:
+                self._spill = tempfile.TemporaryFile(
+                    prefix="rosiepi-session-", dir=self.spill_dir
+                )
+                self._spill.write(self._buffer)
+            self._spill.write(data)
+
+            # keep the end of the session in memory, for excerpts
+            self._extend(data[-self.cap:])
+            if len(self._buffer) > self.cap:
+                try:
+                    del self._buffer[:-self.cap]
+                except BufferError:
+                    self._buffer = self._buffer[-self.cap:]
+
+    def _extend(self, data):
+        try:
+            self._buffer += data
+        except BufferError:
+            # a view from ``tail`` or ``view`` is still held; leave it
+            # looking at the old buffer and carry on in a new one
+            self._buffer = self._buffer + data
+
+    def __iadd__(self, data):
+        self.append(data)
+        return self
+
+    def __len__(self):
+        return self._size
+
+    def __bool__(self):
+        return self._size > 0
+
+    @property
+    def spilled(self):
+        """ Whether the session outgrew ``cap`` and was spilled to disk. """
+        return self._spill is not None
+
+    def tail(self, size):
+        """ A ``memoryview`` of the last ``size`` bytes of the session,
+            up to ``cap``, without copying them.
+        """
+        view = memoryview(self._buffer)
+        return view[max(len(view) - size, 0):]
+
+    def view(self, start=0, stop=None):
+        """ A ``memoryview`` of ``session[start:stop]``, without copying.
+            Only the part of the session held in memory can be viewed.
+
+        :raises: IndexError: if the range reaches into spilled bytes.
+        """
+        first = self._size - len(self._buffer)
+        stop = self._size if stop is None else stop
+        if start < 0:
+            start += self._size
+        if stop < 0:
+            stop += self._size
+        if start < first:
+            raise IndexError("Range is no longer held in memory.")
+        return memoryview(self._buffer)[start - first:max(stop - first, 0)]
+
+    def endswith(self, suffix):
+        """ Same as ``bytes.endswith``, for suffixes up to ``cap``. """
+        return self.tail(len(suffix)) == suffix
+
+    def iter_chunks(self, chunk_size=_READ_CHUNK):
+        """ Yields the whole session as ``bytes``, in chunks. """
+        if self._spill is None:
+            for start in range(0, len(self._buffer), chunk_size):
+                yield bytes(self._buffer[start:start + chunk_size])
+            return
+
+        position = 0
+        while True:
+            with self._lock:
+                if self._spill is None:
+                    break
+                self._spill.seek(position)
+                chunk = self._spill.read(chunk_size)
+                self._spill.seek(0, 2)
+            if not chunk:
+                break
+            position += len(chunk)
+            yield chunk
+
+    def getvalue(self):
+        """ The whole session as ``bytes``. """
+        return b"".join(self.iter_chunks())
+
+    def __bytes__(self):
+        return self.getvalue()
+
+    def decode(self, encoding="utf-8", errors="replace"):
+        """ The whole session as text. """
+        return self.getvalue().decode(encoding, errors)
+
+    def close(self):
+        """ Drops the session, removing any spill file. """
+        with self._lock:
+            if self._spill is not None:
+                self._spill.close()
+                self._spill = None
+            self._buffer = bytearray()
+            self._size = 0
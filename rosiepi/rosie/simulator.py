@@ -0,0 +1,514 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+""" A simulated ``pyboard.CPboard``, for exercising and benchmarking
+    ``TestController`` without a physical board. The simulated board runs
+    test code with the host's Python interpreter behind a byte-level
+    emulation of the CircuitPython raw REPL, including raw-paste mode and
+    ``input()``, and moves every byte over a modelled serial link.
+"""
+
+import builtins
+import collections
+import dataclasses
+import struct
+import sys
+import threading
+import time
+import traceback
+
+from tests import pyboard
+
+# lines of test code run between checks for a Ctrl-C from the host
+INTERRUPT_CHECK_LINES = 64
+
+RAW_REPL_BANNER = b"raw REPL; CTRL-B to exit\r\n>"
+SOFT_REBOOT = b"soft reboot\r\n\r\n"
+FRIENDLY_PROMPT = b"\r\n>>> "
+
+
+@dataclasses.dataclass
+class LinkModel():
+    """ Dataclass to contain the timing model of a simulated board.
+
+    :param: float latency: Seconds for a write to reach the other end.
+    :param: float bandwidth: Bytes per second the link carries, each way.
+    :param: float exec_time: Seconds the board spends starting each
+                             command it runs.
+    :param: int paste_window: Raw-paste flow control window, in bytes.
+                              ``0`` simulates firmware without raw-paste.
+    """
+    latency: float = 0.001
+    bandwidth: float = 1000000
+    exec_time: float = 0.0005
+    paste_window: int = 128
+
+
+class _Pipe():
+    """ One direction of the simulated serial link. Written bytes become
+        readable once the model's latency and transfer time have passed.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self._chunks = collections.deque()
+        self._ready = bytearray()
+        self._free_at = 0
+        self._cond = threading.Condition()
+        self.bytes = 0
+
+    def put(self, data):
+        """ Sends ``data`` down the pipe. """
+        if not data:
+            return
+        with self._cond:
+            now = time.monotonic()
+            # bytes queue behind anything still in transfer
+            start = max(now + self.model.latency, self._free_at)
+            self._free_at = start + len(data) / self.model.bandwidth
+            self._chunks.append((self._free_at, bytes(data)))
+            self.bytes += len(data)
+            self._cond.notify_all()
+
+    def _collect(self):
+        now = time.monotonic()
+        while self._chunks and self._chunks[0][0] <= now:
+            self._ready += self._chunks.popleft()[1]
+        if self._chunks:
+            return self._chunks[0][0] - now
+        return None
+
+    def available(self):
+        """ The number of bytes that can be read without waiting. """
+        with self._cond:
+            self._collect()
+            return len(self._ready)
+
+    def get(self, size, timeout):
+        """ Reads up to ``size`` bytes, waiting up to ``timeout`` seconds
+            for the first of them. ``size=None`` reads all ready bytes.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                next_ready = self._collect()
+                if self._ready:
+                    size = len(self._ready) if size is None else size
+                    data = bytes(self._ready[:size])
+                    del self._ready[:size]
+                    return data
+                wait = next_ready
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return b""
+                    wait = remaining if wait is None else min(wait, remaining)
+                self._cond.wait(wait)
+
+
+class SimulatedSerial():
+    """ Host side of the simulated serial link, with the parts of the
+        ``serial.Serial`` interface the REPL uses. Counts the bytes moved
+        and the round trips: each time the host waits on the board after
+        writing to it.
+
+    :param: model: The ``LinkModel`` of the link.
+    :param: float timeout: Default seconds for ``read`` to wait.
+    """
+
+    def __init__(self, model, timeout=1):
+        self.model = model
+        self.timeout = timeout
+        self.to_device = _Pipe(model)
+        self.from_device = _Pipe(model)
+        self._pushback = bytearray()
+        self._wrote = False
+        self.round_trips = 0
+
+    def write(self, data):
+        """ Sends ``data`` to the board. """
+        self.to_device.put(data)
+        self._wrote = True
+        return len(data)
+
+    def _count_turnaround(self):
+        if self._wrote:
+            self.round_trips += 1
+            self._wrote = False
+
+    def _receive(self, size, timeout):
+        """ Takes up to ``size`` bytes off the link, or all that are ready
+            if ``size`` is ``None``, waiting up to ``timeout`` for them.
+        """
+        return self.from_device.get(size, timeout)
+
+    def _available(self):
+        return self.from_device.available()
+
+    def read(self, size=1):
+        """ Reads up to ``size`` bytes, waiting up to ``timeout``. """
+        if self._pushback:
+            data = bytes(self._pushback[:size])
+            del self._pushback[:size]
+            return data
+        self._count_turnaround()
+        return self._receive(size, self.timeout)
+
+    def read_until(self, ending, timeout):
+        """ Reads up to and including ``ending``, leaving anything after
+            it to be read next. Returns what was read by the deadline.
+        """
+        deadline = time.monotonic() + timeout
+        data = bytearray()
+        while True:
+            if not self._pushback:
+                self._count_turnaround()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return bytes(data)
+                self._pushback += self._receive(None, remaining)
+            # search from where ``ending`` could first be complete
+            start = max(len(data) - len(ending) + 1, 0)
+            data += self._pushback
+            self._pushback.clear()
+            found = data.find(ending, start)
+            if found != -1:
+                end = found + len(ending)
+                self._pushback += data[end:]
+                return bytes(data[:end])
+
+    @property
+    def in_waiting(self):
+        """ The number of bytes that can be read without waiting. """
+        return len(self._pushback) + self._available()
+
+    def inWaiting(self): # pylint: disable=invalid-name
+        """ ``in_waiting``, as pyserial's older name that ``pyboard``
+            polls.
+        """
+        return self.in_waiting
+
+    def reset_input_buffer(self):
+        """ Drops anything waiting to be read. """
+        self._pushback.clear()
+        self._receive(None, 0)
+
+
+class _DeviceReset(Exception):
+    """ Raised inside running code when the host interrupts it. """
+
+
+class SimulatedDevice(threading.Thread):
+    """ Board side of the simulated link: a raw REPL that runs what it
+        is sent with the host's Python interpreter.
+
+    :param: serial: The ``SimulatedSerial`` the host talks through.
+    """
+
+    def __init__(self, serial):
+        super().__init__(name="rosiepi-simulated-board", daemon=True)
+        self.serial = serial
+        self.model = serial.model
+        self.raw = False
+        self.namespace = {}
+        self._stopping = False
+        # bytes taken off the link while looking for a Ctrl-C
+        self._pending = bytearray()
+        self._lines_run = 0
+        self.commands = 0
+        self.soft_reset()
+
+    def _send(self, data):
+        self.serial.from_device.put(data)
+
+    def _recv(self):
+        if self._pending:
+            char = bytes(self._pending[:1])
+            del self._pending[:1]
+            return char
+        while not self._stopping:
+            data = self.serial.to_device.get(1, 0.1)
+            if data:
+                return data
+        raise _DeviceReset()
+
+    def stop(self):
+        """ Stops the simulated board. """
+        self._stopping = True
+
+    def soft_reset(self):
+        """ Clears the board's variables, like a soft reboot. """
+        board_builtins = dict(vars(builtins))
+        board_builtins["print"] = self._print
+        board_builtins["input"] = self._input
+        self.namespace = {"__name__": "__main__", "__builtins__": board_builtins}
+
+    def _print(self, *args, sep=" ", end="\n", file=None, flush=False): # pylint: disable=unused-argument,too-many-arguments
+        text = sep.join(str(arg) for arg in args) + end
+        self._send(text.replace("\n", "\r\n").encode("utf-8"))
+
+    def _input(self, prompt=""):
+        if prompt:
+            self._send(str(prompt).encode("utf-8"))
+        line = bytearray()
+        while True:
+            char = self._recv()
+            if char in (b"\r", b"\n"):
+                if line or char == b"\r":
+                    break
+                continue
+            if char == b"\x03":
+                raise KeyboardInterrupt()
+            line += char
+            self._send(char)
+        self._send(b"\r\n")
+        return line.decode("utf-8")
+
+    def _execute(self, code):
+        self.commands += 1
+        if self.model.exec_time:
+            time.sleep(self.model.exec_time)
+        error = b""
+        sys.settrace(self._trace)
+        try:
+            compiled = compile(code.decode("utf-8"), "<stdin>", "exec")
+            exec(compiled, self.namespace) # pylint: disable=exec-used
+        except _DeviceReset:
+            raise
+        except BaseException as exc: # pylint: disable=broad-except
+            error = self._traceback(exc)
+        finally:
+            sys.settrace(None)
+        self._send(b"\x04" + error + b"\x04>")
+
+    def _trace(self, frame, event, arg): # pylint: disable=unused-argument
+        """ Interrupts the test code, like the firmware does, when the
+            host sends a Ctrl-C while it runs.
+        """
+        if frame.f_code.co_filename != "<stdin>":
+            return None
+        if event == "line":
+            self._lines_run += 1
+            if self._lines_run % INTERRUPT_CHECK_LINES == 0:
+                self._check_interrupt()
+        return self._trace
+
+    def _check_interrupt(self):
+        if self._stopping:
+            raise _DeviceReset()
+        if not self.serial.to_device.available():
+            return
+        data = self.serial.to_device.get(None, 0)
+        interrupt = data.find(b"\x03")
+        if interrupt == -1:
+            self._pending += data
+            return
+        self._pending += data[interrupt + 1:]
+        raise KeyboardInterrupt()
+
+    @staticmethod
+    def _traceback(exc):
+        lines = ["Traceback (most recent call last):"]
+        if isinstance(exc, SyntaxError):
+            lines.append(f'  File "<stdin>", line {exc.lineno}')
+        else:
+            for frame in traceback.extract_tb(exc.__traceback__):
+                if frame.filename == "<stdin>":
+                    lines.append(f'  File "<stdin>", line {frame.lineno}, in {frame.name}')
+        message = str(exc)
+        lines.append(type(exc).__name__ + (f": {message}" if message else ""))
+        return ("\r\n".join(lines) + "\r\n").encode("utf-8")
+
+    def _raw_paste(self):
+        window = self.model.paste_window
+        if not window:
+            # firmware without raw-paste answers with the raw banner
+            self._send(b"R\x00")
+            return
+        self._send(b"R\x01" + struct.pack("<H", window))
+        code = bytearray()
+        received = 0
+        while True:
+            char = self._recv()
+            if char == b"\x04":
+                break
+            code += char
+            received += 1
+            if received == window:
+                received = 0
+                self._send(b"\x01")
+        self._send(b"\x04")
+        self._execute(bytes(code))
+
+    def run(self):
+        buffer = bytearray()
+        while not self._stopping:
+            try:
+                char = self._recv()
+                if not self.raw:
+                    if char == b"\x01":
+                        self.raw = True
+                        self._send(RAW_REPL_BANNER)
+                    elif char == b"\x04":
+                        self.soft_reset()
+                        self._send(SOFT_REBOOT + FRIENDLY_PROMPT)
+                    continue
+
+                if char == b"\x01":
+                    buffer.clear()
+                    self._send(RAW_REPL_BANNER)
+                elif char == b"\x02":
+                    buffer.clear()
+                    self.raw = False
+                    self._send(FRIENDLY_PROMPT)
+                elif char == b"\x03":
+                    buffer.clear()
+                elif char == b"\x05" and not buffer:
+                    if self._recv() == b"A" and self._recv() == b"\x01":
+                        self._raw_paste()
+                elif char == b"\x04":
+                    if buffer:
+                        self._send(b"OK")
+                        self._execute(bytes(buffer))
+                        buffer.clear()
+                    else:
+                        self.soft_reset()
+                        self._send(b"OK\r\n" + SOFT_REBOOT + RAW_REPL_BANNER)
+                else:
+                    buffer += char
+            except _DeviceReset:
+                buffer.clear()
+
+
+class SimulatedREPL():
+    """ Stand-in for the ``pyboard`` REPL of a simulated board. Like the
+        real REPL, it talks through its board's ``serial``, so wrapping
+        the board's port covers the REPL too.
+
+    :param: board: The ``SimulatedBoard`` to talk to.
+    """
+
+    def __init__(self, board):
+        self.board = board
+        self.session = b""
+
+    @property
+    def serial(self):
+        """ The board's serial port. """
+        return self.board.serial
+
+    def write(self, data):
+        """ Writes ``data`` to the board. """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.serial.write(data)
+
+    def read_until(self, ending, timeout=10):
+        """ Reads from the board until ``ending``, adding what was read
+            to the session.
+        """
+        data = self.serial.read_until(ending, timeout)
+        self.session += data
+        if not data.endswith(ending):
+            raise pyboard.CPboardError(
+                f"Timed out waiting for {ending!r}; got: {data[-64:]!r}"
+            )
+        return data
+
+    def execute(self, command, wait_for_response=False):
+        """ Writes ``command`` and, if asked, reads to the next prompt. """
+        self.write(command)
+        if wait_for_response:
+            return self.read_until(b">")
+        return b""
+
+    def reset(self):
+        """ Soft resets the board, back to an empty raw REPL. """
+        self.write(b"\x04")
+        self.read_until(RAW_REPL_BANNER)
+
+
+class _SimulatedDisk(): # pylint: disable=too-few-public-methods
+    def __init__(self, path):
+        self.path = path
+
+
+class SimulatedBoard(pyboard.CPboard): # pylint: disable=super-init-not-called
+    """ A ``pyboard.CPboard`` backed by a simulated board, usable anywhere
+        the controller expects a real one.
+
+    :param: str board_name: The board name to report.
+    :param: model: The ``LinkModel`` of the simulated link.
+    :param: str serial_number: The serial number to report.
+    :param: disk_path: The drive path to report.
+    """
+
+    def __init__(self, board_name="simulated", model=None, serial_number="SIM0", # pylint: disable=too-many-arguments
+                 disk_path="/tmp/rosiepi-sim"):
+        self.board_name = board_name
+        self.model = model or LinkModel()
+        self.serial_number = serial_number
+        self.disk = _SimulatedDisk(disk_path)
+        self.bootloader = False
+        self.serial = SimulatedSerial(self.model)
+        self.repl = SimulatedREPL(self)
+        self.device = SimulatedDevice(self.serial)
+        self.device.start()
+
+    @classmethod
+    def factory(cls, model=None, **kwargs):
+        """ A callable for ``TestController``'s ``board_factory`` that
+            connects to a new simulated board.
+        """
+        def connect(board_name, **_):
+            return cls(board_name, model=model, **kwargs)
+        return connect
+
+    def __enter__(self):
+        self.repl.write(b"\x03\x01")
+        self.repl.read_until(RAW_REPL_BANNER)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback): # pylint: disable=redefined-outer-name
+        self.repl.write(b"\x02")
+        try:
+            self.repl.read_until(FRIENDLY_PROMPT, timeout=1)
+        except pyboard.CPboardError:
+            # closing a real board's port doesn't wait on the board either
+            pass
+
+    def close(self):
+        """ Stops the simulated board. """
+        self.device.stop()
+        self.device.join()
+
+    @property
+    def stats(self):
+        """ Traffic counters of the simulated link. """
+        return {
+            "bytes_to_board": self.serial.to_device.bytes,
+            "bytes_from_board": self.serial.from_device.bytes,
+            "round_trips": self.serial.round_trips,
+            "commands": self.device.commands,
+        }
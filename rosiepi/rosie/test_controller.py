@@ -22,22 +22,33 @@
 #
 
 import argparse
+import ast
+import collections
+import contextlib
 import datetime
-import inspect
-from io import StringIO
+import json
 import os
 import pkg_resources
 import re
+import struct
 import sys
+import textwrap
+import time
+import uuid
 
-import importlib
 #pyboard = importlib.import_module(".circuitpython.tests.pyboard",
 #                                  package="rosiepi")
 
 from tests import pyboard
 
 from rosiepi.rosie import find_circuitpython
-from . import cirpy_actions
+from rosiepi.rosie.deadlines import DeadlineClock, Deadlines, guarded
+from rosiepi.rosie.fw_cache import file_digest
+from rosiepi.rosie.result_log import TestResultStream
+from rosiepi.rosie.session_buffer import DEFAULT_SESSION_CAP, SessionBuffer
+from . import (
+    cirpy_actions, fw_identity, replay, test_history, test_plan, timing, verifiers
+)
 
 cli_parser = argparse.ArgumentParser(description="rosiepi Test Controller")
 cli_parser.add_argument(
@@ -73,6 +84,11 @@ def parse_test_interactions(test_file):
                         to use for verification. The function should
                         be prefixed with the module that contains it.
 
+    Deadlines can be annotated the same way, overriding the node's
+    configured limits:
+        - `#$ timeout=`: Seconds the next line of code may run.
+        - `#$ test-timeout=`: Seconds the whole test file may run.
+
     For example:
     ... code: python
 
@@ -88,27 +104,25 @@ def parse_test_interactions(test_file):
             #$ input=\r\n
             input() # only proceed if previous verify passed
     """
-    has_action = re.compile(r"^\#\$\s(input|output|verify)\=(.+$)")
-    interactions = {}
     with open(test_file, 'r') as file:
-        for line_no, line in enumerate(file.readlines(), start=1):
-            check_line = has_action.match(line)
-            if check_line:
-                # interaction key should be the line after the marker
-                # so add 1 to the current line number
-                interactions[(line_no + 1)] = {"action": check_line.group(1),
-                                               "value": check_line.group(2)}
-            else:
-                if line.startswith("#$"):
-                    exc_msg = [
-                        "Improper interaction syntax on",
-                        f"line {line_no} in '{test_file}'",
-                    ]
-                    raise SyntaxWarning(" ".join(exc_msg))
+        interactions, error_lines = test_plan.parse_interactions(
+            file.readlines()
+        )
+    if error_lines:
+        raise SyntaxWarning(interaction_error(test_file, error_lines[0]))
     #print(interactions)
     return interactions
 
 
+def interaction_error(test_file, line_no):
+    """ The message reported for an improper interaction marker. """
+    exc_msg = [
+        "Improper interaction syntax on",
+        f"line {line_no} in '{test_file}'",
+    ]
+    return " ".join(exc_msg)
+
+
 def exec_line(board, command, input=False, echo=True):
     if not isinstance(board, pyboard.CPboard):
         raise ValueError("'board' argument must be of 'pyboard.CPBoard' type.")
@@ -132,45 +146,217 @@ def exec_line(board, command, input=False, echo=True):
         board.repl.read_until(bytes(command, encoding="utf8"))
 
 
+RAW_REPL_PROMPT = b"CTRL-B to exit\r\n>"
+
+
+def _start_raw_paste(board):
+    """ Asks the board to enter raw-paste mode. Returns the flow control
+        window size if raw-paste is supported, or ``None`` if it is not,
+        in which case the board is left in the normal raw REPL.
+    """
+    serial = board.repl.serial
+    board.repl.write(b"\x05A\x01")
+
+    # skip any prompt left over from the previous command
+    reply = serial.read(1)
+    while reply and reply != b"R":
+        reply = serial.read(1)
+    reply += serial.read(1)
+
+    if reply == b"R\x01":
+        return struct.unpack("<H", serial.read(2))[0]
+    if reply != b"R\x00":
+        # firmware without raw-paste re-prints the raw REPL banner
+        board.repl.read_until(RAW_REPL_PROMPT)
+    return None
+
+
+def _raw_paste_write(board, command, window):
+    """ Writes ``command`` using raw-paste flow control: never more than
+        the window the board has room for is in flight at once.
+    """
+    serial = board.repl.serial
+    remaining = window
+    sent = 0
+    while sent < len(command):
+        while remaining == 0 or serial.in_waiting:
+            flow = serial.read(1)
+            if flow == b"\x01":
+                remaining += window
+            elif flow == b"\x04":
+                serial.write(b"\x04")
+                raise pyboard.CPboardError("Board aborted raw-paste transfer.")
+            else:
+                raise pyboard.CPboardError(
+                    f"Unexpected raw-paste flow control byte: {flow}"
+                )
+        chunk = command[sent:sent + remaining]
+        serial.write(chunk)
+        sent += len(chunk)
+        remaining -= len(chunk)
+    serial.write(b"\x04")
+    # the board acknowledges the end of the paste before running it
+    board.repl.read_until(b"\x04")
+
+
+def exec_block(board, command, raw_paste=True):
+    """ Runs a block of code on the board in a single raw REPL
+        transaction, and returns its ``(output, error)``. Raw-paste
+        mode is used when ``raw_paste`` is set and the firmware supports
+        it; otherwise the block is sent as a normal raw REPL command.
+
+        Returns ``(output, error, raw_paste)``, where ``raw_paste`` is
+        whether the firmware supported raw-paste, so callers can skip
+        asking again.
+
+    :param: board: The ``pyboard.CPboard`` to run the code on.
+    :param: str command: The code to run.
+    :param: bool raw_paste: Whether to try raw-paste mode.
+    """
+    if not isinstance(board, pyboard.CPboard):
+        raise ValueError("'board' argument must be of 'pyboard.CPBoard' type.")
+    command = bytes(command, encoding="utf-8")
+
+    window = _start_raw_paste(board) if raw_paste else None
+    if window is not None:
+        _raw_paste_write(board, command, window)
+    else:
+        board.repl.write(command)
+        board.repl.write(b"\x04")
+        board.repl.read_until(b"OK")
+
+    output = board.repl.read_until(b"\x04")[:-1]
+    error = board.repl.read_until(b"\x04")[:-1]
+    return output, error, window is not None
+
+
+def interrupt_board(board, timeout):
+    """ Interrupts whatever the board is running with Ctrl-C, and waits
+        for it to return to an empty raw REPL.
+
+    :param: board: The ``pyboard.CPboard`` to interrupt.
+    :param: float timeout: Seconds to wait for the board to answer.
+    """
+    board.repl.write(b"\x03\x03\x01")
+    board.repl.read_until(RAW_REPL_PROMPT, timeout=timeout)
+
+
+def soft_reset_board(board, timeout):
+    """ Soft resets the board from the raw REPL, for when interrupting it
+        was not enough, and waits for the raw REPL to return.
+
+    :param: board: The ``pyboard.CPboard`` to reset.
+    :param: float timeout: Seconds to wait for the board to answer.
+    """
+    interrupt_board(board, timeout)
+    board.repl.write(b"\x04")
+    board.repl.read_until(b"soft reboot", timeout=timeout)
+    board.repl.read_until(RAW_REPL_PROMPT, timeout=timeout)
+
+
+# bytes of the REPL session shown with a failed test
+SESSION_EXCERPT = 512
+
+_RESULT_MARKER = "\x1erosiepi-result:"
+
+# runs the script in a function, so it can't clobber the test's names
+_SCRIPT_WRAPPER = """
+def _rosiepi_script():
+    result = None
+{body}
+    return result
+try:
+    import json as _rosiepi_json
+    print({marker!r} + _rosiepi_json.dumps(_rosiepi_script()))
+except ImportError:
+    print({marker!r} + repr(_rosiepi_script()))
+del _rosiepi_script
+"""
+
+def exec_script(board, script, raw_paste=True, **params):
+    """ Runs ``script`` on the board in a single transaction, and returns
+        the value the script assigned to ``result``, decoded on the host.
+        Lets a verifier do all of its on-board work in one round trip
+        instead of one ``exec_line`` per step. The script runs in its own
+        function scope, so it doesn't change the test's variables.
+
+        The result is sent back as JSON, so it should be built from
+        dicts, lists, strings, numbers, booleans and ``None``. Firmware
+        without the ``json`` module sends its ``repr`` instead, which is
+        decoded the same way.
+
+    :param: board: The ``pyboard.CPboard`` to run the script on.
+    :param: str script: Code that assigns its outcome to ``result``.
+    :param: bool raw_paste: Whether to try raw-paste mode.
+    :param: params: Values to define as variables before the script runs.
+                    They must be representable with ``repr``.
+    """
+    preamble = "".join(f"{name} = {value!r}\n" for name, value in params.items())
+    body = textwrap.indent(preamble + textwrap.dedent(script), "    ")
+    output, error, _ = exec_block(
+        board,
+        _SCRIPT_WRAPPER.format(body=body, marker=_RESULT_MARKER),
+        raw_paste=raw_paste
+    )
+    if error:
+        raise pyboard.CPboardError(str(error, encoding="utf-8"))
+
+    output = str(output, encoding="utf-8")
+    marker_at = output.rfind(_RESULT_MARKER)
+    if marker_at == -1:
+        raise pyboard.CPboardError(f"Script returned no result: {output!r}")
+    encoded = output[marker_at + len(_RESULT_MARKER):].strip()
+    try:
+        return json.loads(encoded)
+    except ValueError:
+        return ast.literal_eval(encoded)
+
+
+_ERROR_LINE = re.compile(rb'File "<stdin>", line (\d+)')
+
+def error_line_offset(error):
+    """ Returns the line of a block that raised ``error``, counted from
+        1, using the innermost ``<stdin>`` frame of the traceback. Returns
+        ``None`` when the traceback doesn't name a line.
+    """
+    found = _ERROR_LINE.findall(error)
+    if not found:
+        return None
+    return int(found[-1])
+
+
 class TestObject():
     """ Container to hold test information.
 
     :param: str test_file: Path to the test file
+    :param: plan: The file's compiled ``test_plan.TestPlan``. Loaded from
+                  the test plan cache if not supplied.
     """
 
-    def __init__(self, test_file):
+    def __init__(self, test_file, plan=None):
         if not os.path.exists(test_file):
             raise FileNotFoundError(f"'{test_file}' was not found.")
         path_split = os.path.split(test_file)
         self.test_dir = path_split[0]
         self.test_file = path_split[1]
-        self.interactions = parse_test_interactions(test_file)
+        if plan is None:
+            plan = test_plan.load_test_plan(test_file)
+            if plan.error_lines:
+                raise SyntaxWarning(
+                    interaction_error(test_file, plan.error_lines[0])
+                )
+        self.plan = plan
+        self.interactions = plan.interactions
         self.repl_session = ""
         self.test_result = None
+        # failed attempts on this firmware, counting an earlier run's
+        self.failures = 0
+        # passed, but only after failing
+        self.flaky = False
+        # result taken from an earlier run, instead of running again
+        self.carried_over = False
 
 
-class TestResultStream(StringIO):
-    """ Container for handling test result output, sending to
-        both the stdout (print) and retaining the stream for
-        logging and database usage.
-    """
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-
-    def write(self, data, quiet=True):
-        """ Override StringIO's write command so that we can also
-            print to stdout.
-        """
-        if isinstance(data, bytes):
-            data = str(data, encoding="utf-8")
-
-        if not quiet:
-            print(data)
-
-        if data[-1:] != "\n":
-            data = data + "\n"
-        super().write(data)
-
 class TestController():
     """ Main class to handle testing operations.
 
@@ -178,15 +364,74 @@ class TestController():
                    an available board in `circuitpython/tools/cpboard.py`.
     :param: build_ref: A reference to the tag/commit to test. This will
                        usually be generated by the GitHub Checks API.
+    :param: fw_cache: An optional ``fw_cache.FirmwareCache`` used to
+                      reuse previously built firmware.
+    :param: worktree_pool: An optional ``worktrees.WorktreePool`` to build
+                           firmware in.
+    :param: build_settings: An optional ``cirpy_actions.BuildSettings`` to
+                            build firmware with.
+    :param: device_watcher: An optional ``device_watch.DeviceWatcher`` used
+                            to wait on the board while updating firmware.
+    :param: flash_record: An optional ``fw_identity.FlashRecord``. When
+                          supplied, boards already running the requested
+                          firmware are not rebuilt or reflashed.
+    :param: log_dir: An optional directory to write the run's log file to.
+    :param: int session_cap: Most bytes of each test's REPL session to
+                             hold in memory; the rest is spilled to disk.
+    :param: board_factory: Callable that connects to the board, given its
+                           name. Defaults to ``pyboard.CPboard.from_try_all``;
+                           ``simulator.SimulatedBoard.factory()`` connects
+                           to a simulated board instead.
+    :param: tests_dir: Directory to gather the tests from. Defaults to
+                       circuitpython's ``tests/circuitpython/rosie_tests``.
+    :param: capture_dir: An optional directory to record the serial traffic
+                         of each test run to, for replay with
+                         ``replay.ReplayBoard``.
+    :param: board_index: An optional ``board_index.BoardIndex`` used to
+                         connect to the board without a full scan when
+                         it is where it was last found.
+    :param: deadlines: An optional ``deadlines.Deadlines`` limiting how
+                       long lines, tests and the whole board may run.
+    :param: int retries: Times to run a failed test again. A test that
+                         passes on a retry is counted as flaky.
+    :param: test_history: An optional ``test_history.TestHistory`` the
+                          board's results are recorded in.
+    :param: bool rerun_failed: Only run the tests that did not pass in the
+                               board's last recorded run of ``build_ref``.
+                               Requires ``test_history``.
     """
-    def __init__(self, board, build_ref):
-        self.state = "init"
+    def __init__(self, board, build_ref, fw_cache=None, worktree_pool=None, # pylint: disable=too-many-arguments,too-many-locals
+                 build_settings=None, device_watcher=None, flash_record=None,
+                 log_dir=None, session_cap=None, board_factory=None,
+                 tests_dir=None, capture_dir=None, board_index=None,
+                 deadlines=None, retries=0, test_history=None,
+                 rerun_failed=False):
+        self.error_state = None
+        self._state = "init"
         self.run_date = datetime.datetime.now().strftime("%d-%b-%Y,%H:%M:%S%Z")
         self.build_ref = build_ref
         self.board_name = board
+        self.fw_cache = fw_cache
+        self.worktree_pool = worktree_pool
+        self.build_settings = build_settings
+        self.device_watcher = device_watcher
+        self.flash_record = flash_record
+        self.board_index = board_index
+        self.deadlines = deadlines or Deadlines()
+        self.retries = retries
+        self.test_history = test_history
+        self.rerun_failed = rerun_failed
+        self.fw_build_dir = None
+        self.session_cap = session_cap or DEFAULT_SESSION_CAP
+        self.tests_dir = tests_dir
+        self.capture_dir = capture_dir
+        # whether the firmware supports raw-paste; tried until it says no
+        self.raw_paste = True
         self.tests_run = 0
         self.tests_passed = 0
         self.tests_failed = 0
+        self.tests_flaky = 0
+        self.tests = []
         init_msg = [
             "="*25 + " RosiePi " + "="*26,
             "Initiating rosiepi...",
@@ -198,14 +443,18 @@ class TestController():
             f"Connecting to: {board}",
             "-"*60
         ]
-        self.log = TestResultStream()
+        self.log = TestResultStream(board, log_dir=log_dir)
         self.log.write("\n".join(init_msg))
 
         try:
             kwargs = {
                 'wait': 20,
             }
-            self.board = pyboard.CPboard.from_try_all(board, **kwargs)
+            connect = board_factory or pyboard.CPboard.from_try_all
+            if board_factory is None and board_index is not None:
+                connect = board_index.connect
+            with timing.span(self.log, "connect"):
+                self.board = connect(board, **kwargs)
             init_msg = [
                 "Connected!",
                 "Board info:",
@@ -225,22 +474,75 @@ class TestController():
             self.log.write("\n".join(err_msg))
             self.state = "error"
 
-    def start_test(self):
-        self.state = "starting_fw_prep"
+    def firmware_current(self):
+        """ Whether the board is already running the firmware for
+            ``build_ref``, according to the node's flash record and the
+            board's ``boot_out.txt``.
+        """
+        if self.flash_record is None or self.state == "error":
+            return False
+
+        try:
+            commit = cirpy_actions.resolve_commit(self.build_ref)
+        except RuntimeError:
+            return False
+
+        return self.flash_record.matches(
+            self.board.serial_number,
+            commit,
+            cirpy_actions.fw_cache_key(
+                commit,
+                self.board_name,
+                cirpy_actions.board_build_flags(self.board_name)
+            ),
+            fw_identity.read_boot_out(self.board.disk.path)
+        )
+
+    def prepare_firmware(self, fw_build=None):
+        """ Builds the firmware, or takes it from ``fw_build``, and
+            updates the board with it.
+
+        :param: fw_build: An optional ``concurrent.futures.Future`` from
+                          ``cirpy_actions.ParallelBuild`` holding firmware
+                          that was built ahead of time. If not supplied,
+                          the firmware is built here.
+        """
         self.log.write("Preparing Firmware...")
         self.log.write("-"*60)
         try:
-            self.fw_build_dir = cirpy_actions.build_fw(self.board_name, self.build_ref, self.log)
+            if fw_build is None:
+                self.fw_build_dir = cirpy_actions.build_fw(
+                    self.board_name,
+                    self.build_ref,
+                    self.log,
+                    fw_cache=self.fw_cache,
+                    worktree_pool=self.worktree_pool,
+                    build_settings=self.build_settings
+                )
+            else:
+                with timing.span(self.log, "build_wait"):
+                    self.fw_build_dir, build_log = fw_build.result()
+                if build_log.lines:
+                    self.log.write(build_log.getvalue())
+                self.log.timings.extend(build_log.timings)
             self.log.write("="*60)
 
             self.log.write(f"Updating Firmware on: {self.board_name}")
-            cirpy_actions.update_fw(
-                self.board,
-                self.board_name,
-                os.path.join(self.fw_build_dir, "firmware.uf2"),
-                self.log
-            )
-            self.log.write("="*60)
+            if self.flash_record is not None:
+                self.flash_record.forget(self.board.serial_number)
+            with self._firmware_file(self.fw_build_dir) as fw_path:
+                with timing.span(self.log, "flash"):
+                    cirpy_actions.update_fw(
+                        self.board,
+                        self.board_name,
+                        fw_path,
+                        self.log,
+                        device_watcher=self.device_watcher,
+                        board_index=self.board_index
+                    )
+                self.log.write("="*60)
+
+                self._record_flash(fw_path)
         except RuntimeError as fw_err:
             err_msg = [
                 f"Failed update firmware on: {self.board_name}",
@@ -253,74 +555,397 @@ class TestController():
             #raise RuntimeError("\n".join(err_msg)) from None
         #print(self.board.firmware.info)
 
+    @contextlib.contextmanager
+    def _firmware_file(self, fw_dir):
+        """ Context manager yielding the path of the ``firmware.uf2`` in
+            ``fw_dir``. When it is in the firmware cache, it is pinned so
+            it can't be evicted while the board is flashed with it.
+        """
+        if self.fw_cache is None:
+            yield os.path.join(fw_dir, "firmware.uf2")
+            return
+        with self.fw_cache.pinned(fw_dir) as fw_file:
+            if fw_file is None:
+                raise RuntimeError(
+                    f"Firmware in {fw_dir} was evicted from the cache."
+                )
+            yield str(fw_file)
+
+    def _record_flash(self, fw_path):
+        """ Records in the node's flash record that the board now runs
+            the firmware at ``fw_path``.
+        """
+        if self.flash_record is None:
+            return
+
+        commit = cirpy_actions.resolve_commit(self.build_ref)
+        self.flash_record.update(
+            self.board.serial_number,
+            commit,
+            cirpy_actions.fw_cache_key(
+                commit,
+                self.board_name,
+                cirpy_actions.board_build_flags(self.board_name)
+            ),
+            file_digest(fw_path),
+            fw_identity.read_boot_out(self.board.disk.path)
+        )
+
+    def start_test(self, fw_build=None):
+        """ Gathers and validates the tests, prepares the firmware,
+            updates the board, and runs the tests. The build and update
+            are skipped when the board is already running the firmware
+            for ``build_ref``.
+
+        :param: fw_build: An optional ``concurrent.futures.Future`` from
+                          ``cirpy_actions.ParallelBuild`` holding firmware
+                          that was built ahead of time. If not supplied,
+                          the firmware is built here.
+        """
+        self.state = "gather_tests"
+        self.log.write("Gathering tests to run...")
+        with timing.span(self.log, "gather_tests"):
+            tests_ready = self.prepare_tests()
+        if not tests_ready:
+            return
+        if self.rerun_failed:
+            self.select_failed_tests()
+
+        self.state = "starting_fw_prep"
+        with timing.span(self.log, "firmware_check"):
+            firmware_current = self.firmware_current()
+        if firmware_current:
+            self.log.write(
+                f"{self.board_name} is already running firmware for "
+                f"{self.build_ref}. Skipping build and update."
+            )
+            self.log.write("="*60)
+        else:
+            self.prepare_firmware(fw_build)
+
         if self.state != "error":
-            self.state = "gather_tests"
-            self.log.write("Gathering tests to run...")
-            self.tests = self.gather_tests()
             init_msg = [
                 "The following tests will be run:",
-                " - " + ", ".join([test.test_file for test in self.tests]),
+                " - " + ", ".join(
+                    [test.test_file for test in self.tests if not test.carried_over]
+                ),
                 "="*60,
             ]
             self.log.write("\n".join(init_msg))
 
             self.state = "running_tests"
-            self.run_tests()
+            with timing.span(self.log, "run_tests"):
+                self.run_tests()
             self.log.write("="*60)
+            self.record_history()
+
+    def prepare_tests(self):
+        """ Gathers the tests and checks that every verifier they use is
+            registered, so that a bad test is caught before the board is
+            flashed. Returns whether the tests are ready to run.
+        """
+        try:
+            self.tests = self.gather_tests()
+        except SyntaxWarning as syntax_err:
+            err_msg = [
+                "Test files have improper interaction syntax:",
+                syntax_err.args[0],
+            ]
+            self.log.write("\n".join(err_msg))
+            self.state = "error"
+            return False
+
+        missing = verifiers.missing_verifiers(
+            name for test in self.tests for name in test.plan.verifiers
+        )
+        if missing:
+            err_msg = [
+                "Tests use verifiers that are not registered:",
+                " - " + "\n - ".join(missing),
+            ]
+            self.log.write("\n".join(err_msg))
+            self.state = "error"
+            return False
+
+        return True
+
+    def select_failed_tests(self):
+        """ Narrows the tests to run down to those that did not pass in
+            the board's last recorded run of ``build_ref``. The others
+            keep their recorded result. Every test is run when there is
+            no recorded run.
+        """
+        previous = None
+        if self.test_history is not None:
+            try:
+                commit = cirpy_actions.resolve_commit(self.build_ref)
+                previous = self.test_history.get(commit, self.board_name)
+            except RuntimeError:
+                previous = None
+        if previous is None:
+            self.log.write(
+                f"No earlier results for {self.board_name} at "
+                f"{self.build_ref}. Running every test."
+            )
+            return
+
+        for test in self.tests:
+            status = previous.get(test.test_file)
+            if status in (test_history.PASSED, test_history.FLAKY):
+                test.test_result = True
+                test.flaky = status == test_history.FLAKY
+                test.carried_over = True
+            elif status == test_history.FAILED:
+                test.failures = 1
+
+        carried = [test.test_file for test in self.tests if test.carried_over]
+        self.log.write(
+            f"Rerunning the tests that did not pass on {self.board_name} at "
+            f"{self.build_ref}. Keeping {len(carried)} earlier results."
+        )
+
+    def record_history(self):
+        """ Records the results of the tests that were run in the node's
+            test history, so that a rerun can run only those that did
+            not pass.
+        """
+        if self.test_history is None:
+            return
+        try:
+            commit = cirpy_actions.resolve_commit(self.build_ref)
+        except RuntimeError:
+            return
+        self.test_history.record(
+            commit,
+            self.board_name,
+            [test for test in self.tests if not test.carried_over]
+        )
 
     def gather_tests(self):
-        """ Gathers all tests in `circuitpython/tests/circuitpython/rosie_tests`
-            and returns a list of `TestObject`s.
+        """ Gathers all tests in ``tests_dir``, by default
+            `circuitpython/tests/circuitpython/rosie_tests`, and returns
+            a list of `TestObject`s. Improper interaction syntax
+            in any of the files is reported for all of them at once.
         """
-        rosie_tests_dir = os.path.join(cp_tests_dir(),
-                                       "circuitpython",
-                                       "rosie_tests")
+        rosie_tests_dir = self.tests_dir
+        if rosie_tests_dir is None:
+            rosie_tests_dir = os.path.join(cp_tests_dir(),
+                                           "circuitpython",
+                                           "rosie_tests")
         test_files = []
-        for test in os.scandir(rosie_tests_dir):
+        syntax_errors = []
+        for test in sorted(os.scandir(rosie_tests_dir), key=lambda entry: entry.name):
             # TODO: implement exclusions by board
             if test.path.endswith(".py"):
-                test_files.append(TestObject(test.path))
+                plan = test_plan.load_test_plan(test.path)
+                syntax_errors.extend(
+                    interaction_error(test.path, line_no)
+                    for line_no in plan.error_lines
+                )
+                test_files.append(TestObject(test.path, plan=plan))
+
+        if syntax_errors:
+            raise SyntaxWarning("\n".join(syntax_errors))
 
         return test_files
 
 
+    def _recording(self, board):
+        """ Records the board's serial traffic to ``capture_dir``, along
+            with the tests being run, if a ``capture_dir`` was given.
+        """
+        if self.capture_dir is None:
+            return contextlib.nullcontext()
+
+        os.makedirs(self.capture_dir, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        # several runs of the same board can start within a second
+        capture_file = os.path.join(
+            self.capture_dir,
+            f"{self.board_name}-{stamp}-{uuid.uuid4().hex[:8]}.capture.jsonl.gz"
+        )
+        self.log.write(f"Recording serial traffic to: {capture_file}")
+        return replay.recording(
+            board,
+            capture_file,
+            board=self.board_name,
+            build_ref=self.build_ref,
+            tests={test.test_file: "".join(test.plan.lines) for test in self.tests}
+        )
+
     def run_tests(self):
-        """ Runs the tests in self.tests.
+        """ Runs the tests in self.tests. A test that runs past one of
+            its deadlines, or stops answering, fails, and the board is
+            recovered before the next test is started. Failed tests are
+            run again up to ``retries`` times.
         """
         total_tests = len(self.tests)
-        this_test_passed = True
-
-        with self.board as board:
-            board.repl.session = b""
+        clock = DeadlineClock()
+        clock.start("board", self.deadlines.board)
+        pending = collections.deque(
+            test for test in self.tests if not test.carried_over
+        )
+        self._run_pending(pending, clock)
+
+        if pending:
+            if clock.passed("board"):
+                reason = f"Board deadline of {self.deadlines.board:g}s exceeded."
+            else:
+                reason = f"{self.board_name} could not be recovered."
+            skip_msg = [
+                reason,
+                f"Skipped {len(pending)} tests:",
+                " - " + ", ".join(test.test_file for test in pending),
+            ]
+            self.log.write("\n".join(skip_msg))
 
-            for test in self.tests:
-                # we likely had a REPL reset, so make sure we're
-                # past the "press any key" prompt.
-                board.repl.execute(b"\x01", wait_for_response=True)
+        for attempt in range(1, self.retries + 1):
+            if self.state == "error" or clock.passed("board"):
+                break
+            retry = collections.deque(
+                test for test in self.tests if test.test_result == False
+            )
+            if not retry:
+                break
+            self.log.write(
+                f"Retrying {len(retry)} failed tests "
+                f"(attempt {attempt} of {self.retries})..."
+            )
+            self.log.write("-"*60)
+            self._run_pending(retry, clock)
 
-                this_test_passed = True
+        for test in self.tests:
+            if test.test_result == None:
+                continue
+            self.tests_run += 1
+            if test.test_result == True:
+                if test.flaky:
+                    self.tests_flaky += 1
+                else:
+                    self.tests_passed += 1
+            elif test.test_result == False:
+                self.tests_failed += 1
 
-                self.log.write(f"Starting test: {test.test_file}")
+        end_msg = [
+            f"Ran {self.tests_run} of {total_tests} tests.",
+            f"Passed: {self.tests_passed}",
+            f"Flaky: {self.tests_flaky}",
+            f"Failed: {self.tests_failed}",
+        ]
+        carried = [test for test in self.tests if test.carried_over]
+        if carried:
+            end_msg.append(f"Results kept from the earlier run: {len(carried)}")
+        self.log.write("\n".join(end_msg))
 
-                test_file_path = os.path.join(test.test_dir, test.test_file)
-                test_cmds = []
+    def _run_pending(self, pending, clock):
+        """ Runs the tests in ``pending``, recovering the board after any
+            test that leaves it hung. Tests left in ``pending`` were not
+            run, because the board deadline passed or the board could not
+            be recovered.
 
-                with open(test_file_path, 'r') as current_test:
-                    test_cmds = current_test.readlines()
+        :param: pending: A ``collections.deque`` of ``TestObject``s.
+        :param: clock: The run's ``deadlines.DeadlineClock``.
+        """
+        while pending and self.state != "error" and not clock.passed("board"):
+            recovered = True
+            with self.board as board, self._recording(board):
+                while pending and not clock.passed("board"):
+                    test = pending.popleft()
+                    if not self._run_test(board, test, clock):
+                        recovered = self.recover(board)
+                        if not recovered:
+                            break
+
+            if not recovered and not self.reflash():
+                self.state = "error"
+
+    def _run_test(self, board, test, clock): # pylint: disable=too-many-branches,too-many-statements
+        """ Runs one test under its line and test deadlines. Returns
+            whether the board is still answering afterwards; if it is
+            not, it has to be recovered before the next test.
+
+        :param: board: The connected ``pyboard.CPboard``.
+        :param: test: The ``TestObject`` to run.
+        :param: clock: The run's ``deadlines.DeadlineClock``.
+        """
+        # each test gets its own capture, bounded by session_cap
+        board.repl.session = SessionBuffer(cap=self.session_cap)
+        test_start = time.monotonic()
+        this_test_passed = True
+        responsive = True
+        clock.expired = None
 
-                for line_no, line in enumerate(test_cmds, start=1):
-                    if line == "\n":
-                        continue
+        self.log.write(f"Starting test: {test.test_file}")
 
-                    self.log.write(
-                        "running line: ({0}) {1}".format(line_no,
-                                                         line.rstrip('\n'))
+        test_timeout = test.plan.test_timeout or self.deadlines.test
+        with guarded(board, clock), clock.limit("test", test_timeout):
+            try:
+                # we likely had a REPL reset, so make sure we're
+                # past the "press any key" prompt.
+                board.repl.execute(b"\x01", wait_for_response=True)
+            except (pyboard.CPboardError, TimeoutError) as start_err:
+                this_test_passed = False
+                responsive = False
+                self.log.write(f"Test Failed!\n - Board did not answer: {start_err}")
+
+            steps = test.plan.steps
+            if self.deadlines.line is not None:
+                # the line deadline applies to each statement, so blocks
+                # are run a statement at a time
+                steps = [
+                    statement for step in steps
+                    for statement in test_plan.statement_steps(step)
+                ]
+
+            if responsive:
+                for step in steps:
+                    line_no = step.line_no
+                    line = step.lines[0]
+
+                    line_timeout = test.plan.line_timeouts.get(
+                        step.line_no, self.deadlines.line
                     )
+                    with timing.span(self.log, "line", f"{test.test_file}:{line_no}"), \
+                            clock.limit("line", line_timeout):
+                        try:
+                            if step.action is None:
+                                self.log.write(
+                                    "\n".join(
+                                        "running line: ({0}) {1}".format(
+                                            block_line_no, block_line.rstrip('\n')
+                                        )
+                                        for block_line_no, block_line in enumerate(
+                                            step.lines, start=step.line_no
+                                        )
+                                    )
+                                )
 
-                    try:
-                        if line_no in test.interactions:
-                            action = test.interactions[line_no]["action"]
-                            value = test.interactions[line_no]["value"]
+                                _, error, self.raw_paste = exec_block(
+                                    board,
+                                    "".join(step.lines),
+                                    raw_paste=self.raw_paste
+                                )
+                                if error:
+                                    # point the failure at the line that raised
+                                    offset = error_line_offset(error)
+                                    if offset is not None and offset <= len(step.lines):
+                                        line_no = step.line_no + offset - 1
+                                        line = step.lines[offset - 1]
+                                    else:
+                                        line = step.lines[-1]
+                                        line_no = step.line_no + len(step.lines) - 1
+                                    raise pyboard.CPboardError(
+                                        str(error, encoding="utf-8")
+                                    )
+                                continue
+
+                            self.log.write(
+                                "running line: ({0}) {1}".format(line_no,
+                                                                 line.rstrip('\n'))
+                            )
+
+                            action = step.action
+                            value = step.value
                             #print(f"ACTION: {action}; VALUE: {value}")
                             if action == "output":
                                 self.log.write(
@@ -352,22 +977,7 @@ class TestController():
                                 self.log.write(f"- Verifying with: {value}")
 
                                 try:
-                                    # import the referenced module
-                                    module_name, func_name = value.split(".")
-                                    imprt_stmt = [".verifiers.", module_name]
-                                    verifier = importlib.import_module(
-                                        "".join(imprt_stmt),
-                                        package="rosiepi.rosie"
-                                    )
-
-                                    # now get the function object using inspect
-                                    # so that we can dynamically run it.
-                                    ver_func = [
-                                        func[1] for func in
-                                        inspect.getmembers(verifier)
-                                        if func[0] == func_name
-                                    ][0]
-                                    #self.log.write(ver_func)
+                                    ver_func = verifiers.get_verifier(value)
 
                                     exec_line(board, line)
                                     result = ver_func(board)
@@ -380,46 +990,140 @@ class TestController():
 
                                 self.log.write(" - Passed!")
 
-                        else:
-                            board.repl.execute(line)
-
-                    except pyboard.CPboardError as line_err:
-                        this_test_passed = False
-                        err_args = [str(arg) for arg in line_err.args]
-                        err_msg = [
-                            "Test Failed!",
-                            " - Last code executed: '{}'".format(line.strip('\n')),
-                            f" - Line: {line_no}",
-                            f" - Exception: {''.join(err_args)}",
-                        ]
-                        self.log.write("\n".join(err_msg))
-                        break
+                        except (pyboard.CPboardError, TimeoutError) as line_err:
+                            this_test_passed = False
+                            # a deadline or a silent board leaves it mid-command
+                            if clock.expired is not None or isinstance(line_err, TimeoutError):
+                                responsive = False
+                            line_range = str(line_no)
+                            if not responsive and len(test_plan.statement_steps(step)) > 1:
+                                # the block was cut off somewhere inside
+                                line = "".join(step.lines)
+                                line_range = "{}-{}".format(
+                                    step.line_no, step.line_no + len(step.lines) - 1
+                                )
+                            err_args = [str(arg) for arg in line_err.args]
+                            err_msg = [
+                                "Test Failed!",
+                                " - Last code executed: '{}'".format(line.strip('\n')),
+                                f" - Line: {line_range}",
+                                f" - Exception: {''.join(err_args)}",
+                            ]
+                            with board.repl.session.tail(SESSION_EXCERPT) as excerpt:
+                                if excerpt:
+                                    err_msg.extend([
+                                        f" - REPL output (last {len(excerpt)} bytes):",
+                                        str(excerpt, encoding="utf-8", errors="replace"),
+                                    ])
+                            self.log.write("\n".join(err_msg))
+                            break
 
                     if this_test_passed != True:
                         break
 
-                test.test_result = this_test_passed
-                self.tests_run += 1
-                test.repl_session = board.repl.session
-                #print(board.repl.session)
-                self.log.write("-"*60)
-                board.repl.reset()
+        test.test_result = this_test_passed
+        if not this_test_passed:
+            test.failures += 1
+        elif test.failures:
+            test.flaky = True
+            self.log.write(f"{test.test_file} passed after failing. Marked flaky.")
+        self.log.timings.add(
+            "test", test_start, time.monotonic() - test_start, test.test_file
+        )
+        test.repl_session = board.repl.session
+        #print(board.repl.session)
+        self.log.write("-"*60)
+        if responsive:
+            with timing.span(self.log, "repl_reset"):
+                try:
+                    board.repl.reset()
+                except (pyboard.CPboardError, TimeoutError):
+                    responsive = False
+        return responsive
+
+    def recover(self, board):
+        """ Brings a board that stopped answering back to an empty raw
+            REPL: first by interrupting what it runs, then by soft
+            resetting it. The time spent in each tier is recorded as a
+            ``recovery_<tier>`` timing. Returns whether the board answered;
+            if it did not, it needs ``reflash``.
+
+        :param: board: The connected ``pyboard.CPboard``.
+        """
+        tiers = (
+            ("interrupt", interrupt_board),
+            ("soft_reset", soft_reset_board),
+        )
+        for tier, action in tiers:
+            self.log.write(f"Recovering {self.board_name}: {tier.replace('_', ' ')}...")
+            with timing.span(self.log, f"recovery_{tier}"):
+                try:
+                    action(board, self.deadlines.recovery)
+                except (pyboard.CPboardError, TimeoutError) as recovery_err:
+                    self.log.write(f" - Board did not answer: {recovery_err}")
+                    continue
+            self.log.write(" - Board recovered.")
+            return True
+        return False
+
+    def reflash(self):
+        """ Resets the board into its bootloader and flashes the firmware
+            under test again, for when ``recover`` could not reach it. The
+            time spent is recorded as a ``recovery_reflash`` timing.
+            Returns whether the board came back.
+        """
+        fw_dir = self.fw_build_dir
+        if fw_dir is None:
+            try:
+                commit = cirpy_actions.resolve_commit(self.build_ref)
+                fw_dir = cirpy_actions.check_fw_cache(
+                    self.board_name, commit, self.log, self.fw_cache
+                )
+            except RuntimeError:
+                fw_dir = None
+        if fw_dir is None:
+            self.log.write(
+                f"Recovering {self.board_name}: no firmware to reflash with."
+            )
+            return False
+
+        self.log.write(f"Recovering {self.board_name}: reflash...")
+        with timing.span(self.log, "recovery_reflash"):
+            try:
+                if self.flash_record is not None:
+                    self.flash_record.forget(self.board.serial_number)
+                with self._firmware_file(fw_dir) as fw_path:
+                    # a board that ignores Ctrl-C won't run the REPL reset
+                    # either
+                    cirpy_actions.update_fw(
+                        self.board,
+                        self.board_name,
+                        fw_path,
+                        self.log,
+                        device_watcher=self.device_watcher,
+                        board_index=self.board_index,
+                        repl_reset=False
+                    )
+                    self._record_flash(fw_path)
+            except RuntimeError as fw_err:
+                self.log.write(f" - Reflash failed:\n{fw_err.args[0]}")
+                return False
+        self.log.write(" - Board recovered.")
+        return True
 
-        for test in self.tests:
-            if test.test_result == None:
-                continue
-            elif test.test_result == True:
-                self.tests_passed += 1
-            elif test.test_result == False:
-                self.tests_failed += 1
 
-        end_msg = [
-            f"Ran {self.tests_run} of {total_tests} tests.",
-            f"Passed: {self.tests_passed}",
-            f"Failed: {self.tests_failed}",
-        ]
-        self.log.write("\n".join(end_msg))
+    @property
+    def state(self):
+        """ The controller's current state. Once set to ``"error"``, the
+            state the error happened in is kept in ``error_state``.
+        """
+        return self._state
 
+    @state.setter
+    def state(self, value):
+        if value == "error" and self._state != "error":
+            self.error_state = self._state
+        self._state = value
 
     @property
     def result(self):
@@ -448,4 +1152,6 @@ def main():
     #print(tc.result)
     #print()
     #print("tc's stream log:")
-    print(tc.log.getvalue())
+    tc.log.close()
+    for text in tc.log.iter_text():
+        print(text, end="")
@@ -0,0 +1,132 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+
+""" Node-side history of each board's test results by commit, so that a
+    rerun of a check can run only the tests that did not pass.
+"""
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import pathlib
+import time
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+DEFAULT_HISTORY_FILE = pathlib.Path.home() / ".cache" / "rosiepi" / "test_history.json"
+
+# commit and board results kept before the oldest are dropped
+DEFAULT_MAX_ENTRIES = 200
+
+PASSED = "passed"
+FAILED = "failed"
+FLAKY = "flaky"
+SKIPPED = "skipped"
+
+
+def test_status(test):
+    """ The status recorded for a ``TestObject``: ``"passed"``,
+        ``"failed"``, ``"flaky"`` if it only passed on a retry, or
+        ``"skipped"`` if it did not run.
+    """
+    if test.test_result is None:
+        return SKIPPED
+    if not test.test_result:
+        return FAILED
+    return FLAKY if test.flaky else PASSED
+
+
+class TestHistory():
+    """ Record of the test results of each board at each commit, keyed
+        by ``<commit>:<board name>``. Each entry maps the board's test
+        files to their status from ``test_status``.
+
+    :param: history_file: Path to the JSON file holding the history.
+    :param: int max_entries: Most commit and board results to keep.
+    """
+
+    def __init__(self, history_file=None, max_entries=DEFAULT_MAX_ENTRIES):
+        self.history_file = pathlib.Path(history_file or DEFAULT_HISTORY_FILE)
+        self.history_file.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with open(self.history_file.with_suffix(".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                records = {}
+                if self.history_file.exists():
+                    try:
+                        with open(self.history_file, "r") as file:
+                            records = json.load(file)
+                    except ValueError:
+                        rosiepi_logger.warning(
+                            "Discarding unreadable test history: %s",
+                            self.history_file
+                        )
+                yield records
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _save(self, records):
+        tmp_file = self.history_file.with_suffix(".tmp")
+        with open(tmp_file, "w") as file:
+            json.dump(records, file, indent=1)
+        os.replace(tmp_file, self.history_file)
+
+    def get(self, commit, board_name):
+        """ The test statuses last recorded for ``board_name`` at
+            ``commit``, keyed by test file, or ``None``.
+        """
+        with self._locked() as records:
+            record = records.get(f"{commit}:{board_name}")
+        if record is None:
+            return None
+        return record["tests"]
+
+    def record(self, commit, board_name, tests):
+        """ Records the results of a board's run. Tests already recorded
+            for the commit and board that are not in ``tests`` keep their
+            status, so a partial rerun updates the earlier results.
+
+        :param: str commit: The commit that was tested.
+        :param: str board_name: The name of the board.
+        :param: tests: The ``TestObject``s that were run.
+        """
+        with self._locked() as records:
+            key = f"{commit}:{board_name}"
+            record = records.pop(key, {"tests": {}})
+            record["tests"].update(
+                {test.test_file: test_status(test) for test in tests}
+            )
+            record["recorded_at"] = time.time()
+            # the newest entry goes last, so the oldest are dropped first
+            records[key] = record
+            for stale in list(records)[:-self.max_entries]:
+                del records[stale]
+            self._save(records)
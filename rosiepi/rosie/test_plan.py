@@ -0,0 +1,327 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import ast
+import collections
+import contextlib
+import dataclasses
+import hashlib
+import io
+import json
+import logging
+import os
+import pathlib
+import re
+import tempfile
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+DEFAULT_CACHE_DIR = pathlib.Path.home() / ".cache" / "rosiepi" / "test_plans"
+
+# bump when the stored plan layout changes, so stale plans are ignored
+PLAN_FORMAT = 3
+
+HAS_ACTION = re.compile(r"^\#\$\s(input|output|verify)\=(.+$)")
+HAS_TIMEOUT = re.compile(r"^\#\$\s(timeout|test-timeout)\=(.+$)")
+
+
+TestStep = collections.namedtuple("TestStep", ["line_no", "lines", "action", "value"])
+TestStep.__doc__ = """ A step of a test file. Plain code is grouped into a
+    single block step, with ``action`` set to ``None``; each line with an
+    interaction marker is a step of its own, and so is each statement
+    with a ``#$ timeout=`` marker. ``line_no`` is the file line number of
+    the step's first line.
+"""
+
+
+def parse_interactions(test_lines):
+    """ Finds the interaction markers in the lines of a test file.
+        Returns ``(interactions, error_lines)``: the interactions keyed
+        by the line number they apply to, and the line numbers of any
+        markers with improper syntax.
+
+    :param: test_lines: The lines of the test file.
+    """
+    interactions = {}
+    error_lines = []
+    for line_no, line in enumerate(test_lines, start=1):
+        check_line = HAS_ACTION.match(line)
+        if check_line:
+            # interaction key should be the line after the marker
+            # so add 1 to the current line number
+            interactions[(line_no + 1)] = {"action": check_line.group(1),
+                                           "value": check_line.group(2)}
+        elif line.startswith("#$") and not HAS_TIMEOUT.match(line):
+            error_lines.append(line_no)
+    return interactions, error_lines
+
+
+def parse_timeouts(test_lines):
+    """ Finds the deadline markers in the lines of a test file:
+
+        - ``#$ timeout=<seconds>`` limits the statement starting on the
+          next line of code, after any other markers, to that many
+          seconds.
+        - ``#$ test-timeout=<seconds>`` limits the whole test file.
+
+        Returns ``(line_timeouts, test_timeout, error_lines)``: the line
+        limits keyed by the line number they apply to, the test's limit
+        or ``None``, and the line numbers of markers with a bad value.
+
+    :param: test_lines: The lines of the test file.
+    """
+    line_timeouts = {}
+    test_timeout = None
+    error_lines = []
+    pending = None
+    for line_no, line in enumerate(test_lines, start=1):
+        check_line = HAS_TIMEOUT.match(line)
+        if check_line:
+            try:
+                seconds = float(check_line.group(2))
+            except ValueError:
+                error_lines.append(line_no)
+                continue
+            if seconds <= 0:
+                error_lines.append(line_no)
+            elif check_line.group(1) == "test-timeout":
+                test_timeout = seconds
+            else:
+                pending = seconds
+        elif pending is not None and not line.startswith("#$") and line.strip():
+            line_timeouts[line_no] = pending
+            pending = None
+    return line_timeouts, test_timeout, error_lines
+
+
+def statement_steps(step):
+    """ Splits a block step into a step for each of its top-level
+        statements, so each can be run, and timed, on its own. Other
+        steps, and blocks that don't parse, are returned whole.
+
+    :param: step: The ``TestStep`` to split.
+    """
+    if step.action is not None or len(step.lines) == 1:
+        return [step]
+    try:
+        body = ast.parse("".join(step.lines)).body
+    except SyntaxError:
+        return [step]
+
+    starts = [
+        min([node.lineno] + [dec.lineno for dec in getattr(node, "decorator_list", [])])
+        for node in body
+    ]
+    steps = []
+    for start, end in zip(starts, starts[1:] + [len(step.lines) + 1]):
+        lines = step.lines[start - 1:end - 1]
+        # comments and blank lines between statements add nothing
+        while len(lines) > 1 and (
+                not lines[-1].strip() or lines[-1].lstrip().startswith("#")):
+            lines.pop()
+        steps.append(TestStep(step.line_no + start - 1, lines, None, None))
+    return steps or [step]
+
+
+def group_test_steps(test_lines, interactions, line_timeouts=None):
+    """ Splits the lines of a test file into ``TestStep``s. Consecutive
+        lines without an interaction are grouped so they can be sent to
+        the board in one transaction, while interaction lines, and the
+        statements that ``line_timeouts`` apply to, stay separate
+        synchronization points.
+
+    :param: test_lines: The lines of the test file.
+    :param: interactions: The interactions from ``parse_interactions``.
+    :param: line_timeouts: The line limits from ``parse_timeouts``.
+    """
+    line_timeouts = line_timeouts or {}
+    steps = []
+    block_start = None
+    block = []
+
+    def end_block():
+        # trailing blank lines add nothing to the block
+        while block and not block[-1].strip():
+            block.pop()
+        if block:
+            step = TestStep(block_start, list(block), None, None)
+            if block_start in line_timeouts:
+                # the timed statement is a step of its own
+                timed, *rest = statement_steps(step)
+                steps.append(timed)
+                if rest:
+                    offset = rest[0].line_no - block_start
+                    steps.append(
+                        TestStep(rest[0].line_no, step.lines[offset:], None, None)
+                    )
+            else:
+                steps.append(step)
+        block.clear()
+
+    for line_no, line in enumerate(test_lines, start=1):
+        if line_no in interactions:
+            end_block()
+            steps.append(
+                TestStep(
+                    line_no,
+                    [line],
+                    interactions[line_no]["action"],
+                    interactions[line_no]["value"]
+                )
+            )
+        elif line.startswith("#$"):
+            # interaction markers only matter to the following line
+            end_block()
+        else:
+            if line_no in line_timeouts:
+                end_block()
+            if not block:
+                if not line.strip():
+                    continue
+                block_start = line_no
+            block.append(line)
+    end_block()
+
+    return steps
+
+
+@dataclasses.dataclass
+class TestPlan():
+    """ Dataclass to contain a compiled test file, ready to run.
+
+    :param: source_hash: SHA256 of the test file's contents.
+    :param: lines: The ordered lines of the test file.
+    :param: interactions: The interactions, keyed by line number.
+    :param: steps: The ``TestStep``s to run, in order.
+    :param: verifiers: The ``module.function`` verifiers the test uses.
+    :param: error_lines: Line numbers of improper interaction markers.
+    :param: line_timeouts: Seconds allowed for the statement starting on
+                           each line, from ``#$ timeout=`` markers.
+    :param: test_timeout: Seconds allowed for the whole test, from a
+                          ``#$ test-timeout=`` marker.
+    """
+    source_hash: str
+    lines: list
+    interactions: dict
+    steps: list
+    verifiers: list
+    error_lines: list = dataclasses.field(default_factory=list)
+    line_timeouts: dict = dataclasses.field(default_factory=dict)
+    test_timeout: float = None
+
+    def to_json(self):
+        """ Serializes the plan for the on-disk cache. """
+        plan = dataclasses.asdict(self)
+        plan["format"] = PLAN_FORMAT
+        plan["steps"] = [list(step) for step in self.steps]
+        return json.dumps(plan)
+
+    @classmethod
+    def from_json(cls, plan_json):
+        """ Loads a plan stored with ``to_json``. Returns ``None`` if it
+            was stored in an older format.
+        """
+        plan = json.loads(plan_json)
+        if plan.pop("format", None) != PLAN_FORMAT:
+            return None
+        plan["interactions"] = {
+            int(line_no): action
+            for line_no, action in plan["interactions"].items()
+        }
+        plan["line_timeouts"] = {
+            int(line_no): seconds
+            for line_no, seconds in plan["line_timeouts"].items()
+        }
+        plan["steps"] = [TestStep(*step) for step in plan["steps"]]
+        return cls(**plan)
+
+
+def compile_test_plan(source, source_hash):
+    """ Compiles the text of a test file into a ``TestPlan``.
+
+    :param: str source: The contents of the test file.
+    :param: str source_hash: SHA256 of ``source``.
+    """
+    # read the lines the same way a text mode ``readlines()`` would
+    lines = io.StringIO(source, newline=None).readlines()
+    interactions, error_lines = parse_interactions(lines)
+    line_timeouts, test_timeout, timeout_errors = parse_timeouts(lines)
+    verifiers = sorted({
+        action["value"] for action in interactions.values()
+        if action["action"] == "verify"
+    })
+    return TestPlan(
+        source_hash=source_hash,
+        lines=lines,
+        interactions=interactions,
+        steps=group_test_steps(lines, interactions, line_timeouts),
+        verifiers=verifiers,
+        error_lines=sorted(error_lines + timeout_errors),
+        line_timeouts=line_timeouts,
+        test_timeout=test_timeout,
+    )
+
+
+def load_test_plan(test_file, cache_dir=None):
+    """ Returns the ``TestPlan`` for ``test_file``, compiling it only if
+        a plan for the file's exact contents isn't already cached.
+
+    :param: test_file: Path to the test file.
+    :param: cache_dir: Directory holding cached plans.
+    """
+    cache_dir = pathlib.Path(cache_dir or DEFAULT_CACHE_DIR)
+    with open(test_file, "rb") as file:
+        source = file.read()
+    source_hash = hashlib.sha256(source).hexdigest()
+
+    plan_file = cache_dir / f"{source_hash}.json"
+    if plan_file.exists():
+        try:
+            plan = TestPlan.from_json(plan_file.read_text())
+            if plan is not None:
+                return plan
+        except (ValueError, TypeError, KeyError):
+            rosiepi_logger.warning("Discarding unreadable test plan: %s",
+                                   plan_file)
+
+    plan = compile_test_plan(str(source, encoding="utf-8"), source_hash)
+
+    # every board thread may be storing the same plan at once, so each
+    # writes its own temporary file. A plan that can't be stored is only
+    # compiled again next time.
+    tmp_name = None
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=cache_dir, suffix=".tmp",
+                                         delete=False) as tmp_file:
+            tmp_name = tmp_file.name
+            tmp_file.write(plan.to_json())
+        os.replace(tmp_name, plan_file)
+    except OSError as cache_err:
+        rosiepi_logger.warning("Could not cache test plan %s: %s",
+                               plan_file, cache_err)
+        if tmp_name is not None:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_name)
+
+    return plan
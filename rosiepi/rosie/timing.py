@@ -0,0 +1,121 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+import collections
+import contextlib
+import dataclasses
+import time
+
+# phases recorded too often to send every span of; only their totals are sent
+SUMMARY_ONLY_PHASES = ("line",)
+
+
+@dataclasses.dataclass
+class Span():
+    """ Dataclass to contain one timed phase.
+
+    :param: str phase: Name of the phase.
+    :param: float start: ``time.monotonic()`` when the phase started.
+    :param: float duration: Seconds the phase took.
+    :param: str detail: What the phase was working on, if anything.
+    """
+    phase: str
+    start: float
+    duration: float
+    detail: str = None
+
+
+class PhaseTimings():
+    """ Collects monotonic-clock spans for the phases of a board's run.
+        The monotonic clock is shared by every process on the node, so
+        spans timed by build workers can be merged in with ``extend``.
+    """
+
+    def __init__(self):
+        self.origin = time.monotonic()
+        self.spans = []
+
+    def add(self, phase, start, duration, detail=None):
+        """ Records a phase that was timed elsewhere. """
+        self.spans.append(Span(phase, start, duration, detail))
+
+    @contextlib.contextmanager
+    def span(self, phase, detail=None):
+        """ Times the ``with`` block as ``phase``. """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(phase, start, time.monotonic() - start, detail)
+
+    def extend(self, other):
+        """ Adds the spans of another ``PhaseTimings``. """
+        self.spans.extend(other.spans)
+
+    def summary(self):
+        """ The count, total and longest seconds of each phase. """
+        phases = collections.OrderedDict()
+        for span_ in self.spans:
+            phase = phases.setdefault(
+                span_.phase, {"count": 0, "total": 0.0, "max": 0.0}
+            )
+            phase["count"] += 1
+            phase["total"] += span_.duration
+            phase["max"] = max(phase["max"], span_.duration)
+        for phase in phases.values():
+            phase["total"] = round(phase["total"], 6)
+            phase["max"] = round(phase["max"], 6)
+        return dict(phases)
+
+    def to_dict(self):
+        """ The phase summary and the individual spans, with start times
+            relative to when the timings began, for the result payload.
+        """
+        return {
+            "phases": self.summary(),
+            "spans": [
+                {
+                    "phase": span_.phase,
+                    "start": round(span_.start - self.origin, 6),
+                    "duration": round(span_.duration, 6),
+                    "detail": span_.detail,
+                }
+                for span_ in sorted(self.spans, key=lambda span_: span_.start)
+                if span_.phase not in SUMMARY_ONLY_PHASES
+            ],
+        }
+
+
+def span(test_log, phase, detail=None):
+    """ Times the ``with`` block as ``phase`` in the timings of
+        ``test_log``. Does nothing for logs that don't keep timings.
+
+    :param: test_log: The ``TestController.log`` or ``BuildLog`` of the run.
+    :param: str phase: Name of the phase.
+    :param: str detail: What the phase is working on, if anything.
+    """
+    timings = getattr(test_log, "timings", None)
+    if timings is None:
+        return contextlib.nullcontext()
+    return timings.span(phase, detail)
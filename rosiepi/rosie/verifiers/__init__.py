@@ -0,0 +1,71 @@
+""" Verifiers are host-side functions that a rosie test can call with a
+    ``#$ verify=<module>.<function>`` marker. Each verifier is passed the
+    ``pyboard.CPboard`` under test and returns whether the check passed.
+
+    Verifiers are registered with the ``register`` decorator in any
+    module of this package, or by other packages through the
+    ``rosiepi.verifiers`` entry point group, where the entry point name
+    is the ``module.function`` name tests refer to it by.
+"""
+
+import importlib
+import logging
+import pkgutil
+
+import pkg_resources
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+ENTRY_POINT_GROUP = "rosiepi.verifiers"
+
+_REGISTRY = {}
+_discovered = False # pylint: disable=invalid-name
+
+
+def register(func):
+    """ Decorator that registers ``func`` as a verifier, under the name
+        ``<module>.<function>``.
+    """
+    module_name = func.__module__.rpartition(".")[2]
+    _REGISTRY[f"{module_name}.{func.__name__}"] = func
+    return func
+
+
+def discover():
+    """ Imports every verifier module and loads the verifier entry
+        points, indexing all verifiers. Runs once; later calls return
+        the existing index.
+    """
+    global _discovered # pylint: disable=global-statement,invalid-name
+    if _discovered:
+        return _REGISTRY
+
+    for module_info in pkgutil.iter_modules(__path__):
+        importlib.import_module(f"{__name__}.{module_info.name}")
+
+    for entry_point in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP):
+        try:
+            _REGISTRY[entry_point.name] = entry_point.load()
+        except Exception: # pylint: disable=broad-except
+            rosiepi_logger.warning("Failed to load verifier entry point: %s",
+                                   entry_point)
+
+    _discovered = True
+    return _REGISTRY
+
+
+def get_verifier(name):
+    """ Returns the verifier registered as ``name``.
+
+    :param: str name: The ``module.function`` name of the verifier.
+    """
+    try:
+        return discover()[name]
+    except KeyError:
+        raise LookupError(f"No verifier named '{name}' is registered.") from None
+
+
+def missing_verifiers(names):
+    """ Returns the names in ``names`` that no verifier is registered as. """
+    registry = discover()
+    return sorted(name for name in set(names) if name not in registry)
@@ -0,0 +1,226 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import pathlib
+import shutil
+import time
+import uuid
+
+import sh
+from sh.contrib import git
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+DEFAULT_POOL_DIR = pathlib.Path.home() / ".fw_builds" / "worktrees"
+DEFAULT_MAX_AGE = 7 * 24 * 60 * 60
+DEFAULT_MAX_SIZE = 20 * 1024 * 1024 * 1024
+
+
+def _dir_size(path):
+    """ Total size, in bytes, of the files under ``path``. """
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _live_leases(leases):
+    """ Drops leases held by processes that no longer exist. """
+    return [
+        lease_id for lease_id in leases
+        if _pid_alive(int(lease_id.split(":")[0]))
+    ]
+
+
+class WorktreePool():
+    """ Pool of git worktrees of the local circuitpython clone, one per
+        commit. Worktrees are leased while a build uses them, reused
+        when the same commit is built again, and garbage collected by
+        age and total disk use once they are no longer leased.
+
+    :param: repo_dir: Path to the circuitpython clone the worktrees
+                      are created from.
+    :param: pool_dir: Directory to hold the worktrees.
+    :param: int max_age: Seconds an unused worktree is kept for.
+    :param: int max_size: Disk budget for all worktrees, in bytes.
+    :param: mirror: An optional ``git_mirror.GitMirror`` that the clone
+                    and the worktrees' submodules borrow objects from.
+    """
+
+    def __init__(self, repo_dir, pool_dir=None, max_age=DEFAULT_MAX_AGE, # pylint: disable=too-many-arguments
+                 max_size=DEFAULT_MAX_SIZE, mirror=None):
+        self.repo_dir = pathlib.Path(repo_dir)
+        self.mirror = mirror
+        self.pool_dir = pathlib.Path(pool_dir or DEFAULT_POOL_DIR)
+        self.max_age = max_age
+        self.max_size = max_size
+        self.index_file = self.pool_dir / "index.json"
+        self._lock_file = self.pool_dir / ".lock"
+        self.pool_dir.mkdir(parents=True, exist_ok=True)
+
+    @contextlib.contextmanager
+    def _locked_index(self):
+        with open(self._lock_file, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                index = {}
+                if self.index_file.exists():
+                    with open(self.index_file, "r") as file:
+                        index = json.load(file)
+                yield index
+                tmp_file = self.index_file.with_suffix(".tmp")
+                with open(tmp_file, "w") as file:
+                    json.dump(index, file, indent=1)
+                os.replace(tmp_file, self.index_file)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def worktree_dir(self, commit):
+        """ The directory the worktree for ``commit`` lives in. """
+        return self.pool_dir / commit
+
+    def _git(self, *args, cwd=None):
+        return git(*args, _cwd=str(cwd or self.repo_dir))
+
+    def has_commit(self, commit):
+        """ Whether the clone already has the objects for ``commit``. """
+        try:
+            self._git("cat-file", "-e", f"{commit}^{{commit}}")
+        except sh.ErrorReturnCode:
+            return False
+        return True
+
+    def _add_worktree(self, commit):
+        worktree = self.worktree_dir(commit)
+        if worktree.exists():
+            # left over from an interrupted lease; start clean.
+            self._remove_worktree(commit)
+        rosiepi_logger.info("Adding worktree for %s", commit)
+        self._git("worktree", "add", "--detach", str(worktree), commit)
+
+    def _remove_worktree(self, commit):
+        worktree = self.worktree_dir(commit)
+        rosiepi_logger.info("Removing worktree for %s", commit)
+        try:
+            self._git("worktree", "remove", "--force", str(worktree))
+        except sh.ErrorReturnCode:
+            shutil.rmtree(worktree, ignore_errors=True)
+            self._git("worktree", "prune")
+
+    @contextlib.contextmanager
+    def lease(self, commit):
+        """ Leases the worktree for ``commit``, creating it if needed.
+            Yields a ``(worktree_dir, is_new)`` tuple; ``is_new`` is
+            ``False`` when an existing worktree for the commit is reused,
+            in which case its submodules are already in place.
+
+        :param: str commit: The full SHA to check out. Its objects must
+                            already be in the clone.
+        """
+        lease_id = f"{os.getpid()}:{uuid.uuid4().hex}"
+        while True:
+            with self._locked_index() as index:
+                entry = index.get(commit)
+                if entry is not None:
+                    entry["leases"] = _live_leases(entry["leases"])
+                # wait while another build is still populating the worktree
+                populating = (
+                    entry is not None and not entry["ready"] and entry["leases"]
+                )
+
+                if not populating:
+                    is_new = entry is None or not entry["ready"]
+                    if is_new:
+                        self._add_worktree(commit)
+                        entry = {"ready": False, "size": 0, "leases": []}
+                        index[commit] = entry
+                    entry["leases"].append(lease_id)
+                    entry["last_used"] = time.time()
+                    break
+            time.sleep(1)
+
+        try:
+            yield self.worktree_dir(commit), is_new
+            # only mark the worktree reusable once the lease holder
+            # finished with it without error.
+            with self._locked_index() as index:
+                index[commit]["ready"] = True
+        finally:
+            size = _dir_size(self.worktree_dir(commit))
+            with self._locked_index() as index:
+                entry = index[commit]
+                if lease_id in entry["leases"]:
+                    entry["leases"].remove(lease_id)
+                entry["last_used"] = time.time()
+                entry["size"] = size
+                self._collect(index)
+
+    def _collect(self, index):
+        """ Removes unleased worktrees older than ``max_age``, then the
+            least recently used ones until the pool fits ``max_size``.
+        """
+        now = time.time()
+        idle = []
+        for commit, entry in index.items():
+            entry["leases"] = _live_leases(entry["leases"])
+            if not entry["leases"]:
+                idle.append(commit)
+
+        for commit in list(idle):
+            if now - index[commit]["last_used"] > self.max_age:
+                self._remove_worktree(commit)
+                index.pop(commit)
+                idle.remove(commit)
+
+        total = sum(entry["size"] for entry in index.values())
+        idle.sort(key=lambda commit: index[commit]["last_used"])
+        for commit in idle:
+            if total <= self.max_size:
+                break
+            total -= index[commit]["size"]
+            self._remove_worktree(commit)
+            index.pop(commit)
+
+    def collect(self):
+        """ Runs garbage collection on the pool outside of a lease. """
+        with self._locked_index() as index:
+            self._collect(index)
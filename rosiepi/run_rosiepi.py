@@ -29,18 +29,34 @@ with open(ACTIVATE_THIS) as file_:
 
 # pylint: disable=wrong-import-position
 import argparse
+import concurrent.futures
+import contextlib
 import dataclasses
 import datetime
 import logging
 import json
+import re
 import traceback
 
 from configparser import ConfigParser
 from socket import gethostname
 
-import requests
-
-from .rosie import test_controller
+from .rosie import cirpy_actions, test_controller
+from .rosie import find_circuitpython
+from .rosie.board_index import BoardIndex
+from .rosie.deadlines import Deadlines
+from .rosie.device_watch import DeviceWatcher
+from .rosie.fw_cache import FirmwareCache
+from .rosie.fw_identity import FlashRecord
+from .rosie.git_mirror import GitMirror
+from .rosie.job_budget import JobBudget
+from .rosie.metrics import NodeMetrics
+from .rosie.result_log import TestResultStream, prune_logs
+from .rosie.outbox import ResultOutbox
+from .rosie.pipeline import TestPipeline
+from .rosie.result_upload import ResultUploader
+from .rosie.test_history import TestHistory
+from .rosie.worktrees import WorktreePool
 
 # pylint: disable=invalid-name
 rosiepi_logger = logging.getLogger(__name__)
@@ -54,6 +70,15 @@ cli_parser.add_argument(
     "check_run_id",
     help="ID of the check run that requested the test"
 )
+cli_parser.add_argument(
+    "--rerun-failed",
+    action="store_true",
+    default=None,
+    help=(
+        "Only run the tests that did not pass in each board's last run "
+        "of the commit."
+    )
+)
 
 
 # TODO: update to adafruit github
@@ -93,6 +118,337 @@ class PhysaCIConfig():
         board_list = [board.strip() for board in boards.split(",")]
         return board_list
 
+    @property
+    def fw_cache_dir(self):
+        """ Directory holding the firmware build cache. """
+        return self.config.get("rosie_pi", "fw_cache_dir", fallback=None)
+
+    @property
+    def fw_cache_max_size(self):
+        """ Disk budget for the firmware build cache, in bytes. Configured
+            in megabytes.
+        """
+        max_mb = self.config.getint("rosie_pi", "fw_cache_max_mb", fallback=2048)
+        return max_mb * 1024 * 1024
+
+    @property
+    def build_jobs(self):
+        """ The most firmware builds to run at the same time. Defaults to
+            the number of CPUs when not configured.
+        """
+        return self.config.getint("rosie_pi", "build_jobs", fallback=None)
+
+    @property
+    def worktree_dir(self):
+        """ Directory holding the pool of circuitpython worktrees. """
+        return self.config.get("rosie_pi", "worktree_dir", fallback=None)
+
+    @property
+    def worktree_max_age(self):
+        """ Seconds an unused worktree is kept for. Configured in hours. """
+        max_hours = self.config.getint("rosie_pi", "worktree_max_age_hours",
+                                       fallback=168)
+        return max_hours * 60 * 60
+
+    @property
+    def worktree_max_size(self):
+        """ Disk budget for the worktree pool, in bytes. Configured
+            in megabytes.
+        """
+        max_mb = self.config.getint("rosie_pi", "worktree_max_mb",
+                                    fallback=20480)
+        return max_mb * 1024 * 1024
+
+    @property
+    def git_mirror(self):
+        """ Whether to keep local mirrors of circuitpython and its
+            submodules to build from.
+        """
+        return self.config.getboolean("rosie_pi", "git_mirror", fallback=True)
+
+    @property
+    def git_mirror_dir(self):
+        """ Directory holding the local git mirrors. """
+        return self.config.get("rosie_pi", "git_mirror_dir", fallback=None)
+
+    @property
+    def git_upstream(self):
+        """ URL of the circuitpython repository to mirror. Defaults to
+            the local clone's ``origin``, which commits are resolved on.
+        """
+        return self.config.get("rosie_pi", "git_upstream", fallback=None)
+
+    @property
+    def use_ccache(self):
+        """ Whether to compile firmware through ccache. """
+        return self.config.getboolean("rosie_pi", "ccache", fallback=True)
+
+    @property
+    def make_jobs(self):
+        """ The node-wide budget of ``make`` jobs shared by all builds.
+            Defaults to the number of CPUs when not configured.
+        """
+        return self.config.getint("rosie_pi", "make_jobs", fallback=None)
+
+    @property
+    def device_timeouts(self):
+        """ Seconds to wait on each of a board's USB transitions while
+            updating firmware, as keyword arguments for ``DeviceWatcher``.
+        """
+        return {
+            "bootloader_timeout": self.config.getfloat(
+                "rosie_pi", "bootloader_timeout", fallback=30
+            ),
+            "flush_timeout": self.config.getfloat(
+                "rosie_pi", "flush_timeout", fallback=60
+            ),
+            "reboot_timeout": self.config.getfloat(
+                "rosie_pi", "reboot_timeout", fallback=30
+            ),
+        }
+
+    @property
+    def board_index(self):
+        """ Whether to keep an index of where each board was last found,
+            to connect to boards without a full scan.
+        """
+        return self.config.getboolean("rosie_pi", "board_index", fallback=True)
+
+    @property
+    def board_index_file(self):
+        """ File holding the node's board index. """
+        return self.config.get("rosie_pi", "board_index_file", fallback=None)
+
+    @property
+    def board_index_wait(self):
+        """ Most seconds to wait for an indexed board at its last known
+            port before scanning for it.
+        """
+        return self.config.getfloat("rosie_pi", "board_index_wait", fallback=5)
+
+    @property
+    def test_history_file(self):
+        """ File holding each board's test results by commit. """
+        return self.config.get("rosie_pi", "test_history_file", fallback=None)
+
+    @property
+    def test_retries(self):
+        """ Times to run a failed test again. Tests that pass on a retry
+            are reported as flaky.
+        """
+        return self.config.getint("rosie_pi", "test_retries", fallback=0)
+
+    @property
+    def rerun_failed(self):
+        """ Whether to only run the tests that did not pass in a board's
+            last run of the commit, when there is one.
+        """
+        return self.config.getboolean("rosie_pi", "rerun_failed",
+                                      fallback=False)
+
+    @property
+    def log_dir(self):
+        """ Directory holding the compressed test run logs. """
+        return self.config.get("rosie_pi", "log_dir", fallback=None)
+
+    @property
+    def log_max_age(self):
+        """ Seconds a test run log is kept for. Configured in days. """
+        max_days = self.config.getint("rosie_pi", "log_max_age_days",
+                                      fallback=7)
+        return max_days * 24 * 60 * 60
+
+    @property
+    def session_cap(self):
+        """ Most bytes of each test's REPL session to hold in memory.
+            Configured in kilobytes.
+        """
+        cap_kb = self.config.getint("rosie_pi", "session_cap_kb",
+                                    fallback=1024)
+        return cap_kb * 1024
+
+    @property
+    def incremental_upload(self):
+        """ Whether to send each board's results as soon as it finishes. """
+        return self.config.getboolean("rosie_pi", "incremental_upload",
+                                      fallback=True)
+
+    @property
+    def compress_uploads(self):
+        """ Whether to gzip the results sent to physaCI. """
+        return self.config.getboolean("rosie_pi", "compress_uploads",
+                                      fallback=True)
+
+    @property
+    def outbox_dir(self):
+        """ Directory holding results waiting to be sent to physaCI. """
+        return self.config.get("rosie_pi", "outbox_dir", fallback=None)
+
+    @property
+    def outbox_drain_timeout(self):
+        """ Seconds to wait at the end of a run for queued results to be
+            sent. Anything left is sent by the next run.
+        """
+        return self.config.getfloat("rosie_pi", "outbox_drain_timeout",
+                                    fallback=300)
+
+    @property
+    def capture_dir(self):
+        """ Directory to record each board's serial traffic to, for
+            replaying later. Nothing is recorded when not configured.
+        """
+        return self.config.get("rosie_pi", "capture_dir", fallback=None)
+
+    @property
+    def metrics_textfile(self):
+        """ The ``.prom`` file to write the node's metrics to, for the
+            Prometheus node exporter's textfile collector. Metrics aren't
+            exported when not configured.
+        """
+        return self.config.get("rosie_pi", "metrics_textfile", fallback=None)
+
+    @property
+    def metrics_state_file(self):
+        """ File holding the node's metric totals between runs. """
+        return self.config.get("rosie_pi", "metrics_state_file", fallback=None)
+
+    @property
+    def metrics_port(self):
+        """ Local port the node daemon serves its metrics on. Metrics are
+            only served on the daemon's socket when not configured.
+        """
+        return self.config.getint("rosie_pi", "metrics_port", fallback=None)
+
+    @property
+    def daemon_socket(self):
+        """ Unix socket the node daemon takes test jobs on. """
+        return self.config.get("rosie_pi", "daemon_socket", fallback=None)
+
+    @property
+    def daemon_max_queued(self):
+        """ The most jobs the node daemon holds waiting to run. """
+        return self.config.getint("rosie_pi", "daemon_max_queued", fallback=32)
+
+    @property
+    def build_ahead(self):
+        """ The most commits the node daemon builds ahead of the one the
+            boards are testing.
+        """
+        return self.config.getint("rosie_pi", "build_ahead", fallback=1)
+
+    @property
+    def concurrent_tests(self):
+        """ Whether to run each board's tests at the same time. """
+        return self.config.getboolean("rosie_pi", "concurrent_tests",
+                                      fallback=True)
+
+    @property
+    def line_timeout(self):
+        """ Seconds each line of a test may run. Unlimited when not
+            configured.
+        """
+        return self.config.getfloat("rosie_pi", "line_timeout", fallback=None)
+
+    @property
+    def test_timeout(self):
+        """ Seconds each test file may run. """
+        return self.config.getfloat("rosie_pi", "test_timeout", fallback=300)
+
+    @property
+    def board_timeout(self):
+        """ Seconds all of a board's tests may run. Unlimited when not
+            configured.
+        """
+        return self.config.getfloat("rosie_pi", "board_timeout", fallback=None)
+
+    @property
+    def recovery_timeout(self):
+        """ Seconds each tier of recovering a hung board waits for it. """
+        return self.config.getfloat("rosie_pi", "recovery_timeout",
+                                    fallback=10)
+
+    @property
+    def deadlines(self):
+        """ The ``Deadlines`` to run each board's tests under. """
+        return Deadlines(
+            line=self.line_timeout,
+            test=self.test_timeout,
+            board=self.board_timeout,
+            recovery=self.recovery_timeout,
+        )
+
+@dataclasses.dataclass
+class NodeResources(): # pylint: disable=too-many-instance-attributes
+    """ Dataclass to contain the node's state that is shared by test runs,
+        so that a long-running node keeps its caches, mirrors and board
+        records warm between runs.
+
+    :param: fw_cache: The node's ``FirmwareCache``.
+    :param: worktree_pool: The ``WorktreePool`` firmware is built in.
+    :param: build_settings: The ``cirpy_actions.BuildSettings`` to build with.
+    :param: device_watcher: The ``DeviceWatcher`` used while flashing.
+    :param: flash_record: The node's ``FlashRecord``.
+    :param: board_index: The node's ``BoardIndex``, if it keeps one.
+    :param: test_history: The node's ``TestHistory``.
+    """
+    fw_cache: FirmwareCache
+    worktree_pool: WorktreePool
+    build_settings: cirpy_actions.BuildSettings
+    device_watcher: DeviceWatcher
+    flash_record: FlashRecord
+    board_index: BoardIndex = None
+    test_history: TestHistory = None
+
+    @classmethod
+    def from_config(cls, config):
+        """ Sets up the node's resources as configured.
+
+        :param: config: A ``PhysaCIConfig()`` instance.
+        """
+        fw_cache = FirmwareCache(
+            cache_dir=config.fw_cache_dir,
+            max_size=config.fw_cache_max_size
+        )
+
+        git_mirror = None
+        if config.git_mirror:
+            git_mirror = GitMirror(
+                upstream=config.git_upstream,
+                mirror_dir=config.git_mirror_dir
+            )
+
+        worktree_pool = WorktreePool(
+            find_circuitpython(),
+            pool_dir=config.worktree_dir,
+            max_age=config.worktree_max_age,
+            max_size=config.worktree_max_size,
+            mirror=git_mirror
+        )
+
+        build_settings = cirpy_actions.BuildSettings(
+            ccache=config.use_ccache,
+            job_budget=JobBudget(config.make_jobs)
+        )
+
+        device_watcher = DeviceWatcher(**config.device_timeouts)
+        board_index = None
+        if config.board_index:
+            board_index = BoardIndex(
+                index_file=config.board_index_file,
+                device_watcher=device_watcher,
+                index_wait=config.board_index_wait
+            )
+
+        return cls(
+            fw_cache=fw_cache,
+            worktree_pool=worktree_pool,
+            build_settings=build_settings,
+            device_watcher=device_watcher,
+            flash_record=FlashRecord(),
+            board_index=board_index,
+            test_history=TestHistory(history_file=config.test_history_file)
+        )
+
 @dataclasses.dataclass
 class GitHubData():
     """ Dataclass to contain data formatted to update the GitHub
@@ -105,8 +461,13 @@ class GitHubData():
 # pylint: disable=too-few-public-methods
 @dataclasses.dataclass
 class NodeTestData():
-    """ Dataclass to contain test data stored by physaCI. """
+    """ Dataclass to contain test data stored by physaCI.
+
+        ``board_timings`` maps each board to the summary and spans of the
+        phases of its run, from ``timing.PhaseTimings.to_dict``.
+    """
     board_tests: list = dataclasses.field(default_factory=list)
+    board_timings: dict = dataclasses.field(default_factory=dict)
 
 class TestResultPayload():
     """ Container to hold the test result payload """
@@ -118,12 +479,58 @@ class TestResultPayload():
     @property
     def payload_json(self):
         """ Format the contents into a JSON string. """
+        return "".join(self.iter_json())
+
+    def iter_json(self, sent_logs=(), **extra):
+        """ Yields the contents as JSON, in chunks. Board logs are streamed
+            from their log files as they are encoded, so the payload is
+            never held in memory in full.
+
+        :param: sent_logs: Boards whose logs physaCI already has. Their
+                           logs are left out and marked as sent.
+        :param: extra: Additional top-level keys to include.
+        """
+        logs = {}
+
+        def board_entry(board_tests):
+            if board_tests["board_name"] in sent_logs:
+                return dict(board_tests, rosie_log=None, rosie_log_sent=True)
+            return {key: placeholder(value) for key, value in board_tests.items()}
+
+        def placeholder(value):
+            if not isinstance(value, TestResultStream):
+                return value
+            token = f"\x00rosiepi-log-{len(logs)}\x00"
+            logs[json.dumps(token)] = value
+            return token
+
+        node_test_data = {
+            field.name: getattr(self.node_test_data, field.name)
+            for field in dataclasses.fields(self.node_test_data)
+        }
+        node_test_data["board_tests"] = [
+            board_entry(board_tests)
+            for board_tests in self.node_test_data.board_tests
+        ]
         payload_dict = {
             "github_data": dataclasses.asdict(self.github_data),
-            "node_test_data": dataclasses.asdict(self.node_test_data)
+            "node_test_data": node_test_data,
+            **extra
         }
-
-        return json.dumps(payload_dict)
+        encoded = json.dumps(payload_dict)
+        if not logs:
+            yield encoded
+            return
+
+        position = 0
+        tokens = re.compile("|".join(re.escape(token) for token in logs))
+        for match in tokens.finditer(encoded):
+            yield encoded[position:match.start()] + '"'
+            for text in logs[match.group()].iter_text():
+                yield json.dumps(text)[1:-1]
+            yield '"'
+            position = match.end()
+        yield encoded[position:]
 
 def markdownify_results(results, results_url):
     """ Puts test results into a Markdown table for use with
@@ -133,8 +540,8 @@ def markdownify_results(results, results_url):
     """
 
     mdown = [
-        "| Board | Result | Tests Passed | Tests Failed |",
-        "| :---: | :---: | :---: | :---: |"
+        "| Board | Result | Tests Passed | Tests Flaky | Tests Failed |",
+        "| :---: | :---: | :---: | :---: | :---: |"
     ]
 
     for board in results:
@@ -143,6 +550,7 @@ def markdownify_results(results, results_url):
             board["board_name"],
             board["outcome"],
             board["tests_passed"],
+            board["tests_flaky"],
             board["tests_failed"],
             "",
         ]
@@ -156,63 +564,218 @@ def markdownify_results(results, results_url):
     return "\n".join(mdown)
 
 
-def run_rosie(commit, check_run_id, boards, payload):
+def board_test_results(board, rosie_test):
+    """ Collects the outcome of a board's test run into the dict stored
+        in ``NodeTestData.board_tests``.
+
+        :param: board: The name of the board.
+        :param: rosie_test: The ``TestController`` that ran the board's tests.
+    """
+    board_results = {
+        "board_name": board,
+        "outcome": None,
+        "tests_passed": 0,
+        "tests_flaky": 0,
+        "tests_failed": 0,
+        "flaky_tests": [],
+        "rosie_log": None,
+    }
+
+    if rosie_test.result: # everything passed!
+        board_results["outcome"] = "Passed"
+    else:
+        if rosie_test.state != "error":
+            board_results["outcome"] = "Failed"
+        else:
+            board_results["outcome"] = "Error"
+
+    board_results["tests_passed"] = str(rosie_test.tests_passed)
+    board_results["tests_flaky"] = str(rosie_test.tests_flaky)
+    board_results["tests_failed"] = str(rosie_test.tests_failed)
+    # tests that only passed on a retry
+    board_results["flaky_tests"] = [
+        test.test_file for test in rosie_test.tests
+        if test.flaky and test.test_result
+    ]
+    # the log is streamed from its file when the payload is sent
+    rosie_test.log.close()
+    board_results["rosie_log"] = rosie_test.log
+
+    return board_results
+
+def board_error_results(board, board_err, log_dir=None):
+    """ The results of a board that no ``TestController`` could be made
+        for, reported as errored with the error in its log.
+
+        :param: board: The name of the board.
+        :param: board_err: The exception that stopped the board.
+        :param: log_dir: An optional directory to write the board's log to.
+    """
+    board_log = TestResultStream(board, log_dir=log_dir)
+    err_msg = [
+        f"Failed to start testing on: {board}",
+        "".join(traceback.format_exception(
+            type(board_err), board_err, board_err.__traceback__
+        )),
+        "="*60,
+        "Closing RosiePi",
+    ]
+    board_log.write("\n".join(err_msg))
+    board_log.close()
+    return {
+        "board_name": board,
+        "outcome": "Error",
+        "tests_passed": "0",
+        "tests_flaky": "0",
+        "tests_failed": "0",
+        "flaky_tests": [],
+        "rosie_log": board_log,
+    }
+
+def run_rosie(commit, check_run_id, boards, payload, fw_cache=None, # pylint: disable=too-many-arguments,too-many-locals
+              build_jobs=None, concurrent_tests=True, worktree_pool=None,
+              build_settings=None, device_watcher=None, flash_record=None,
+              log_dir=None, session_cap=None, uploader=None, capture_dir=None,
+              metrics=None, pipeline=None, board_index=None, deadlines=None,
+              retries=0, test_history=None, rerun_failed=False):
     """ Runs rosiepi for each board.
         Returns results as a JSON for sending to GitHub.
 
+        The commit is run through a ``TestPipeline``: firmware for every
+        connected board is built at the same time, and each board's tests
+        start as soon as its firmware is ready. When ``concurrent_tests``
+        is set, every board's tests run in parallel since each board has
+        its own serial port and drive.
+
         :param: commit: The commit of circuitpython to pass to rosiepi.
         :param: check_run_id: The ID of the GitHub Check Run
         :param: boards: The boards connected to the RosiePi node to run tests
                         on. Supplied by the node's config file.
         :param: payload: The ``TestResultPayload`` container to hold
                          incremental result data.
+        :param: fw_cache: An optional ``FirmwareCache`` to reuse previously
+                          built firmware from.
+        :param: build_jobs: The most firmware builds to run at once. Defaults
+                            to the number of CPUs.
+        :param: concurrent_tests: Run the boards' tests in parallel instead
+                                  of one board at a time.
+        :param: worktree_pool: An optional ``WorktreePool`` to build the
+                               firmware in.
+        :param: build_settings: An optional ``cirpy_actions.BuildSettings``
+                                to build the firmware with.
+        :param: device_watcher: An optional ``DeviceWatcher`` to wait on the
+                                boards while updating firmware.
+        :param: flash_record: An optional ``FlashRecord``; boards already
+                              running the firmware for ``commit`` are
+                              neither rebuilt nor reflashed.
+        :param: log_dir: An optional directory to write the boards' run
+                         logs to.
+        :param: session_cap: Most bytes of each test's REPL session to hold
+                             in memory.
+        :param: uploader: An optional ``ResultUploader`` or ``ResultOutbox``.
+                          Each board's results are sent with it as soon as
+                          the board finishes.
+        :param: capture_dir: An optional directory to record each board's
+                             serial traffic to.
+        :param: metrics: An optional ``NodeMetrics`` to record each board's
+                         run in.
+        :param: pipeline: An optional running ``TestPipeline`` to submit
+                          the commit to, so that it overlaps with other
+                          commits. A pipeline is made for the run if not
+                          supplied.
+        :param: board_index: An optional ``BoardIndex`` to find the boards
+                             with.
+        :param: deadlines: An optional ``Deadlines`` to run each board's
+                           tests under.
+        :param: retries: Times to run a failed test again.
+        :param: test_history: An optional ``TestHistory`` to record each
+                              board's results in.
+        :param: rerun_failed: Only run the tests that did not pass in each
+                              board's last recorded run of ``commit``.
     """
 
     app_conclusion = ""
 
     rosiepi_logger.info("Starting tests...")
 
-    for board in boards:
-        board_results = {
-            "board_name": board,
-            "outcome": None,
-            "tests_passed": 0,
-            "tests_failed": 0,
-            "rosie_log": "",
-        }
-
-        try:
-            rosie_test = test_controller.TestController(board, commit)
+    def make_controller(board, build_ref):
+        return test_controller.TestController(
+            board,
+            build_ref,
+            fw_cache=fw_cache,
+            worktree_pool=worktree_pool,
+            build_settings=build_settings,
+            device_watcher=device_watcher,
+            flash_record=flash_record,
+            log_dir=log_dir,
+            session_cap=session_cap,
+            capture_dir=capture_dir,
+            board_index=board_index,
+            deadlines=deadlines,
+            retries=retries,
+            test_history=test_history,
+            rerun_failed=rerun_failed
+        )
 
-            # check if connection to board was successful
-            if rosie_test.state != "error":
-                rosie_test.start_test()
-            else:
-                board_results["outcome"] = "Error"
-                #print(rosie_test.log.getvalue())
-                app_conclusion = "failure"
-
-        except Exception: # pylint: disable=broad-except
-            rosie_test.log.write(traceback.format_exc())
-            break
-
-        finally:
-            # now check the result of each board test
-            if rosie_test.result: # everything passed!
-                board_results["outcome"] = "Passed"
-                if app_conclusion != "failure":
-                    app_conclusion = "success"
+    rosie_tests = {}
+    results = {}
+    with contextlib.ExitStack() as run_stack:
+        if pipeline is None:
+            pipeline = run_stack.enter_context(TestPipeline(
+                boards,
+                fw_cache=fw_cache,
+                build_jobs=build_jobs,
+                worktree_pool=worktree_pool,
+                build_settings=build_settings,
+                concurrent_tests=concurrent_tests
+            ))
+        pipeline_run = pipeline.submit(
+            commit, boards, make_controller=make_controller
+        )
+        board_runs = {
+            future: board for board, future in pipeline_run.futures.items()
+        }
+        for future in concurrent.futures.as_completed(board_runs):
+            board = board_runs[future]
+            try:
+                rosie_tests[board] = future.result()
+            except Exception as board_err: # pylint: disable=broad-except
+                # only this board is lost; the others still report
+                rosiepi_logger.warning(
+                    "Could not test on %s: %s", board, board_err
+                )
+                rosie_tests[board] = None
+                results[board] = board_error_results(board, board_err, log_dir)
             else:
-                if rosie_test.state != "error":
-                    board_results["outcome"] = "Failed"
-                else:
-                    board_results["outcome"] = "Error"
-                app_conclusion = "failure"
-
-            board_results["tests_passed"] = str(rosie_test.tests_passed)
-            board_results["tests_failed"] = str(rosie_test.tests_failed)
-            board_results["rosie_log"] = rosie_test.log.getvalue()
-            payload.node_test_data.board_tests.append(board_results)
+                results[board] = board_test_results(board, rosie_tests[board])
+            if uploader is not None:
+                board_payload = TestResultPayload()
+                board_payload.node_test_data.board_tests.append(
+                    results[board]
+                )
+                board_payload.node_test_data.board_timings[board] = (
+                    results[board]["rosie_log"].timings.to_dict()
+                )
+                uploader.send_board(board_payload)
+
+    # keep the results in the configured board order, regardless
+    # of the order that the boards finished in.
+    for board in boards:
+        board_results = results[board]
+        if board_results["outcome"] == "Passed":
+            if app_conclusion != "failure":
+                app_conclusion = "success"
+        else:
+            app_conclusion = "failure"
+
+        payload.node_test_data.board_tests.append(board_results)
+        payload.node_test_data.board_timings[board] = (
+            board_results["rosie_log"].timings.to_dict()
+        )
+        if metrics is not None:
+            metrics.observe_board(
+                board, rosie_tests[board], board_results["outcome"]
+            )
 
     app_output_summary = [
         f"RosiePi Node: {gethostname()}",
@@ -242,36 +805,141 @@ def run_rosie(commit, check_run_id, boards, payload):
 
     rosiepi_logger.info("Tests completed...")
 
-def send_results(check_run_id, physaci_config, results_payload):
+def send_results(check_run_id, physaci_config, results_payload, uploader=None):
     """ Send the results to physaCI.
 
         :param: check_run_id: The check run ID of the initiating check.
         :param: physaci_config: A ``PhysaCIConfig()`` instance
-        :param: results_payload: A JSON string with the test results.
+        :param: results_payload: The ``TestResultPayload`` with the test
+                                 results. It is streamed to physaCI, board
+                                 logs included.
+        :param: uploader: The ``ResultUploader`` or ``ResultOutbox`` that
+                          sent the boards' results during the run, if any.
+                          Logs it already sent are left out.
     """
 
     rosiepi_logger.info("Sending test results to physaCI.")
 
-    physaci_url = physaci_config.physaci_url + "/testresult/update"
-    header = {"x-functions-key": physaci_config.physaci_api_key}
-    payload = json.loads(results_payload)
-    payload["node_name"] = gethostname()
-    payload["check_run_id"] = check_run_id
+    if uploader is None:
+        uploader = ResultUploader(
+            physaci_config.physaci_url,
+            physaci_config.physaci_api_key,
+            check_run_id,
+            compress=physaci_config.compress_uploads
+        )
 
-    response = requests.post(physaci_url, headers=header, json=payload)
-    if not response.ok:
+    try:
+        uploader.send_final(results_payload)
+    except RuntimeError as upload_err:
         rosiepi_logger.warning(
-            "Failed to send results to physaCI.\n"
-            "Response code: %s\n"
-            "Response: %s",
-            response.status_code,
-            response.text
+            "Failed to send results to physaCI.\n%s",
+            upload_err.args[0]
         )
+        log_files = [
+            str(board["rosie_log"].path)
+            for board in results_payload.node_test_data.board_tests
+            if isinstance(board["rosie_log"], TestResultStream)
+        ]
         raise RuntimeError(
-            f"RosiePi failed to send results. Results payload: {results_payload}"
+            "RosiePi failed to send results. Results summary: "
+            f"{results_payload.github_data.output.get('text', '')}\n"
+            f"Board logs: {', '.join(log_files)}"
+        ) from None
+
+    rosiepi_logger.info("Test results handed off for delivery.")
+
+def run_check(commit, check_run_id, config, resources, pipeline=None, # pylint: disable=too-many-arguments
+              coalesced=(), queue_wait=None, rerun_failed=None):
+    """ Tests ``commit`` and hands the results off to physaCI.
+
+        :param: commit: The commit of circuitpython to test.
+        :param: check_run_id: The ID of the GitHub Check Run.
+        :param: config: A ``PhysaCIConfig()`` instance.
+        :param: resources: The node's ``NodeResources``.
+        :param: pipeline: An optional running ``TestPipeline`` to test in.
+        :param: coalesced: IDs of other check runs for the same commit,
+                           which are sent the same results.
+        :param: float queue_wait: Seconds the job waited to start, if it
+                                  was queued.
+        :param: bool rerun_failed: Only run the tests that did not pass in
+                                   each board's last run of ``commit``.
+                                   Defaults to the configured setting.
+    """
+    if rerun_failed is None:
+        rerun_failed = config.rerun_failed
+
+    payload = TestResultPayload()
+
+    metrics = None
+    if config.metrics_textfile or config.metrics_port:
+        metrics = NodeMetrics()
+        if queue_wait is not None:
+            metrics.queue_wait.observe(queue_wait)
+
+    uploader = ResultUploader(
+        config.physaci_url,
+        config.physaci_api_key,
+        check_run_id,
+        compress=config.compress_uploads
+    )
+
+    # the outbox also delivers anything left over from earlier runs
+    with uploader, ResultOutbox(uploader, outbox_dir=config.outbox_dir) as outbox:
+        run_rosie(
+            commit,
+            check_run_id,
+            config.supported_boards,
+            payload,
+            fw_cache=resources.fw_cache,
+            build_jobs=config.build_jobs,
+            concurrent_tests=config.concurrent_tests,
+            worktree_pool=resources.worktree_pool,
+            build_settings=resources.build_settings,
+            device_watcher=resources.device_watcher,
+            flash_record=resources.flash_record,
+            log_dir=config.log_dir,
+            session_cap=config.session_cap,
+            uploader=outbox if config.incremental_upload else None,
+            capture_dir=config.capture_dir,
+            metrics=metrics,
+            pipeline=pipeline,
+            board_index=resources.board_index,
+            deadlines=config.deadlines,
+            retries=config.test_retries,
+            test_history=resources.test_history,
+            rerun_failed=rerun_failed
         )
 
-    rosiepi_logger.info("Test results sent successfully.")
+        metrics_totals = None
+        if metrics is not None:
+            metrics_totals = metrics.publish(
+                config.metrics_state_file, config.metrics_textfile
+            )
+
+        send_results(check_run_id, config, payload, uploader=outbox)
+        queued = set(outbox.queued)
+        for other_run_id in coalesced:
+            with ResultUploader(config.physaci_url, config.physaci_api_key,
+                                other_run_id,
+                                compress=config.compress_uploads) as other_uploader:
+                other_outbox = ResultOutbox(other_uploader,
+                                            outbox_dir=config.outbox_dir)
+                send_results(
+                    other_run_id,
+                    config,
+                    payload,
+                    uploader=other_outbox
+                )
+                queued |= other_outbox.queued
+
+        if not outbox.drain(config.outbox_drain_timeout, keys=queued):
+            rosiepi_logger.warning(
+                "Results not yet accepted by physaCI are kept in %s and "
+                "will be sent by the next run.",
+                outbox.outbox_dir
+            )
+
+    return metrics_totals
 
 def main():
     """ Run RosiePi tests. """
@@ -286,8 +954,12 @@ def main():
 
     config = PhysaCIConfig()
 
-    payload = TestResultPayload()
-
-    run_rosie(commit, check_run_id, config.supported_boards, payload)
+    prune_logs(config.log_dir, config.log_max_age)
 
-    send_results(check_run_id, config, payload.payload_json)
+    run_check(
+        commit,
+        check_run_id,
+        config,
+        NodeResources.from_config(config),
+        rerun_failed=cli_arg.rerun_failed
+    )
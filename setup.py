@@ -40,7 +40,9 @@ setup(
     entry_points={
         "console_scripts": [
             "rosiepi = rosiepi.rosie.test_controller:main",
-            "run_rosie = rosiepi.run_rosiepi:main"
+            "run_rosie = rosiepi.run_rosiepi:main",
+            "rosiepi-bench = rosiepi.rosie.benchmark:main",
+            "rosiepi-daemon = rosiepi.node_daemon:main"
         ]
     }
 )
@@ -0,0 +1,41 @@
+""" Keeps every test away from the node's real caches and state. Their
+    default paths are under the home directory, and are worked out when
+    the modules are imported, so moving ``HOME`` alone isn't enough.
+"""
+
+import pathlib
+
+import pytest
+
+from rosiepi import node_daemon
+from rosiepi.rosie import (
+    board_index, fw_cache, fw_identity, git_mirror, job_budget, metrics,
+    outbox, result_log, test_history, test_plan, worktrees
+)
+
+REAL_HOME = pathlib.Path.home()
+
+_MODULES = (
+    node_daemon, board_index, fw_cache, fw_identity, git_mirror, job_budget,
+    metrics, outbox, result_log, test_history, test_plan, worktrees
+)
+
+
+@pytest.fixture(autouse=True)
+def isolated_home(tmp_path, monkeypatch):
+    """ Points ``HOME``, and every module's default path under it, at a
+        directory of the test's own.
+    """
+    home = tmp_path / "home"
+    home.mkdir()
+    monkeypatch.setenv("HOME", str(home))
+    for module in _MODULES:
+        for name, value in list(vars(module).items()):
+            if not name.startswith("DEFAULT_") or not isinstance(value, pathlib.Path):
+                continue
+            try:
+                relative = value.relative_to(REAL_HOME)
+            except ValueError:
+                continue
+            monkeypatch.setattr(module, name, home / relative)
+    return home
@@ -0,0 +1,102 @@
+""" Block-mode REPL execution against a simulated board, with and
+    without raw-paste flow control, and scripts run for verifiers.
+"""
+
+import textwrap
+
+import pytest
+
+from rosiepi.rosie import test_controller
+from rosiepi.rosie.simulator import LinkModel, SimulatedBoard
+
+
+@pytest.fixture
+def connect():
+    boards = []
+
+    def connect_board(**model):
+        board = SimulatedBoard(model=LinkModel(**model))
+        boards.append(board)
+        return board.__enter__()
+
+    yield connect_board
+    for board in boards:
+        board.close()
+
+
+@pytest.mark.parametrize("paste_window", [128, 0])
+def test_block_runs_in_one_command(connect, paste_window):
+    board = connect(paste_window=paste_window)
+    block = textwrap.dedent("""\
+        x = 1
+        for i in range(3):
+            x += i
+        print(x)
+        """)
+
+    output, error, raw_paste = test_controller.exec_block(board, block)
+
+    assert (output, error) == (b"4\r\n", b"")
+    assert raw_paste is bool(paste_window)
+    assert board.device.commands == 1
+
+
+def test_block_larger_than_paste_window(connect):
+    board = connect(paste_window=16)
+    block = "".join(f"v{i} = {i}\n" for i in range(100)) + "print(v99)\n"
+
+    output, error, raw_paste = test_controller.exec_block(board, block)
+
+    assert (output, error, raw_paste) == (b"99\r\n", b"", True)
+
+
+def test_block_without_raw_paste_when_not_asked(connect):
+    board = connect()
+
+    output, _, raw_paste = test_controller.exec_block(
+        board, "print('plain')\n", raw_paste=False
+    )
+
+    assert output == b"plain\r\n"
+    assert raw_paste is False
+
+
+def test_block_error_names_its_line(connect):
+    board = connect()
+    block = "a = 1\nb = 2\nraise ValueError('nope')\nc = 3\n"
+
+    output, error, _ = test_controller.exec_block(board, block)
+
+    assert output == b""
+    assert b"ValueError: nope" in error
+    assert test_controller.error_line_offset(error) == 3
+    assert test_controller.error_line_offset(b"") is None
+
+
+def test_blocks_share_the_boards_variables(connect):
+    board = connect()
+    test_controller.exec_block(board, "total = 40\n")
+
+    output, _, _ = test_controller.exec_block(board, "print(total + 2)\n")
+
+    assert output == b"42\r\n"
+
+
+def test_script_result_is_decoded_without_clobbering_names(connect):
+    board = connect()
+    test_controller.exec_block(board, "result = 'mine'\n")
+
+    value = test_controller.exec_script(
+        board, "result = {'pins': [pin * 2 for pin in pins]}", pins=[1, 2]
+    )
+    output, _, _ = test_controller.exec_block(board, "print(result)\n")
+
+    assert value == {"pins": [2, 4]}
+    assert output == b"mine\r\n"
+
+
+def test_script_error_raises(connect):
+    board = connect()
+
+    with pytest.raises(test_controller.pyboard.CPboardError):
+        test_controller.exec_script(board, "result = 1 / 0")
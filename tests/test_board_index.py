@@ -0,0 +1,93 @@
+""" BoardIndex connecting through the by-id links of a simulated
+    device tree, and as the way TestController connects.
+"""
+
+import time
+
+import pytest
+
+from rosiepi.rosie import test_controller
+from rosiepi.rosie.board_index import BoardIndex
+from rosiepi.rosie.device_watch import DeviceWatcher
+from rosiepi.rosie.simulator import SimulatedBoard
+
+
+class Scanned():
+    """ Stands in for a board found by a full scan. """
+    serial_number = "ABC123"
+    disk = None
+
+
+@pytest.fixture
+def board_index(tmp_path):
+    dev_root = tmp_path / "dev"
+    (dev_root / "serial" / "by-id").mkdir(parents=True)
+    watcher = DeviceWatcher(dev_root, poll_interval=0.01)
+    index = BoardIndex(tmp_path / "index.json", watcher, index_wait=0.3)
+    index.update("feather_m4_express", serial_number="ABC123")
+    return index
+
+
+def scan_recorder(calls):
+    def scan(board_name, wait, **kwargs):
+        calls.append((board_name, wait, time.monotonic()))
+        return Scanned()
+    return scan
+
+
+def test_absent_board_waits_at_most_index_wait(board_index):
+    calls = []
+    start = time.monotonic()
+    board_index.connect("feather_m4_express", wait=20, scan=scan_recorder(calls))
+
+    (board_name, wait, scanned_at), = calls
+    assert board_name == "feather_m4_express"
+    assert 0.3 <= scanned_at - start < 2
+    assert 18 < wait < 20
+
+
+def test_unplugged_board_is_scanned_for_at_once(board_index):
+    board_index.apply_event("remove", "ABC123")
+    assert board_index.get("feather_m4_express")["present"] is False
+
+    calls = []
+    start = time.monotonic()
+    board_index.connect("feather_m4_express", wait=20, scan=scan_recorder(calls))
+
+    (_, wait, scanned_at), = calls
+    assert scanned_at - start < 0.2
+    assert wait > 19.8
+    assert board_index.get("feather_m4_express")["present"] is True
+
+
+def test_unindexed_board_is_scanned_for(board_index):
+    calls = []
+    board_index.connect("metro_m0_express", wait=5, scan=scan_recorder(calls))
+
+    (board_name, wait, _), = calls
+    assert board_name == "metro_m0_express"
+    assert wait > 4.9
+    assert board_index.get("metro_m0_express")["serial_number"] == "ABC123"
+
+
+def test_controller_connects_through_index(board_index, tmp_path, monkeypatch):
+    calls = []
+
+    def from_try_all(board_name, wait, **kwargs): # pylint: disable=unused-argument
+        calls.append((board_name, wait))
+        return SimulatedBoard(board_name, serial_number="SIM7")
+    monkeypatch.setattr(
+        test_controller.pyboard.CPboard, "from_try_all", from_try_all,
+        raising=False
+    )
+
+    controller = test_controller.TestController(
+        "metro_m0_express", "main", log_dir=tmp_path / "logs",
+        board_index=board_index
+    )
+    controller.board.close()
+
+    assert controller.state == "board_connected"
+    assert calls == [("metro_m0_express", pytest.approx(20, abs=0.5))]
+    record = board_index.get("metro_m0_express")
+    assert (record["serial_number"], record["present"]) == ("SIM7", True)
@@ -0,0 +1,195 @@
+""" DeviceWatcher over a device tree of plain files. """
+
+import threading
+import time
+
+import pytest
+
+from rosiepi.rosie.device_watch import DeviceWatcher
+
+SERIAL = "usb-Adafruit_Feather_M4_ABC123-if00"
+DRIVE = "usb-Adafruit_Feather_M4_ABC123-0:0"
+
+
+@pytest.fixture
+def dev_root(tmp_path):
+    for kind in ("serial", "disk"):
+        (tmp_path / kind / "by-id").mkdir(parents=True)
+    return tmp_path
+
+
+def plug(dev_root, kind, name):
+    (dev_root / kind / "by-id" / name).touch()
+
+
+def unplug(dev_root, kind, name):
+    (dev_root / kind / "by-id" / name).unlink()
+
+
+def later(delay, *actions):
+    """ Runs each ``(function, args)`` action after ``delay`` seconds, in
+        the background, ``delay`` apart.
+    """
+    def run():
+        for func, *args in actions:
+            time.sleep(delay)
+            func(*args)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_lists_devices(dev_root):
+    plug(dev_root, "serial", SERIAL)
+    plug(dev_root, "disk", DRIVE)
+    plug(dev_root, "disk", DRIVE + "-part1")
+    plug(dev_root, "disk", "ata-SSD_0001")
+    watcher = DeviceWatcher(dev_root)
+
+    assert watcher.serial_ports("ABC123") == {SERIAL}
+    assert watcher.serial_ports("XYZ789") == set()
+    assert watcher.usb_disks() == {DRIVE}
+
+
+def test_missing_device_tree(tmp_path):
+    watcher = DeviceWatcher(tmp_path / "nothing")
+    assert watcher.usb_disks() == set()
+    assert watcher.serial_ports("ABC123") == set()
+
+
+def test_wait_for_bootloader(dev_root):
+    plug(dev_root, "serial", SERIAL)
+    plug(dev_root, "disk", DRIVE)
+    watcher = DeviceWatcher(dev_root, poll_interval=0.01)
+    boot_drive = "usb-Adafruit_Feather_M4_UF2_FFEE-0:0"
+
+    later(
+        0.05,
+        (unplug, dev_root, "serial", SERIAL),
+        (unplug, dev_root, "disk", DRIVE),
+        (plug, dev_root, "disk", boot_drive),
+    )
+    drive, elapsed = watcher.wait_for_bootloader("ABC123", timeout=5)
+
+    assert drive == boot_drive
+    assert 0.1 <= elapsed < 5
+
+
+def test_wait_for_bootloader_takes_only_its_own_drive(dev_root):
+    plug(dev_root, "serial", SERIAL)
+    watcher = DeviceWatcher(dev_root, poll_interval=0.01)
+    other_drive = "usb-Adafruit_Metro_M0_UF2_AAAA-0:0"
+    boot_drive = "usb-Adafruit_Feather_M4_UF2_FFEE-0:0"
+
+    later(
+        0.05,
+        (unplug, dev_root, "serial", SERIAL),
+        (plug, dev_root, "disk", other_drive),
+        (plug, dev_root, "disk", boot_drive),
+    )
+    drive, _ = watcher.wait_for_bootloader(
+        "ABC123", timeout=5, boot_ids=["FFEE", None]
+    )
+
+    assert drive == boot_drive
+
+
+def test_wait_for_bootloader_times_out(dev_root):
+    plug(dev_root, "serial", SERIAL)
+    watcher = DeviceWatcher(dev_root, poll_interval=0.01)
+
+    with pytest.raises(TimeoutError):
+        watcher.wait_for_bootloader("ABC123", timeout=0.1)
+
+
+def test_flush_and_reboot(dev_root):
+    boot_drive = "usb-Adafruit_Feather_M4_UF2_FFEE-0:0"
+    plug(dev_root, "disk", boot_drive)
+    watcher = DeviceWatcher(dev_root, poll_interval=0.01)
+
+    later(
+        0.05,
+        (unplug, dev_root, "disk", boot_drive),
+        (plug, dev_root, "serial", SERIAL),
+    )
+    assert watcher.wait_for_flush(boot_drive, timeout=5) < 5
+    assert watcher.wait_for_serial("ABC123", timeout=5) < 5
+
+
+def test_zero_timeout_is_not_the_default(dev_root):
+    watcher = DeviceWatcher(dev_root, poll_interval=0.01, reboot_timeout=30)
+
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        watcher.wait_for_serial("ABC123", timeout=0)
+    assert time.monotonic() - start < 1
+
+
+def test_bootloader_phase_is_exclusive_until_identified():
+    events = []
+    unknown_entered = threading.Event()
+
+    def unknown_board():
+        with DeviceWatcher.bootloader_phase(False):
+            unknown_entered.set()
+            events.append("unknown in")
+            time.sleep(0.2)
+            events.append("unknown out")
+
+    def known_board(name):
+        unknown_entered.wait()
+        with DeviceWatcher.bootloader_phase(True):
+            events.append(f"{name} in")
+            time.sleep(0.05)
+
+    threads = [
+        threading.Thread(target=unknown_board),
+        threading.Thread(target=known_board, args=("a",)),
+        threading.Thread(target=known_board, args=("b",)),
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert events[:2] == ["unknown in", "unknown out"]
+    assert sorted(events[2:]) == ["a in", "b in"]
+
+
+def test_quick_bootloader_drive_is_seen(dev_root):
+    plug(dev_root, "serial", SERIAL)
+    plug(dev_root, "disk", DRIVE)
+    watcher = DeviceWatcher(dev_root, poll_interval=0.01)
+    boot_drive = "usb-Adafruit_Feather_M4_UF2_FFEE-0:0"
+    before = watcher.usb_disks()
+
+    # the bootloader is up before the serial port is seen to close
+    plug(dev_root, "disk", boot_drive)
+    later(0.05, (unplug, dev_root, "serial", SERIAL))
+    drive, _ = watcher.wait_for_bootloader("ABC123", timeout=5, before=before)
+
+    assert drive == boot_drive
+
+
+def test_known_bootloader_drive_already_present(dev_root):
+    boot_drive = "usb-Adafruit_Feather_M4_UF2_ABC123-0:0"
+    plug(dev_root, "disk", boot_drive)
+    watcher = DeviceWatcher(dev_root, poll_interval=0.01)
+
+    drive, _ = watcher.wait_for_bootloader(
+        "ABC123", timeout=1, boot_ids=["ABC123", boot_drive],
+        before={boot_drive}
+    )
+
+    assert drive == boot_drive
+
+
+def test_own_drive_is_not_taken_for_bootloader(dev_root):
+    # the board's drive carries the same serial number as its bootloader
+    plug(dev_root, "disk", DRIVE)
+    watcher = DeviceWatcher(dev_root, poll_interval=0.01)
+
+    with pytest.raises(TimeoutError):
+        watcher.wait_for_bootloader(
+            "ABC123", timeout=0.1, boot_ids=["ABC123"], before={DRIVE}
+        )
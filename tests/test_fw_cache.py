@@ -0,0 +1,114 @@
+""" FirmwareCache integrity checks and eviction. """
+
+import threading
+from unittest import mock
+
+import pytest
+
+from rosiepi.rosie import fw_cache
+from rosiepi.rosie.fw_cache import FirmwareCache, file_digest
+
+
+def build_output(tmp_path, name, size=100):
+    fw_file = tmp_path / f"{name}.uf2"
+    fw_file.write_bytes(name.encode("utf-8") * size)
+    return fw_file
+
+
+def test_store_records_digest_of_build_output(tmp_path):
+    cache = FirmwareCache(tmp_path / "cache")
+    fw_file = build_output(tmp_path, "a")
+
+    entry_dir = cache.store("a" * 64, fw_file)
+
+    assert cache.lookup("a" * 64) == entry_dir
+    assert file_digest(entry_dir / "firmware.uf2") == file_digest(fw_file)
+
+
+def test_store_rejects_corrupt_copy(tmp_path):
+    cache = FirmwareCache(tmp_path / "cache")
+    fw_file = build_output(tmp_path, "a")
+
+    def bad_copy(src, dst):
+        with open(dst, "wb") as file:
+            file.write(b"corrupt")
+
+    with mock.patch.object(fw_cache.shutil, "copyfile", bad_copy):
+        with pytest.raises(RuntimeError):
+            cache.store("a" * 64, fw_file)
+
+    assert cache.lookup("a" * 64) is None
+
+
+def test_concurrent_stores_of_one_key(tmp_path):
+    cache = FirmwareCache(tmp_path / "cache")
+    fw_file = build_output(tmp_path, "a", size=100000)
+    errors = []
+
+    def store():
+        try:
+            cache.store("a" * 64, fw_file)
+        except Exception as store_err: # pylint: disable=broad-except
+            errors.append(store_err)
+
+    threads = [threading.Thread(target=store) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    entry_dir = cache.lookup("a" * 64)
+    assert file_digest(entry_dir / "firmware.uf2") == file_digest(fw_file)
+    assert not list(entry_dir.glob("*.tmp"))
+
+
+def test_corrupt_copy_leaves_no_tmp_file(tmp_path):
+    cache = FirmwareCache(tmp_path / "cache")
+
+    def bad_copy(src, dst):
+        with open(dst, "wb") as file:
+            file.write(b"corrupt")
+
+    with mock.patch.object(fw_cache.shutil, "copyfile", bad_copy):
+        with pytest.raises(RuntimeError):
+            cache.store("a" * 64, build_output(tmp_path, "a"))
+
+    assert not list((tmp_path / "cache").rglob("*.tmp"))
+
+
+def test_lookup_discards_tampered_artifact(tmp_path):
+    cache = FirmwareCache(tmp_path / "cache")
+    entry_dir = cache.store("a" * 64, build_output(tmp_path, "a"))
+    (entry_dir / "firmware.uf2").write_bytes(b"tampered")
+
+    assert cache.lookup("a" * 64) is None
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = FirmwareCache(tmp_path / "cache", max_size=250)
+    cache.store("a" * 64, build_output(tmp_path, "a"))
+    cache.store("b" * 64, build_output(tmp_path, "b"))
+    cache.lookup("a" * 64)
+
+    cache.store("c" * 64, build_output(tmp_path, "c"))
+
+    assert cache.lookup("a" * 64) is not None
+    assert cache.lookup("b" * 64) is None
+    assert cache.lookup("c" * 64) is not None
+
+
+def test_pinned_artifact_is_not_evicted(tmp_path):
+    cache = FirmwareCache(tmp_path / "cache", max_size=150)
+    entry_dir = cache.store("a" * 64, build_output(tmp_path, "a"))
+
+    with cache.pinned(entry_dir) as fw_path:
+        cache.store("b" * 64, build_output(tmp_path, "b"))
+        assert fw_path.read_bytes() == b"a" * 100
+
+    assert cache.lookup("a" * 64) == entry_dir
+
+    cache.store("c" * 64, build_output(tmp_path, "c"))
+    assert cache.lookup("a" * 64) is None
+    with cache.pinned(entry_dir) as fw_path:
+        assert fw_path is None
@@ -0,0 +1,120 @@
+""" GitMirror against a bare upstream with a submodule, all local. """
+
+import subprocess
+
+import pytest
+import sh
+
+from rosiepi.rosie.git_mirror import GitMirror
+
+
+def run_git(*args, cwd):
+    return subprocess.run(
+        ["git", "-c", "protocol.file.allow=always"] + list(args),
+        cwd=str(cwd), check=True, capture_output=True, text=True
+    ).stdout.strip()
+
+
+def commit_file(repo, name, text):
+    (repo / name).write_text(text)
+    run_git("add", name, cwd=repo)
+    run_git("commit", "-q", "-m", f"Add {name}", cwd=repo)
+    return run_git("rev-parse", "HEAD", cwd=repo)
+
+
+@pytest.fixture
+def repos(tmp_path, monkeypatch):
+    """ A bare upstream whose second commit adds a submodule, and a clone
+        of the upstream made before that commit.
+    """
+    for var in ("AUTHOR", "COMMITTER"):
+        monkeypatch.setenv(f"GIT_{var}_NAME", "RosiePi")
+        monkeypatch.setenv(f"GIT_{var}_EMAIL", "rosiepi@example.com")
+
+    sub_work = tmp_path / "sub_work"
+    sub_work.mkdir()
+    run_git("init", "-q", cwd=sub_work)
+    sub_commit = commit_file(sub_work, "lib.txt", "submodule\n")
+    run_git("clone", "-q", "--bare", str(sub_work), str(tmp_path / "sub.git"),
+            cwd=tmp_path)
+
+    work = tmp_path / "work"
+    work.mkdir()
+    run_git("init", "-q", cwd=work)
+    commit_file(work, "README", "first\n")
+    upstream = tmp_path / "circuitpython.git"
+    run_git("clone", "-q", "--bare", str(work), str(upstream), cwd=tmp_path)
+    run_git("remote", "add", "origin", str(upstream), cwd=work)
+
+    clone = tmp_path / "clone"
+    run_git("clone", "-q", str(upstream), str(clone), cwd=tmp_path)
+
+    run_git("submodule", "add", "-q", "../sub.git", "lib/sub", cwd=work)
+    run_git("commit", "-q", "-m", "Add submodule", cwd=work)
+    commit = run_git("rev-parse", "HEAD", cwd=work)
+    run_git("tag", "v1.0", cwd=work)
+    run_git("push", "-q", "origin", "HEAD", "v1.0", cwd=work)
+
+    return {
+        "clone": clone,
+        "upstream": upstream,
+        "commit": commit,
+        "sub_commit": sub_commit,
+        "mirrors": tmp_path / "mirrors",
+    }
+
+
+def has_commit(repo, commit):
+    return subprocess.run(
+        ["git", "cat-file", "-e", f"{commit}^{{commit}}"],
+        cwd=str(repo), capture_output=True, check=False
+    ).returncode == 0
+
+
+@pytest.mark.parametrize("build_ref", ["full", "abbreviated", "v1.0"])
+def test_populate_clone_pins_full_sha(repos, build_ref):
+    commit = repos["commit"]
+    build_ref = {"full": commit, "abbreviated": commit[:7]}.get(build_ref, build_ref)
+    mirror = GitMirror(mirror_dir=repos["mirrors"])
+    assert not has_commit(repos["clone"], commit)
+
+    mirror.populate_clone(repos["clone"], build_ref, commit)
+
+    assert has_commit(repos["clone"], commit)
+    mirror_path = mirror.mirror_path(str(repos["upstream"]))
+    pinned = run_git("rev-parse", f"refs/rosiepi/{commit}", cwd=mirror_path)
+    assert pinned == commit
+
+
+def test_upstream_defaults_to_clone_origin(repos):
+    mirror = GitMirror(mirror_dir=repos["mirrors"])
+    assert mirror.upstream_url(repos["clone"]) == str(repos["upstream"])
+
+    other = GitMirror(upstream="https://example.com/circuitpython.git",
+                      mirror_dir=repos["mirrors"])
+    assert other.upstream_url(repos["clone"]) == "https://example.com/circuitpython.git"
+
+
+def test_update_submodules_from_mirror(repos, tmp_path):
+    commit = repos["commit"]
+    mirror = GitMirror(mirror_dir=repos["mirrors"])
+    mirror.populate_clone(repos["clone"], commit, commit)
+    worktree = tmp_path / "worktree"
+    run_git("worktree", "add", "-q", "--detach", str(worktree), commit,
+            cwd=repos["clone"])
+
+    assert mirror.submodules(worktree) == [
+        ("lib/sub", "lib/sub", str(tmp_path / "sub.git"), repos["sub_commit"])
+    ]
+
+    mirror.update_submodules(worktree)
+
+    assert (worktree / "lib" / "sub" / "lib.txt").read_text() == "submodule\n"
+    sub_mirror = mirror.mirror_path(str(tmp_path / "sub.git"))
+    assert has_commit(sub_mirror, repos["sub_commit"])
+
+
+def test_fetch_missing_commit_fails(repos):
+    mirror = GitMirror(mirror_dir=repos["mirrors"])
+    with pytest.raises(sh.ErrorReturnCode):
+        mirror.fetch(str(repos["upstream"]), "0" * 40)
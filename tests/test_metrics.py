@@ -0,0 +1,144 @@
+""" Node metrics: the text format, stored totals and the textfile
+    collector file, and what a board's run is counted as.
+"""
+
+import threading
+import types
+
+from rosiepi.rosie import metrics
+from rosiepi.rosie.timing import PhaseTimings
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = metrics.MetricsRegistry()
+    histogram = registry.histogram(
+        "rosiepi_flash_seconds", "Flash time.", (1, 5), ("board",)
+    )
+    for value in (0.5, 1, 3, 30):
+        histogram.observe(value, board="metro_m4")
+
+    assert registry.render().splitlines() == [
+        "# HELP rosiepi_flash_seconds Flash time.",
+        "# TYPE rosiepi_flash_seconds histogram",
+        'rosiepi_flash_seconds_bucket{board="metro_m4",le="1.0"} 2',
+        'rosiepi_flash_seconds_bucket{board="metro_m4",le="5.0"} 3',
+        'rosiepi_flash_seconds_bucket{board="metro_m4",le="+Inf"} 4',
+        'rosiepi_flash_seconds_sum{board="metro_m4"} 34.5',
+        'rosiepi_flash_seconds_count{board="metro_m4"} 4',
+    ]
+
+
+def test_counter_escapes_label_values():
+    registry = metrics.MetricsRegistry()
+    counter = registry.counter("rosiepi_runs_total", "Runs.", ("board",))
+    counter.inc(board='odd "board"\\name')
+    counter.inc(2, board='odd "board"\\name')
+
+    assert registry.render().splitlines()[-1] == (
+        'rosiepi_runs_total{board="odd \\"board\\"\\\\name"} 3'
+    )
+
+
+def test_publish_adds_to_stored_totals(tmp_path):
+    state_file = tmp_path / "state" / "metrics.json"
+    textfile = tmp_path / "textfile" / "rosiepi.prom"
+    for _ in range(2):
+        run = metrics.NodeMetrics()
+        run.queue_wait.observe(3)
+        run.publish(state_file, textfile)
+
+    totals = metrics.NodeMetrics().publish(state_file)
+
+    assert totals.queue_wait.state()["[]"]["counts"][1] == 2
+    assert "rosiepi_queue_wait_seconds_count 2" in textfile.read_text()
+    assert not list(textfile.parent.glob("*.tmp"))
+
+
+def test_concurrent_publishes_are_all_counted(tmp_path):
+    state_file = tmp_path / "metrics.json"
+    textfile = tmp_path / "rosiepi.prom"
+
+    def publish():
+        run = metrics.NodeMetrics()
+        run.fw_cache.inc(result="hit")
+        run.publish(state_file, textfile)
+
+    threads = [threading.Thread(target=publish) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    totals = metrics.NodeMetrics().publish(state_file)
+    assert totals.fw_cache.state() == {'["hit"]': 8}
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_unreadable_state_is_discarded(tmp_path):
+    state_file = tmp_path / "metrics.json"
+    state_file.write_text("{not json")
+
+    run = metrics.NodeMetrics()
+    run.flaky.inc(board="metro_m4")
+    totals = run.publish(state_file)
+
+    assert totals.flaky.state() == {'["metro_m4"]': 1}
+
+
+def board_run(spans, state="done", error_state=None, tests=()):
+    timings = PhaseTimings()
+    for phase, duration in spans:
+        timings.add(phase, timings.origin, duration)
+    return types.SimpleNamespace(
+        log=types.SimpleNamespace(timings=timings),
+        state=state,
+        error_state=error_state,
+        tests=list(tests),
+    )
+
+
+def test_observe_board_counts_build_and_cache_miss():
+    node = metrics.NodeMetrics()
+    flaky = types.SimpleNamespace(flaky=True, test_result=True, carried_over=False)
+    carried = types.SimpleNamespace(flaky=True, test_result=True, carried_over=True)
+    run = board_run(
+        [("firmware_check", 0.1), ("fw_cache_lookup", 0.1), ("make", 60),
+         ("fw_cache_store", 1), ("flash", 8), ("test", 2),
+         ("recovery_interrupt", 0.5)],
+        tests=[flaky, carried],
+    )
+
+    node.observe_board("metro_m4", run, "Passed")
+
+    assert node.fw_cache.state() == {'["miss"]': 1}
+    assert node.build.state()['["metro_m4"]']["sum"] == 61.1
+    assert node.flash.state()['["metro_m4"]']["sum"] == 8
+    assert node.recovery.state() == {
+        '["metro_m4", "interrupt"]': {
+            "counts": [0, 1] + [0] * 8, "sum": 0.5
+        }
+    }
+    assert node.flaky.state() == {'["metro_m4"]': 1}
+    assert node.fw_reused.state() == {}
+
+
+def test_observe_board_counts_reuse_and_failures():
+    node = metrics.NodeMetrics()
+
+    node.observe_board(
+        "metro_m4", board_run([("firmware_check", 0.1), ("test", 1)]), "Passed"
+    )
+    node.observe_board(
+        "feather_m0",
+        board_run([("fw_cache_lookup", 0.1)], state="error",
+                  error_state="starting_fw_prep"),
+        "Error"
+    )
+    node.observe_board("itsybitsy_m4", None, "Error")
+
+    assert node.fw_reused.state() == {'["metro_m4"]': 1}
+    assert node.fw_cache.state() == {'["hit"]': 1}
+    assert node.failures.state() == {
+        '["feather_m0", "firmware"]': 1,
+        '["itsybitsy_m4", "connect"]': 1,
+    }
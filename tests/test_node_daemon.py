@@ -0,0 +1,107 @@
+""" The node daemon's JobQueue: deduplication, coalescing, superseding
+    pushes, and closing the queue while a job runs.
+"""
+
+import threading
+
+import pytest
+
+from rosiepi.node_daemon import JobQueue
+
+
+def test_duplicate_check_run_is_not_queued_again():
+    jobs = JobQueue()
+    job, queued, _ = jobs.submit("a" * 40, 1)
+
+    again, queued_again, superseded = jobs.submit("a" * 40, "1")
+
+    assert queued and not queued_again
+    assert again is job
+    assert not superseded
+    assert jobs.jobs() == [job]
+
+
+def test_same_commit_is_coalesced_into_queued_job():
+    jobs = JobQueue()
+    job, _, _ = jobs.submit("a" * 40, 1)
+
+    coalesced, queued, _ = jobs.submit("a" * 40, 2)
+
+    assert coalesced is job and not queued
+    assert job.check_run_ids == ["1", "2"]
+    assert jobs.find(2) is job
+    assert jobs.get() is job
+    assert jobs.jobs() == [job]
+
+
+def test_push_to_branch_supersedes_queued_job():
+    jobs = JobQueue()
+    old, _, _ = jobs.submit("a" * 40, 1, branch="main")
+    other, _, _ = jobs.submit("b" * 40, 2, branch="dev")
+
+    new, queued, superseded = jobs.submit("c" * 40, 3, branch="main")
+
+    assert queued
+    assert superseded == [old]
+    assert (old.status, old.superseded_by) == ("superseded", "c" * 40)
+    assert old.finished is not None
+    assert jobs.get() is other
+    assert jobs.get() is new
+
+
+def test_push_to_branch_leaves_running_job():
+    jobs = JobQueue()
+    running, _, _ = jobs.submit("a" * 40, 1, branch="main")
+    assert jobs.get() is running
+
+    _, queued, superseded = jobs.submit("b" * 40, 2, branch="main")
+
+    assert queued and not superseded
+    assert running.status == "running"
+
+
+def test_full_queue_refuses_jobs():
+    jobs = JobQueue(max_queued=1)
+    jobs.submit("a" * 40, 1)
+
+    with pytest.raises(RuntimeError):
+        jobs.submit("b" * 40, 2)
+
+    assert jobs.find(2) is None
+
+
+def test_close_while_job_runs():
+    jobs = JobQueue()
+    running, _, _ = jobs.submit("a" * 40, 1)
+    assert jobs.get() is running
+    queued, _, _ = jobs.submit("b" * 40, 2)
+
+    waiter_got = []
+    waiter = threading.Thread(target=lambda: waiter_got.append(jobs.get()))
+    jobs.close()
+    waiter.start()
+    waiter.join(5)
+
+    # queued jobs are dropped, and no more are taken
+    assert waiter_got == [None]
+    assert queued.status == "queued"
+    with pytest.raises(RuntimeError):
+        jobs.submit("c" * 40, 3)
+
+    # the running job still finishes
+    jobs.finish(running)
+    assert running.status == "done"
+    assert running.finished is not None
+
+
+def test_close_wakes_waiting_dispatcher():
+    jobs = JobQueue()
+    waiter_got = []
+    waiter = threading.Thread(target=lambda: waiter_got.append(jobs.get()))
+    waiter.start()
+
+    jobs.close()
+    waiter.join(5)
+
+    assert not waiter.is_alive()
+    assert waiter_got == [None]
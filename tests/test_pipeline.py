@@ -0,0 +1,157 @@
+""" TestPipeline wiring: commits reach every board in order, builds are
+    handed to the boards that need them, and one board's failure stays
+    with that board.
+"""
+
+import concurrent.futures
+import threading
+
+import pytest
+
+from rosiepi.rosie import cirpy_actions, pipeline
+
+
+class Log():
+    """ Stands in for a ``TestResultStream``. """
+
+    def __init__(self):
+        self.lines = []
+
+    def write(self, data):
+        self.lines.append(data)
+
+    def tail(self):
+        return "".join(self.lines)
+
+
+class Controller():
+    """ Stands in for a connected ``TestController``. """
+
+    def __init__(self, board_name, commit, current=False, state="board_connected"):
+        self.board_name = board_name
+        self.commit = commit
+        self.current = current
+        self.state = state
+        self.fw_build = None
+        self.log = Log()
+
+    def firmware_current(self):
+        return self.current
+
+    def start_test(self, fw_build=None):
+        self.fw_build = fw_build
+        self.state = "done"
+
+
+class FakeBuild():
+    """ Stands in for ``cirpy_actions.ParallelBuild``, recording what
+        each commit was built for.
+    """
+    built = []
+
+    def __init__(self, boards, build_ref, **kwargs): # pylint: disable=unused-argument
+        self.boards = list(boards)
+        self.build_ref = build_ref
+        self.futures = {}
+
+    def __enter__(self):
+        if self.boards:
+            FakeBuild.built.append((self.build_ref, sorted(self.boards)))
+        for board in self.boards:
+            future = concurrent.futures.Future()
+            future.set_result((f"/fw/{self.build_ref}/{board}", None))
+            self.futures[board] = future
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def fake_build(monkeypatch):
+    FakeBuild.built = []
+    monkeypatch.setattr(cirpy_actions, "ParallelBuild", FakeBuild)
+    return FakeBuild
+
+
+def make_controllers(current=(), fail=()):
+    made = []
+    lock = threading.Lock()
+
+    def make_controller(board, commit):
+        if board in fail:
+            raise RuntimeError(f"{board} is not connected")
+        controller = Controller(board, commit, current=board in current)
+        with lock:
+            made.append(controller)
+        return controller
+
+    return make_controller, made
+
+
+def test_commits_run_in_order_on_every_board():
+    make_controller, made = make_controllers()
+    with pipeline.TestPipeline(["metro_m4", "feather_m0"], make_controller) as tests:
+        runs = [tests.submit(commit) for commit in ("one", "two", "three")]
+        assert all(run.wait(10) for run in runs)
+
+    for run in runs:
+        for board, future in run.futures.items():
+            controller = future.result()
+            assert (controller.board_name, controller.commit) == (board, run.commit)
+            assert controller.state == "done"
+            assert controller.fw_build.result()[0] == f"/fw/{run.commit}/{board}"
+    for board in ("metro_m4", "feather_m0"):
+        assert [
+            controller.commit for controller in made
+            if controller.board_name == board
+        ] == ["one", "two", "three"]
+
+
+def test_current_boards_skip_the_build(fake_build):
+    make_controller, _ = make_controllers(current={"metro_m4"})
+    with pipeline.TestPipeline(["metro_m4", "feather_m0"], make_controller) as tests:
+        run = tests.submit("one")
+        assert run.wait(10)
+
+    assert fake_build.built == [("one", ["feather_m0"])]
+    assert run.futures["metro_m4"].result().fw_build is None
+
+
+def test_failed_connection_stays_with_its_board():
+    make_controller, _ = make_controllers(fail={"feather_m0"})
+    with pipeline.TestPipeline(["metro_m4", "feather_m0"], make_controller) as tests:
+        run = tests.submit("one")
+        assert run.wait(10)
+
+    assert run.futures["metro_m4"].result().state == "done"
+    with pytest.raises(RuntimeError):
+        run.futures["feather_m0"].result()
+
+
+def test_errored_test_run_is_contained(monkeypatch):
+    def start_test(self, fw_build=None):
+        raise ValueError("controller bug")
+    monkeypatch.setattr(Controller, "start_test", start_test)
+
+    make_controller, _ = make_controllers()
+    with pipeline.TestPipeline(["metro_m4"], make_controller) as tests:
+        run = tests.submit("one")
+        assert run.wait(10)
+
+    controller = run.futures["metro_m4"].result()
+    assert controller.state == "error"
+    assert "controller bug" in controller.log.tail()
+
+
+def test_submit_checks_boards_and_close():
+    make_controller, _ = make_controllers()
+    tests = pipeline.TestPipeline(["metro_m4"], make_controller)
+    tests.start()
+
+    with pytest.raises(RuntimeError):
+        tests.submit("one", boards=["feather_m0"])
+
+    tests.close()
+    with pytest.raises(RuntimeError):
+        tests.submit("two")
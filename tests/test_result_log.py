@@ -0,0 +1,117 @@
+""" Streamed run logs, and splicing them into result payloads. """
+
+import gzip
+import json
+import os
+import time
+
+import pytest
+
+from rosiepi import run_rosiepi
+from rosiepi.rosie import result_log
+
+
+def test_keeps_only_tail_in_memory(tmp_path):
+    log = result_log.TestResultStream("board", log_dir=tmp_path, tail_size=100)
+    lines = [f"line {number:04}" for number in range(500)]
+    for line in lines:
+        log.write(line)
+
+    assert len(log.tail()) == 100
+    assert log.tail().endswith("line 0499\n")
+    assert log.getvalue() == "".join(line + "\n" for line in lines)
+    assert log.size == len(log.getvalue())
+
+
+def test_readable_while_open_and_after_close(tmp_path):
+    log = result_log.TestResultStream("board", log_dir=tmp_path)
+    log.write("first")
+    assert log.getvalue() == "first\n"
+
+    log.write(b"second\n")
+    log.close()
+
+    assert log.closed
+    assert log.getvalue() == "first\nsecond\n"
+    with gzip.open(log.path, "rt", encoding="utf-8") as log_file:
+        assert log_file.read() == "first\nsecond\n"
+    with pytest.raises(ValueError):
+        log.write("third")
+
+
+def test_multibyte_text_survives_chunked_reads(tmp_path):
+    log = result_log.TestResultStream("board", log_dir=tmp_path)
+    text = "µs → ✓ " * 200
+    log.write(text)
+    log.close()
+
+    assert "".join(log.iter_text(chunk_size=7)) == text + "\n"
+
+
+def test_logs_get_their_own_files(tmp_path):
+    first = result_log.TestResultStream("board", log_dir=tmp_path)
+    second = result_log.TestResultStream("board", log_dir=tmp_path)
+
+    assert first.path != second.path
+
+
+def test_prune_removes_old_logs(tmp_path):
+    old = result_log.TestResultStream("old", log_dir=tmp_path)
+    old.close()
+    stale = time.time() - 3600
+    os.utime(old.path, (stale, stale))
+    new = result_log.TestResultStream("new", log_dir=tmp_path)
+    new.close()
+
+    result_log.prune_logs(tmp_path, max_age=60)
+
+    assert not old.path.exists()
+    assert new.path.exists()
+
+
+def payload_with_logs(tmp_path, **board_logs):
+    payload = run_rosiepi.TestResultPayload()
+    for board_name, text in board_logs.items():
+        log = result_log.TestResultStream(board_name, log_dir=tmp_path)
+        log.write(text)
+        payload.node_test_data.board_tests.append({
+            "board_name": board_name,
+            "outcome": "Passed",
+            "rosie_log": log,
+        })
+    return payload
+
+
+def test_iter_json_splices_logs_into_payload(tmp_path):
+    text = 'quotes " and \\ slashes\n\ttabs, \x1b escapes and ünïcode'
+    payload = payload_with_logs(
+        tmp_path, metro_m4=text, feather_m0="other board"
+    )
+
+    chunks = list(payload.iter_json(check_run_id=42))
+    decoded = json.loads("".join(chunks))
+
+    assert len(chunks) > 1
+    assert decoded["check_run_id"] == 42
+    assert [
+        (board["board_name"], board["rosie_log"])
+        for board in decoded["node_test_data"]["board_tests"]
+    ] == [("metro_m4", text + "\n"), ("feather_m0", "other board\n")]
+
+
+def test_iter_json_leaves_out_sent_logs(tmp_path):
+    payload = payload_with_logs(tmp_path, metro_m4="sent", feather_m0="unsent")
+
+    decoded = json.loads("".join(payload.iter_json(sent_logs={"metro_m4"})))
+
+    sent, unsent = decoded["node_test_data"]["board_tests"]
+    assert (sent["rosie_log"], sent["rosie_log_sent"]) == (None, True)
+    assert unsent["rosie_log"] == "unsent\n"
+    assert "rosie_log_sent" not in unsent
+
+
+def test_iter_json_without_logs():
+    payload = run_rosiepi.TestResultPayload()
+
+    assert list(payload.iter_json()) == [payload.payload_json]
+    assert json.loads(payload.payload_json)["node_test_data"]["board_tests"] == []
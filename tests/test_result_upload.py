@@ -0,0 +1,270 @@
+""" ResultUploader and ResultOutbox against a local HTTP server. """
+
+import gzip
+import http.server
+import json
+import threading
+
+import pytest
+
+from rosiepi import run_rosiepi
+from rosiepi.rosie.outbox import ResultOutbox
+from rosiepi.rosie.result_upload import (
+    BOARD_ENDPOINT, FINAL_ENDPOINT, ResultUploader
+)
+
+
+class PhysaCI(http.server.ThreadingHTTPServer):
+    """ Records every upload, and answers with the status codes queued
+        in ``responses`` (200 once they run out). Uploads whose
+        idempotency key was already accepted are acknowledged but not
+        recorded again, like physaCI.
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), PhysaCIHandler)
+        self.responses = []
+        self.requests = []
+        self.accepted = {}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class PhysaCIHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_POST(self): # pylint: disable=invalid-name
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Transfer-Encoding") == "chunked" or not body:
+            body = self._read_chunked()
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        key = self.headers.get("Idempotency-Key")
+
+        with self.server.lock:
+            status = self.server.responses.pop(0) if self.server.responses else 200
+            self.server.requests.append((self.path, key, status))
+            if status == 200 and (key is None or key not in self.server.accepted):
+                self.server.accepted[key or len(self.server.accepted)] = (
+                    self.path, json.loads(body)
+                )
+
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _read_chunked(self):
+        body = b""
+        while True:
+            size = int(self.rfile.readline().strip(), 16)
+            if not size:
+                self.rfile.readline()
+                return body
+            body += self.rfile.read(size)
+            self.rfile.readline()
+
+    def log_message(self, *args): # pylint: disable=arguments-differ
+        pass
+
+
+@pytest.fixture
+def physaci():
+    server = PhysaCI()
+    thread = threading.Thread(
+        target=server.serve_forever, args=(0.05,), daemon=True
+    )
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def board_payload(board_name, outcome="Passed"):
+    payload = run_rosiepi.TestResultPayload()
+    payload.node_test_data.board_tests.append({
+        "board_name": board_name,
+        "outcome": outcome,
+        "rosie_log": f"{board_name} log",
+    })
+    return payload
+
+
+def final_payload(*board_names):
+    payload = run_rosiepi.TestResultPayload()
+    for board_name in board_names:
+        payload.node_test_data.board_tests.extend(
+            board_payload(board_name).node_test_data.board_tests
+        )
+    return payload
+
+
+@pytest.mark.parametrize("compress", [True, False])
+def test_uploader_sends_board_then_final(physaci, compress):
+    with ResultUploader(physaci.url, "key", 42, node_name="node",
+                        compress=compress) as uploader:
+        assert uploader.send_board(board_payload("metro_m4"))
+        uploader.send_final(final_payload("metro_m4", "feather_m0"))
+
+    (path, board), (final_path, final) = physaci.accepted.values()
+    assert path == BOARD_ENDPOINT
+    assert board["partial"] is True
+    assert board["check_run_id"] == 42
+    assert final_path == FINAL_ENDPOINT
+    metro, feather = final["node_test_data"]["board_tests"]
+    assert metro["rosie_log"] is None and metro["rosie_log_sent"] is True
+    assert feather["rosie_log"] == "feather_m0 log"
+
+
+def test_uploader_failed_board_send_goes_in_final(physaci):
+    physaci.responses = [503]
+    with ResultUploader(physaci.url, "key", 42, node_name="node") as uploader:
+        assert not uploader.send_board(board_payload("metro_m4"))
+        uploader.send_final(final_payload("metro_m4"))
+
+    (path, final), = physaci.accepted.values()
+    assert path == FINAL_ENDPOINT
+    assert final["node_test_data"]["board_tests"][0]["rosie_log"] == "metro_m4 log"
+
+
+def test_uploader_raises_status_code(physaci):
+    physaci.responses = [401]
+    with ResultUploader(physaci.url, "key", 42, node_name="node") as uploader:
+        with pytest.raises(RuntimeError) as upload_err:
+            uploader.send_final(final_payload("metro_m4"))
+    assert upload_err.value.args[1] == 401
+
+
+def test_uploader_unreachable():
+    with ResultUploader("http://127.0.0.1:9", "key", 42, node_name="node",
+                        timeout=1) as uploader:
+        with pytest.raises(RuntimeError) as upload_err:
+            uploader.send_final(final_payload("metro_m4"))
+    assert upload_err.value.args[1] is None
+
+
+def make_outbox(physaci, tmp_path, check_run_id=42, **kwargs):
+    uploader = ResultUploader(physaci.url, "key", check_run_id, node_name="node")
+    kwargs.setdefault("base_delay", 0.05)
+    return ResultOutbox(uploader, outbox_dir=tmp_path / "outbox", **kwargs)
+
+
+def test_outbox_retries_until_delivered(physaci, tmp_path):
+    physaci.responses = [503, 429, 500]
+    with make_outbox(physaci, tmp_path) as outbox:
+        outbox.send_board(board_payload("metro_m4"))
+        outbox.send_final(final_payload("metro_m4"))
+        assert outbox.drain(10)
+
+    assert not outbox.pending()
+    assert len(physaci.requests) == 5
+    assert set(physaci.accepted) == {"42:node:metro_m4", "42:node"}
+    assert outbox.uploader.uploaded == {"metro_m4"}
+
+
+def test_outbox_dead_letters_rejected_upload(physaci, tmp_path):
+    physaci.responses = [400]
+    with make_outbox(physaci, tmp_path) as outbox:
+        outbox.send_final(final_payload("metro_m4"))
+        assert outbox.drain(10)
+
+    assert not physaci.accepted
+    assert not outbox.pending()
+    dead = sorted(path.name for path in outbox.dead_dir.iterdir())
+    assert dead == ["42_node.json.gz", "42_node.meta.json"]
+
+
+def test_outbox_dead_letters_expired_upload(physaci, tmp_path):
+    physaci.responses = [503] * 100
+    with make_outbox(physaci, tmp_path, max_age=0) as outbox:
+        outbox.send_final(final_payload("metro_m4"))
+        assert outbox.drain(10)
+
+    assert len(physaci.requests) == 1
+    assert (outbox.dead_dir / "42_node.meta.json").exists()
+
+
+def test_outbox_put_replaces_same_key(physaci, tmp_path):
+    outbox = make_outbox(physaci, tmp_path)
+    outbox.send_final(final_payload("metro_m4"))
+    outbox.send_final(final_payload("metro_m4", "feather_m0"))
+    assert [meta["key"] for meta in outbox.pending()] == ["42:node"]
+
+    outbox.send_due()
+
+    (_, final), = physaci.accepted.values()
+    assert len(final["node_test_data"]["board_tests"]) == 2
+    assert final["idempotency_key"] == "42:node"
+
+
+def test_outbox_repeat_delivery_is_idempotent(physaci, tmp_path):
+    outbox = make_outbox(physaci, tmp_path)
+    outbox.send_final(final_payload("metro_m4"))
+    outbox.send_due()
+    outbox.send_final(final_payload("metro_m4"))
+    outbox.send_due()
+
+    assert [key for _, key, _ in physaci.requests] == ["42:node", "42:node"]
+    assert len(physaci.accepted) == 1
+
+
+def test_outbox_drain_ignores_earlier_runs(physaci, tmp_path):
+    earlier = make_outbox(physaci, tmp_path, check_run_id=41, base_delay=600)
+    earlier.send_final(final_payload("metro_m4"))
+    physaci.responses = [503]
+    earlier.send_due()
+    assert [meta["key"] for meta in earlier.pending()] == ["41:node"]
+
+    with make_outbox(physaci, tmp_path, base_delay=600) as outbox:
+        outbox.send_final(final_payload("metro_m4"))
+        assert outbox.drain(5)
+
+    assert [meta["key"] for meta in outbox.pending()] == ["41:node"]
+    assert list(physaci.accepted) == ["42:node"]
+
+
+def test_outbox_delivers_leftovers_from_earlier_runs(physaci, tmp_path):
+    earlier = make_outbox(physaci, tmp_path, check_run_id=41)
+    earlier.send_final(final_payload("metro_m4"))
+
+    with make_outbox(physaci, tmp_path) as outbox:
+        assert outbox.drain(5, keys=["41:node"])
+
+    assert list(physaci.accepted) == ["41:node"]
+
+
+def test_outbox_removes_delivered_and_dead_entries(physaci, tmp_path):
+    physaci.responses = [400]
+    with make_outbox(physaci, tmp_path) as outbox:
+        outbox.send_final(final_payload("metro_m4"))
+        outbox.send_board(board_payload("metro_m4"))
+        assert outbox.drain(10)
+
+    assert len(physaci.accepted) == 1
+    assert [path.name for path in outbox.outbox_dir.iterdir()] == ["dead"]
+
+
+def test_outbox_concurrent_puts_of_one_key(physaci, tmp_path):
+    outbox = make_outbox(physaci, tmp_path)
+    errors = []
+
+    def put():
+        try:
+            outbox.send_final(final_payload("metro_m4"))
+        except Exception as put_err: # pylint: disable=broad-except
+            errors.append(put_err)
+
+    threads = [threading.Thread(target=put) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert [meta["key"] for meta in outbox.pending()] == ["42:node"]
+    assert not list(outbox.outbox_dir.glob("*.tmp"))
+
+    outbox.send_due()
+
+    assert list(physaci.accepted) == ["42:node"]
@@ -0,0 +1,75 @@
+""" Capturing a REPL session in memory, and spilling it to disk once it
+    outgrows its cap.
+"""
+
+import pytest
+
+from rosiepi.rosie.session_buffer import SessionBuffer
+
+
+def test_appends_in_place_under_cap():
+    session = SessionBuffer(cap=64)
+    session += b"soft reboot\r\n"
+    session += b""
+    session += b">>> "
+
+    assert not session.spilled
+    assert len(session) == 17
+    assert session.getvalue() == b"soft reboot\r\n>>> "
+    assert session.endswith(b">>> ")
+    assert bytes(session.view(5, 11)) == b"reboot"
+    assert bytes(session.view(-4)) == b">>> "
+
+
+def test_spills_past_cap_and_keeps_tail(tmp_path):
+    session = SessionBuffer(cap=16, spill_dir=tmp_path)
+    chunks = [f"line {number:03}\r\n".encode() for number in range(50)]
+    for chunk in chunks:
+        session += chunk
+
+    assert session.spilled
+    assert len(session) == sum(len(chunk) for chunk in chunks)
+    assert session.getvalue() == b"".join(chunks)
+    assert b"".join(session.iter_chunks(chunk_size=7)) == b"".join(chunks)
+    assert bytes(session.tail(100)) == b"".join(chunks)[-16:]
+    assert session.endswith(b"line 049\r\n")
+
+
+def test_chunk_larger_than_cap(tmp_path):
+    session = SessionBuffer(cap=8, spill_dir=tmp_path)
+    session += b"x" * 100 + b"traceback"
+
+    assert session.spilled
+    assert bytes(session.tail(8)) == b"raceback"
+    assert session.decode() == "x" * 100 + "traceback"
+
+
+def test_view_of_spilled_range_raises(tmp_path):
+    session = SessionBuffer(cap=8, spill_dir=tmp_path)
+    session += b"0123456789abcdef"
+
+    assert bytes(session.view(12)) == b"cdef"
+    with pytest.raises(IndexError):
+        session.view(0, 4)
+
+
+def test_append_while_view_is_held():
+    session = SessionBuffer(cap=8)
+    session += b"abcd"
+    held = session.tail(4)
+
+    session += b"efgh"
+    session += b"ijkl"
+
+    assert bytes(held) == b"abcd"
+    assert bytes(session.tail(8)) == b"efghijkl"
+
+
+def test_close_drops_the_session(tmp_path):
+    session = SessionBuffer(cap=4, spill_dir=tmp_path)
+    session += b"spilled session"
+    session.close()
+
+    assert not session
+    assert not session.spilled
+    assert session.getvalue() == b""
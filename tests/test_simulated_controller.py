@@ -0,0 +1,420 @@
+""" TestController runs against a simulated board: results, deadlines
+    and hang recovery, retries of flaky tests, reruns of failed tests,
+    and replays of recorded runs.
+"""
+
+import textwrap
+
+import pytest
+
+from rosiepi.rosie import cirpy_actions, test_controller, test_history
+from rosiepi.rosie.replay import ReplayBoard, SerialRecorder, load_capture
+from rosiepi.rosie.deadlines import Deadlines
+from rosiepi.rosie.simulator import SimulatedBoard
+
+
+@pytest.fixture
+def tests_dir(tmp_path):
+    tests_dir = tmp_path / "rosie_tests"
+    tests_dir.mkdir()
+    return tests_dir
+
+
+@pytest.fixture(autouse=True)
+def no_firmware(monkeypatch):
+    """ Resolves every build ref without git, and treats the simulated
+        board as already running its firmware.
+    """
+    monkeypatch.setattr(cirpy_actions, "resolve_commit", lambda ref: "a" * 40)
+    monkeypatch.setattr(
+        test_controller.TestController, "firmware_current", lambda self: True
+    )
+
+
+def write_tests(tests_dir, **tests):
+    for name, source in tests.items():
+        (tests_dir / f"{name}.py").write_text(textwrap.dedent(source))
+
+
+def run_controller(tmp_path, tests_dir, **kwargs):
+    kwargs.setdefault("board_factory", SimulatedBoard.factory())
+    controller = test_controller.TestController(
+        "simulated",
+        "main",
+        log_dir=tmp_path / "logs",
+        tests_dir=str(tests_dir),
+        **kwargs
+    )
+    controller.start_test()
+    controller.log.close()
+    return controller
+
+
+def results(controller):
+    return {test.test_file: test.test_result for test in controller.tests}
+
+
+def phases(controller):
+    return [span.phase for span in controller.log.timings.spans]
+
+
+def test_passing_and_failing_tests(tmp_path, tests_dir):
+    write_tests(
+        tests_dir,
+        a_pass="""\
+            x = 2
+            #$ output=4
+            print(x * 2)
+            """,
+        b_fail="""\
+            #$ output=5
+            print(2 + 2)
+            """,
+        c_raise="""\
+            raise ValueError("nope")
+            """,
+    )
+    controller = run_controller(tmp_path, tests_dir)
+
+    assert results(controller) == {
+        "a_pass.py": True, "b_fail.py": False, "c_raise.py": False
+    }
+    assert (controller.tests_run, controller.tests_passed,
+            controller.tests_failed) == (3, 1, 2)
+    assert controller.result is False
+
+
+def test_hung_tests_fail_alone_and_board_recovers(tmp_path, tests_dir):
+    write_tests(
+        tests_dir,
+        a_spin="""\
+            y = 1
+            #$ timeout=0.5
+            while True:
+                y += 1
+            """,
+        b_slow="""\
+            #$ test-timeout=0.5
+            import time
+            for _ in range(100):
+                time.sleep(0.05)
+            """,
+        c_input="""\
+            z = input()
+            """,
+        d_chatty="""\
+            while True:
+                print("still here")
+            """,
+        e_pass="""\
+            #$ output=3
+            print(1 + 2)
+            """,
+    )
+    controller = run_controller(
+        tmp_path, tests_dir,
+        deadlines=Deadlines(line=1, test=3, recovery=2)
+    )
+
+    assert results(controller) == {
+        "a_spin.py": False,
+        "b_slow.py": False,
+        "c_input.py": False,
+        "d_chatty.py": False,
+        "e_pass.py": True,
+    }
+    assert phases(controller).count("recovery_interrupt") == 4
+    assert "recovery_reflash" not in phases(controller)
+    assert controller.state != "error"
+
+
+def test_soft_reset_when_interrupt_goes_unanswered(tmp_path, tests_dir,
+                                                   monkeypatch):
+    write_tests(
+        tests_dir,
+        a_spin="""\
+            while True:
+                pass
+            """,
+        b_pass="""\
+            #$ output=3
+            print(1 + 2)
+            """,
+    )
+    interrupt_board = test_controller.interrupt_board
+    calls = []
+
+    def slow_interrupt(board, timeout):
+        calls.append(timeout)
+        if len(calls) == 1:
+            raise TimeoutError("no answer")
+        interrupt_board(board, timeout)
+
+    monkeypatch.setattr(test_controller, "interrupt_board", slow_interrupt)
+    controller = run_controller(
+        tmp_path, tests_dir,
+        deadlines=Deadlines(line=0.5, test=3, recovery=2)
+    )
+
+    assert results(controller) == {"a_spin.py": False, "b_pass.py": True}
+    assert phases(controller).count("recovery_interrupt") == 1
+    assert phases(controller).count("recovery_soft_reset") == 1
+    assert controller.state != "error"
+
+
+def test_unrecoverable_board_needs_reflash(tmp_path, tests_dir):
+    write_tests(
+        tests_dir,
+        a_stubborn="""\
+            while True:
+                try:
+                    while True:
+                        pass
+                except KeyboardInterrupt:
+                    pass
+            """,
+        b_pass="""\
+            #$ output=3
+            print(1 + 2)
+            """,
+    )
+    controller = run_controller(
+        tmp_path, tests_dir,
+        deadlines=Deadlines(line=0.5, test=3, recovery=0.5)
+    )
+
+    assert results(controller) == {"a_stubborn.py": False, "b_pass.py": None}
+    assert "recovery_soft_reset" in phases(controller)
+    # the simulated board has no firmware to reflash with
+    assert controller.state == "error"
+
+
+def test_timeout_marker_limits_only_its_statement(tmp_path, tests_dir):
+    write_tests(
+        tests_dir,
+        a_block="""\
+            import time
+            #$ timeout=1
+            time.sleep(0.6)
+            time.sleep(0.6)
+            time.sleep(0.6)
+            """,
+        b_loop="""\
+            import time
+            #$ timeout=1
+            for _ in range(3):
+                time.sleep(0.6)
+            done = True
+            """,
+    )
+    controller = run_controller(tmp_path, tests_dir)
+
+    assert results(controller) == {"a_block.py": True, "b_loop.py": False}
+    log = "".join(controller.log.iter_text())
+    assert " - Line: 3\n" in log
+    assert "line deadline of 1s exceeded" in log
+
+
+def test_line_deadline_applies_per_statement(tmp_path, tests_dir):
+    write_tests(
+        tests_dir,
+        a_block="""\
+            import time
+            time.sleep(0.6)
+            time.sleep(0.6)
+            x = 1
+            """,
+        b_block="""\
+            import time
+            x = 1
+            while True:
+                x += 1
+            y = 2
+            """,
+    )
+    controller = run_controller(
+        tmp_path, tests_dir,
+        deadlines=Deadlines(line=1, test=10, recovery=2)
+    )
+
+    assert results(controller) == {"a_block.py": True, "b_block.py": False}
+    log = "".join(controller.log.iter_text())
+    assert " - Line: 3\n" in log
+    assert "'while True:" in log
+
+
+def test_board_deadline_skips_remaining_tests(tmp_path, tests_dir):
+    write_tests(
+        tests_dir,
+        a_pass="""\
+            #$ output=3
+            print(1 + 2)
+            """,
+        b_slow="""\
+            import time
+            time.sleep(5)
+            """,
+        c_pass="""\
+            #$ output=3
+            print(1 + 2)
+            """,
+    )
+    controller = run_controller(
+        tmp_path, tests_dir,
+        deadlines=Deadlines(line=10, test=10, board=1, recovery=2)
+    )
+
+    assert results(controller) == {
+        "a_pass.py": True, "b_slow.py": False, "c_pass.py": None
+    }
+    assert controller.tests_run == 2
+    assert controller.result is False
+
+
+def flaky_test(tmp_path):
+    flag = tmp_path / "ran_once"
+    return f"""\
+        import os
+        first = not os.path.exists({str(flag)!r})
+        open({str(flag)!r}, "w").close()
+        assert not first
+        """
+
+
+def test_retry_marks_test_flaky(tmp_path, tests_dir):
+    write_tests(
+        tests_dir,
+        a_pass="""\
+            #$ output=3
+            print(1 + 2)
+            """,
+        b_flaky=flaky_test(tmp_path),
+        c_fail="""\
+            #$ output=5
+            print(2 + 2)
+            """,
+    )
+    controller = run_controller(tmp_path, tests_dir, retries=1)
+
+    assert results(controller) == {
+        "a_pass.py": True, "b_flaky.py": True, "c_fail.py": False
+    }
+    assert [test.test_file for test in controller.tests if test.flaky] == [
+        "b_flaky.py"
+    ]
+    assert (controller.tests_passed, controller.tests_flaky,
+            controller.tests_failed) == (1, 1, 1)
+
+
+def test_without_retries_flaky_test_fails(tmp_path, tests_dir):
+    write_tests(tests_dir, b_flaky=flaky_test(tmp_path))
+    controller = run_controller(tmp_path, tests_dir)
+
+    assert results(controller) == {"b_flaky.py": False}
+    assert controller.tests_flaky == 0
+
+
+def test_rerun_runs_only_failed_tests(tmp_path, tests_dir):
+    history = test_history.TestHistory(tmp_path / "history.json")
+    write_tests(
+        tests_dir,
+        a_pass="""\
+            #$ output=3
+            print(1 + 2)
+            """,
+        b_flaky=flaky_test(tmp_path),
+    )
+    first = run_controller(tmp_path, tests_dir, test_history=history)
+    assert results(first) == {"a_pass.py": True, "b_flaky.py": False}
+
+    # a test that would now fail, to show the passed one isn't run again
+    write_tests(
+        tests_dir,
+        a_pass="""\
+            raise RuntimeError("should not run")
+            """,
+    )
+    rerun = run_controller(
+        tmp_path, tests_dir, test_history=history, rerun_failed=True
+    )
+
+    assert results(rerun) == {"a_pass.py": True, "b_flaky.py": True}
+    assert [test.test_file for test in rerun.tests if test.carried_over] == [
+        "a_pass.py"
+    ]
+    assert phases(rerun).count("test") == 1
+    assert rerun.result is True
+
+
+def test_rerun_without_history_runs_everything(tmp_path, tests_dir):
+    write_tests(
+        tests_dir,
+        a_pass="""\
+            #$ output=3
+            print(1 + 2)
+            """,
+    )
+    controller = run_controller(
+        tmp_path, tests_dir,
+        test_history=test_history.TestHistory(tmp_path / "history.json"),
+        rerun_failed=True
+    )
+
+    assert results(controller) == {"a_pass.py": True}
+    assert controller.tests_run == 1
+
+
+def test_recorded_run_replays_to_same_results(tmp_path, tests_dir):
+    write_tests(
+        tests_dir,
+        a_pass="""\
+            for i in range(20):
+                print("line", i)
+            #$ output=4
+            print(2 + 2)
+            """,
+        b_fail="""\
+            #$ output=5
+            print(2 + 2)
+            """,
+        c_raise="""\
+            raise ValueError("nope")
+            """,
+    )
+    recorded = run_controller(
+        tmp_path, tests_dir, capture_dir=tmp_path / "captures"
+    )
+    capture_file, = (tmp_path / "captures").iterdir()
+
+    info, _ = load_capture(capture_file)
+    assert set(info["tests"]) == {"a_pass.py", "b_fail.py", "c_raise.py"}
+
+    replayed = run_controller(
+        tmp_path, tests_dir,
+        board_factory=ReplayBoard.factory(capture_file, speed=10)
+    )
+
+    assert results(recorded) == {
+        "a_pass.py": True, "b_fail.py": False, "c_raise.py": False
+    }
+    assert results(replayed) == results(recorded)
+    assert replayed.result is recorded.result is False
+
+
+def test_recorder_merges_reads_of_one_burst(tmp_path):
+    recorder = SerialRecorder(tmp_path / "capture.jsonl.gz", merge_window=10)
+    recorder.record("w", b"print(1)\r")
+    for byte in b"1\r\n>>> ":
+        recorder.record("r", bytes([byte]))
+    recorder.record("w", b"\x04")
+    recorder.record("r", b"soft reboot")
+    recorder.close()
+
+    _, records = load_capture(tmp_path / "capture.jsonl.gz")
+
+    assert [(direction, data) for _, direction, data in records] == [
+        ("w", b"print(1)\r"),
+        ("r", b"1\r\n>>> "),
+        ("w", b"\x04"),
+        ("r", b"soft reboot"),
+    ]
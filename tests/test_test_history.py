@@ -0,0 +1,71 @@
+""" Test history by commit and board, and the statuses it records. """
+
+import types
+
+import pytest
+
+from rosiepi.rosie import test_history
+
+
+def result(test_file, test_result, flaky=False):
+    return types.SimpleNamespace(
+        test_file=test_file, test_result=test_result, flaky=flaky
+    )
+
+
+@pytest.mark.parametrize("test_result, flaky, status", [
+    (True, False, test_history.PASSED),
+    (True, True, test_history.FLAKY),
+    (False, False, test_history.FAILED),
+    (False, True, test_history.FAILED),
+    (None, False, test_history.SKIPPED),
+])
+def test_status_of_a_test(test_result, flaky, status):
+    assert test_history.test_status(result("a.py", test_result, flaky)) == status
+
+
+def test_records_by_commit_and_board(tmp_path):
+    history = test_history.TestHistory(tmp_path / "history.json")
+    history.record("a" * 40, "metro_m4", [
+        result("a.py", True), result("b.py", False), result("c.py", True, flaky=True)
+    ])
+
+    assert history.get("a" * 40, "metro_m4") == {
+        "a.py": "passed", "b.py": "failed", "c.py": "flaky"
+    }
+    assert history.get("a" * 40, "feather_m0") is None
+    assert history.get("b" * 40, "metro_m4") is None
+
+
+def test_partial_rerun_updates_earlier_results(tmp_path):
+    history = test_history.TestHistory(tmp_path / "history.json")
+    history.record("a" * 40, "metro_m4", [result("a.py", True), result("b.py", False)])
+
+    history.record("a" * 40, "metro_m4", [result("b.py", True, flaky=True)])
+
+    assert history.get("a" * 40, "metro_m4") == {"a.py": "passed", "b.py": "flaky"}
+
+
+def test_oldest_entries_are_dropped(tmp_path):
+    history = test_history.TestHistory(tmp_path / "history.json", max_entries=2)
+    history.record("a" * 40, "metro_m4", [result("a.py", True)])
+    history.record("b" * 40, "metro_m4", [result("a.py", True)])
+    # recording again makes the entry the newest
+    history.record("a" * 40, "metro_m4", [result("b.py", True)])
+
+    history.record("c" * 40, "metro_m4", [result("a.py", True)])
+
+    assert history.get("b" * 40, "metro_m4") is None
+    assert history.get("a" * 40, "metro_m4") == {"a.py": "passed", "b.py": "passed"}
+    assert history.get("c" * 40, "metro_m4") == {"a.py": "passed"}
+
+
+def test_unreadable_history_is_discarded(tmp_path):
+    history_file = tmp_path / "history.json"
+    history_file.write_text("{not json")
+    history = test_history.TestHistory(history_file)
+
+    assert history.get("a" * 40, "metro_m4") is None
+    history.record("a" * 40, "metro_m4", [result("a.py", False)])
+
+    assert history.get("a" * 40, "metro_m4") == {"a.py": "failed"}
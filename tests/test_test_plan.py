@@ -0,0 +1,180 @@
+""" Compiling test files into TestPlans, and the plan cache. """
+
+import concurrent.futures
+import textwrap
+
+from rosiepi.rosie import test_plan
+
+
+def compile_source(source):
+    source = textwrap.dedent(source)
+    return test_plan.compile_test_plan(source, "0" * 64)
+
+
+def test_steps_group_code_between_interactions():
+    plan = compile_source("""\
+        import board
+        x = 2
+
+        #$ output=4
+        print(x * 2)
+        y = input()
+        """)
+
+    assert [(step.line_no, step.action) for step in plan.steps] == [
+        (1, None), (5, "output"), (6, None)
+    ]
+    assert plan.steps[0].lines == ["import board\n", "x = 2\n"]
+    assert plan.steps[1].value == "4"
+
+
+def test_timeout_marker_splits_off_its_statement():
+    plan = compile_source("""\
+        import time
+        #$ timeout=1
+        for _ in range(3):
+            time.sleep(0.1)
+        x = 1
+        y = 2
+        #$ test-timeout=30
+        """)
+
+    assert plan.line_timeouts == {3: 1.0}
+    assert plan.test_timeout == 30.0
+    assert [(step.line_no, len(step.lines)) for step in plan.steps] == [
+        (1, 1), (3, 2), (5, 2)
+    ]
+
+
+def test_statement_steps():
+    step = test_plan.TestStep(
+        10,
+        ["x = 1\n", "# note\n", "@decorate\n", "def f():\n", "    pass\n",
+         "y = (1,\n", "     2)\n"],
+        None,
+        None
+    )
+
+    assert [(part.line_no, part.lines) for part in test_plan.statement_steps(step)] == [
+        (10, ["x = 1\n"]),
+        (12, ["@decorate\n", "def f():\n", "    pass\n"]),
+        (15, ["y = (1,\n", "     2)\n"]),
+    ]
+
+
+def test_statement_steps_keeps_unparsable_block_whole():
+    step = test_plan.TestStep(1, ["x = (\n", "y = 1\n"], None, None)
+    assert test_plan.statement_steps(step) == [step]
+
+
+def test_bad_markers_are_reported():
+    plan = compile_source("""\
+        #$ outptu=4
+        print(4)
+        #$ timeout=soon
+        x = 1
+        #$ timeout=-1
+        """)
+
+    assert plan.error_lines == [1, 3, 5]
+
+
+def test_verifiers_are_collected():
+    plan = compile_source("""\
+        #$ verify=board_tests.check_pins
+        import board
+        #$ verify=board_tests.check_i2c
+        import busio
+        #$ verify=board_tests.check_pins
+        import digitalio
+        """)
+
+    assert plan.verifiers == ["board_tests.check_i2c", "board_tests.check_pins"]
+
+
+def test_plan_round_trips_through_json():
+    plan = compile_source("""\
+        #$ timeout=2
+        x = 1
+        #$ output=1
+        print(x)
+        """)
+
+    assert test_plan.TestPlan.from_json(plan.to_json()) == plan
+
+
+def test_plan_in_older_format_is_ignored():
+    plan = compile_source("x = 1\n")
+    stored = plan.to_json().replace(
+        f'"format": {test_plan.PLAN_FORMAT}', '"format": 1'
+    )
+
+    assert test_plan.TestPlan.from_json(stored) is None
+
+
+def test_cache_is_keyed_by_contents(tmp_path):
+    cache_dir = tmp_path / "plans"
+    test_file = tmp_path / "test_pins.py"
+    test_file.write_text("x = 1\n")
+
+    first = test_plan.load_test_plan(test_file, cache_dir)
+    assert test_plan.load_test_plan(test_file, cache_dir) == first
+    assert [path.name for path in cache_dir.iterdir()] == [
+        f"{first.source_hash}.json"
+    ]
+
+    test_file.write_text("x = 2\n")
+    changed = test_plan.load_test_plan(test_file, cache_dir)
+
+    assert changed.source_hash != first.source_hash
+    assert changed.steps[0].lines == ["x = 2\n"]
+    assert len(list(cache_dir.iterdir())) == 2
+
+
+def test_unreadable_cached_plan_is_recompiled(tmp_path):
+    cache_dir = tmp_path / "plans"
+    test_file = tmp_path / "test_pins.py"
+    test_file.write_text("x = 1\n")
+    plan = test_plan.load_test_plan(test_file, cache_dir)
+    (cache_dir / f"{plan.source_hash}.json").write_text("{not json")
+
+    assert test_plan.load_test_plan(test_file, cache_dir) == plan
+
+
+def test_concurrent_loads_share_the_cache(tmp_path):
+    cache_dir = tmp_path / "plans"
+    test_files = []
+    for index in range(50):
+        test_file = tmp_path / f"test_{index}.py"
+        test_file.write_text(f"x = {index}\n#$ output={index}\nprint(x)\n")
+        test_files.append(test_file)
+
+    def load_all(_):
+        return [test_plan.load_test_plan(path, cache_dir) for path in test_files]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=6) as pool:
+        loaded = list(pool.map(load_all, range(6)))
+
+    assert all(plans == loaded[0] for plans in loaded)
+    assert sorted(path.suffix for path in cache_dir.iterdir()) == [".json"] * 50
+
+
+def test_unwritable_cache_is_a_miss(tmp_path):
+    cache_dir = tmp_path / "plans"
+    cache_dir.write_text("not a directory")
+    test_file = tmp_path / "test_pins.py"
+    test_file.write_text("x = 1\n")
+
+    plan = test_plan.load_test_plan(test_file, cache_dir)
+
+    assert plan.steps[0].lines == ["x = 1\n"]
+
+
+def test_default_cache_is_kept_out_of_real_home(tmp_path, isolated_home):
+    test_file = tmp_path / "test_pins.py"
+    test_file.write_text("x = 1\n")
+
+    plan = test_plan.load_test_plan(test_file)
+
+    cache_dir = isolated_home / ".cache" / "rosiepi" / "test_plans"
+    assert (cache_dir / f"{plan.source_hash}.json").exists()
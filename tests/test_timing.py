@@ -0,0 +1,68 @@
+""" Phase timings, and how they are summarised for the result payload. """
+
+import pytest
+
+from rosiepi.rosie import timing
+
+
+def test_summary_counts_totals_and_longest():
+    timings = timing.PhaseTimings()
+    timings.add("make", 10.0, 2.0, "metro_m4")
+    timings.add("make", 11.0, 3.5, "feather_m0")
+    timings.add("flash", 15.0, 1.25)
+
+    assert timings.summary() == {
+        "make": {"count": 2, "total": 5.5, "max": 3.5},
+        "flash": {"count": 1, "total": 1.25, "max": 1.25},
+    }
+
+
+def test_span_is_recorded_when_block_raises():
+    timings = timing.PhaseTimings()
+
+    with pytest.raises(RuntimeError):
+        with timings.span("make", "metro_m4"):
+            raise RuntimeError("build failed")
+
+    (span,) = timings.spans
+    assert (span.phase, span.detail) == ("make", "metro_m4")
+    assert span.duration >= 0
+
+
+def test_to_dict_orders_spans_and_summarises_lines():
+    timings = timing.PhaseTimings()
+    origin = timings.origin
+    timings.add("test", origin + 2, 1.0, "a.py")
+    timings.add("line", origin + 2.1, 0.1)
+    timings.add("line", origin + 2.3, 0.2)
+    timings.add("connect", origin + 0.5, 1.0)
+
+    payload = timings.to_dict()
+
+    assert [span["phase"] for span in payload["spans"]] == ["connect", "test"]
+    assert payload["spans"][0]["start"] == 0.5
+    assert payload["phases"]["line"] == {"count": 2, "total": 0.3, "max": 0.2}
+
+
+def test_extend_merges_worker_spans():
+    timings = timing.PhaseTimings()
+    timings.add("connect", timings.origin, 1.0)
+    worker = timing.PhaseTimings()
+    worker.add("make", worker.origin, 30.0, "metro_m4")
+
+    timings.extend(worker)
+
+    assert [span.phase for span in timings.spans] == ["connect", "make"]
+
+
+def test_span_helper_uses_log_timings():
+    class Log(): # pylint: disable=too-few-public-methods
+        timings = timing.PhaseTimings()
+
+    with timing.span(Log, "fw_cache_lookup"):
+        pass
+    # logs without timings are left alone
+    with timing.span(object(), "fw_cache_lookup"):
+        pass
+
+    assert [span.phase for span in Log.timings.spans] == ["fw_cache_lookup"]
@@ -0,0 +1,129 @@
+""" The verifier registry, and the controller's checks of the verifiers
+    a test uses.
+"""
+
+import textwrap
+
+import pytest
+
+from rosiepi.rosie import test_controller, verifiers
+from rosiepi.rosie.simulator import SimulatedBoard
+
+
+class EntryPoint(): # pylint: disable=too-few-public-methods
+    def __init__(self, name, func=None):
+        self.name = name
+        self.func = func
+
+    def load(self):
+        if self.func is None:
+            raise ImportError(f"no module for {self.name}")
+        return self.func
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    """ A copy of the discovered registry, so tests can add to it. """
+    monkeypatch.setattr(verifiers, "_REGISTRY", dict(verifiers.discover()))
+    return verifiers._REGISTRY # pylint: disable=protected-access
+
+
+def test_discovers_bundled_verifiers(registry):
+    from rosiepi.rosie.verifiers import test_stub # pylint: disable=import-outside-toplevel
+
+    assert verifiers.get_verifier("test_stub.foo") is test_stub.foo
+    assert "test_stub.bar" not in registry
+
+
+def test_register_names_by_module_and_function(registry):
+    def check(board): # pylint: disable=unused-argument
+        return True
+    check.__module__ = "rosiepi_extras.pin_tests"
+
+    assert verifiers.register(check) is check
+    assert verifiers.get_verifier("pin_tests.check") is check
+
+
+def test_unknown_verifier(registry):
+    with pytest.raises(LookupError):
+        verifiers.get_verifier("pin_tests.nope")
+
+    assert verifiers.missing_verifiers(
+        ["pin_tests.nope", "test_stub.foo", "pin_tests.nope", "a.b"]
+    ) == ["a.b", "pin_tests.nope"]
+
+
+def test_entry_points_are_loaded_once(registry, monkeypatch):
+    def assert_pin_high(board): # pylint: disable=unused-argument
+        return True
+    loads = []
+
+    def iter_entry_points(group):
+        loads.append(group)
+        return [
+            EntryPoint("pin_tests.assert_pin_high", assert_pin_high),
+            EntryPoint("broken.verifier"),
+        ]
+    monkeypatch.setattr(verifiers.pkg_resources, "iter_entry_points",
+                        iter_entry_points)
+    monkeypatch.setattr(verifiers, "_discovered", False)
+
+    assert verifiers.get_verifier("pin_tests.assert_pin_high") is assert_pin_high
+    assert verifiers.missing_verifiers(["broken.verifier"]) == ["broken.verifier"]
+    assert loads == [verifiers.ENTRY_POINT_GROUP]
+
+
+def controller_for(tmp_path, **tests):
+    tests_dir = tmp_path / "rosie_tests"
+    tests_dir.mkdir()
+    for name, source in tests.items():
+        (tests_dir / f"{name}.py").write_text(textwrap.dedent(source))
+    return test_controller.TestController(
+        "simulated",
+        "main",
+        log_dir=tmp_path / "logs",
+        board_factory=SimulatedBoard.factory(),
+        tests_dir=str(tests_dir),
+    )
+
+
+def test_unregistered_verifier_stops_run_before_flashing(tmp_path, registry):
+    controller = controller_for(
+        tmp_path,
+        a_verify="""\
+            #$ verify=pin_tests.nope
+            x = 1
+            """,
+    )
+    try:
+        assert not controller.prepare_tests()
+    finally:
+        controller.board.close()
+
+    assert controller.state == "error"
+    assert "pin_tests.nope" in controller.log.tail()
+
+
+def test_verifier_decides_line_result(tmp_path, registry):
+    registry["pin_tests.high"] = lambda board: True
+    registry["pin_tests.low"] = lambda board: False
+    controller = controller_for(
+        tmp_path,
+        a_high="""\
+            #$ verify=pin_tests.high
+            x = 1
+            """,
+        b_low="""\
+            #$ verify=pin_tests.low
+            x = 1
+            """,
+    )
+    try:
+        assert controller.prepare_tests()
+        controller.run_tests()
+    finally:
+        controller.board.close()
+
+    assert {test.test_file: test.test_result for test in controller.tests} == {
+        "a_high.py": True, "b_low.py": False
+    }